@@ -16,6 +16,8 @@ function DocumentPreview({ file, filename, onClose }) {
   const [error, setError] = useState(null);
 
   useEffect(() => {
+    let cancelled = false;
+
     const fetchPreview = async () => {
       try {
         if (file) {
@@ -53,6 +55,28 @@ function DocumentPreview({ file, filename, onClose }) {
             setError("Unsupported file type for preview");
             setLoading(false);
           }
+        } else if (filename && filename.match(/\.(pdf|docx)$/i)) {
+          // Server-side previews are paginated: show the first page as soon as it is ready
+          const previewUrl = `http://localhost:5000/document/preview/${filename}`;
+          const manifest = (await axios.get(`${previewUrl}/manifest`)).data;
+          if (manifest.type === "pdf") {
+            setFileContent({
+              type: "pdfPages",
+              pages: Array.from({ length: manifest.pages }, (_, i) => `${previewUrl}/pages/${i + 1}`),
+              url: previewUrl
+            });
+            setLoading(false);
+          } else {
+            const first = await axios.get(`${previewUrl}/pages/1`);
+            if (cancelled) return;
+            setFileContent({ type: "docx", text: first.data.content });
+            setLoading(false);
+            for (let page = 2; page <= manifest.pages && !cancelled; page++) {
+              const next = await axios.get(`${previewUrl}/pages/${page}`);
+              if (cancelled) return;
+              setFileContent(prev => ({ ...prev, text: `${prev.text}\n${next.data.content}` }));
+            }
+          }
         } else if (filename) {
           const token = localStorage.getItem('token');
           const response = await axios.get(`http://localhost:5000/document/preview/${filename}`, {
@@ -88,7 +112,8 @@ function DocumentPreview({ file, filename, onClose }) {
     fetchPreview();
 
     return () => {
-      if (fileContent?.url) {
+      cancelled = true;
+      if (fileContent?.url?.startsWith("blob:")) {
         URL.revokeObjectURL(fileContent.url);
       }
     };
@@ -121,6 +146,13 @@ function DocumentPreview({ file, filename, onClose }) {
             width="100%"
             height="100%"
           />
+        ) : fileContent?.type === "pdfPages" ? (
+          <div className="PdfPagesPreview">
+            <a href={fileContent.url} target="_blank" rel="noopener noreferrer">Open full PDF</a>
+            {fileContent.pages.map((src, index) => (
+              <img key={src} src={src} alt={`Page ${index + 1}`} loading="lazy" />
+            ))}
+          </div>
         ) : fileContent?.type === "docx" ? (
           <div className="DocxPreview">
             <pre>{fileContent.text}</pre>
@@ -218,6 +250,7 @@ function Mainpage() {
   const accountMenuRef = useRef(null);
   const historyListRef = useRef(null);
   const hasInitializedChatsRef = useRef(false);
+  const chatHistoryCacheRef = useRef({ etag: null, chats: null });
 
   useEffect(() => {
     let debounceTimeout;
@@ -411,11 +444,20 @@ function Mainpage() {
         localStorage.setItem('interruptedRequests', JSON.stringify([...serverInterruptedRequests]));
       }
 
+      // Revalidate with the last ETag; a 304 means the server-side chats are unchanged
+      const cache = chatHistoryCacheRef.current;
       const response = await axios.get('http://localhost:5000/chat/history', {
-        headers: { Authorization: `Bearer ${token}` },
+        headers: {
+          Authorization: `Bearer ${token}`,
+          ...(cache.etag ? { 'If-None-Match': cache.etag } : {})
+        },
+        validateStatus: status => (status >= 200 && status < 300) || status === 304,
         signal
       });
-      const fetchedChats = response.data.chats
+      if (response.status !== 304) {
+        chatHistoryCacheRef.current = { etag: response.headers.etag || null, chats: response.data.chats };
+      }
+      const fetchedChats = chatHistoryCacheRef.current.chats
         .map(chat => ({
           id: chat.id,
           name: chat.name,
@@ -617,6 +659,31 @@ function Mainpage() {
     }
   };
 
+  const findExistingDocument = async (file) => {
+    if (!user || user.isGuest || !window.crypto?.subtle) return null;
+    try {
+      const token = localStorage.getItem('token');
+      const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+      const sha256 = Array.from(new Uint8Array(digest))
+        .map(byte => byte.toString(16).padStart(2, '0'))
+        .join('');
+      const response = await axios.post('http://localhost:5000/document/check', {
+        sha256,
+        size: file.size,
+        file_type: file.name.split('.').pop().toLowerCase()
+      }, {
+        headers: {
+          Authorization: `Bearer ${token}`,
+          'Content-Type': 'application/json'
+        }
+      });
+      return response.data.exists ? response.data.document_id : null;
+    } catch (err) {
+      console.error("Error checking for existing document:", err);
+      return null;
+    }
+  };
+
   const handleQuerySubmit = async (isSummary = false) => {
     if ((query.trim() !== "" || selectedFile) && !isLoading) {
       const controller = new AbortController();
@@ -695,8 +762,21 @@ function Mainpage() {
         }
       }
 
+      // Skip the upload entirely when the server already has this file
+      const existingDocumentId = selectedFile ? await findExistingDocument(selectedFile) : null;
+
       const formData = new FormData();
-      if (selectedFile) formData.append('file', selectedFile);
+      if (existingDocumentId) {
+        formData.append('document_id', existingDocumentId);
+      } else if (selectedFile) {
+        formData.append('file', selectedFile);
+      }
+      if (user?.isGuest) {
+        // Guest documents stay cached on the server for a while; follow-ups refer to them by hash
+        const guestToken = localStorage.getItem('guestToken');
+        if (guestToken) formData.append('guest_token', guestToken);
+        if (!selectedFile && currentChatData.fileHash) formData.append('file_hash', currentChatData.fileHash);
+      }
       formData.append('query', effectiveQuery);
       formData.append('chat_id', chatId);
       formData.append('chat_name', chatName);
@@ -722,13 +802,17 @@ function Mainpage() {
           content: response.data.response,
           timestamp: new Date().toLocaleTimeString(),
         };
+        if (response.data.guest_token) {
+          localStorage.setItem('guestToken', response.data.guest_token);
+        }
 
         setChats(prevChats => {
           const updatedChats = prevChats.map(chat => {
             if (chat.id === chatId) {
               return {
                 ...chat,
-                history: [...chat.history, responseEntry]
+                history: [...chat.history, responseEntry],
+                ...(response.data.file_hash && { fileHash: response.data.file_hash })
               };
             }
             return chat;
@@ -823,6 +907,12 @@ function Mainpage() {
           ? "Request was interrupted by the client."
           : error.response?.data?.error || "An unexpected error occurred";
         console.error("Error during query submission:", errorMessage, error);
+        if (error.response?.status === 410) {
+          // The server-side guest copy expired; the next question needs the file again
+          setChats(prevChats => prevChats.map(chat =>
+            chat.id === chatId ? { ...chat, fileHash: undefined } : chat
+          ));
+        }
         setError(errorMessage);
       } finally {
         setIsLoading(false);
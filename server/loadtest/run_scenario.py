@@ -0,0 +1,197 @@
+"""Drive /document/upload and /document/process-document at rising concurrency.
+
+    python -m loadtest.run_scenario --files samples/*.pdf --concurrency 1,2,4,8,16 --requests 40
+
+Reports throughput and p50/p95/p99 latency per endpoint for every concurrency level.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import glob
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+import uuid
+import requests
+
+logger = logging.getLogger(__name__)
+
+QUESTIONS = [
+    "Summarize the document",
+    "What methods are used in this paper?",
+    "What are the main results?",
+    "How many pages does the document have?",
+    "What are the limitations of this work?",
+]
+
+MIME_TYPES = {
+    "pdf": "application/pdf",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+}
+
+def percentile(sorted_values, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+class Recorder:
+    """Thread-safe collection of (endpoint, latency, ok) samples"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, endpoint: str, latency: float, ok: bool):
+        with self.lock:
+            self.samples.setdefault(endpoint, []).append((latency, ok))
+
+    def summary(self, wall_time: float) -> dict:
+        report = {}
+        for endpoint, samples in self.samples.items():
+            latencies = sorted(s[0] for s in samples)
+            errors = sum(1 for s in samples if not s[1])
+            report[endpoint] = {
+                "requests": len(samples),
+                "errors": errors,
+                "throughput_rps": round(len(samples) / wall_time, 2) if wall_time else 0.0,
+                "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+                "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+                "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+            }
+        return report
+
+class Client:
+    """Minimal API client for one virtual user"""
+
+    def __init__(self, base_url: str, recorder: Recorder, token: str = None):
+        self.base_url = base_url.rstrip("/")
+        self.recorder = recorder
+        self.token = token
+        self.session = requests.Session()
+
+    def _headers(self):
+        return {"Authorization": f"Bearer {self.token}"} if self.token else {}
+
+    def _timed_post(self, endpoint: str, **kwargs):
+        start = time.perf_counter()
+        ok = False
+        try:
+            response = self.session.post(f"{self.base_url}{endpoint}", headers=self._headers(), timeout=300, **kwargs)
+            ok = response.status_code < 400
+            return response
+        except requests.RequestException as e:
+            logger.warning(f"{endpoint} failed: {str(e)}")
+            return None
+        finally:
+            self.recorder.record(endpoint, time.perf_counter() - start, ok)
+
+    def upload(self, filename: str, payload: bytes):
+        ext = filename.rsplit(".", 1)[1].lower()
+        files = {"file": (filename, payload, MIME_TYPES.get(ext, "application/octet-stream"))}
+        return self._timed_post("/document/upload", files=files)
+
+    def process(self, query: str, filename: str = None, payload: bytes = None, chat_id: str = None):
+        data = {"query": query, "request_id": str(uuid.uuid4()), "chat_name": "Load test"}
+        if chat_id:
+            data["chat_id"] = chat_id
+        files = None
+        if filename:
+            ext = filename.rsplit(".", 1)[1].lower()
+            files = {"file": (filename, payload, MIME_TYPES.get(ext, "application/octet-stream"))}
+        return self._timed_post("/document/process-document", data=data, files=files)
+
+def login(base_url: str) -> str:
+    """Create a throwaway user and return its JWT"""
+    username = f"loadtest_{uuid.uuid4().hex[:10]}"
+    password = uuid.uuid4().hex
+    requests.post(f"{base_url}/auth/signup", json={
+        "username": username,
+        "email": f"{username}@loadtest.local",
+        "password": password
+    }, timeout=30).raise_for_status()
+    response = requests.post(f"{base_url}/auth/login", json={"username": username, "password": password}, timeout=30)
+    response.raise_for_status()
+    return response.json()["token"]
+
+def make_unique(filename: str, payload: bytes) -> bytes:
+    """Defeat hash dedupe so every upload is fully ingested (PDF only: trailing comment is ignored by readers)"""
+    if filename.lower().endswith(".pdf"):
+        return payload + f"\n%loadtest-{uuid.uuid4()}\n".encode()
+    return payload
+
+def virtual_user(args, corpus, recorder: Recorder, token: str, iterations: int):
+    client = Client(args.base_url, recorder, token)
+    for _ in range(iterations):
+        filename, payload = random.choice(corpus)
+        if args.unique_uploads:
+            payload = make_unique(filename, payload)
+        scenario = args.scenario if args.scenario != "mixed" else random.choice(["upload", "process", "followup"])
+
+        if scenario == "upload" and token:
+            client.upload(filename, payload)
+        elif scenario == "followup" and token:
+            response = client.process(random.choice(QUESTIONS), filename, payload)
+            chat_id = response.json().get("chat_id") if response is not None and response.ok else None
+            if chat_id:
+                client.process(random.choice(QUESTIONS), chat_id=chat_id)
+        else:
+            client.process(random.choice(QUESTIONS), filename, payload)
+
+def run_level(args, corpus, concurrency: int) -> dict:
+    recorder = Recorder()
+    tokens = [None] * concurrency
+    if not args.guest:
+        tokens = [login(args.base_url) for _ in range(concurrency)]
+    per_user = max(1, args.requests // concurrency)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(virtual_user, args, corpus, recorder, tokens[i], per_user) for i in range(concurrency)]
+        for future in futures:
+            future.result()
+    wall_time = time.perf_counter() - start
+    return {"concurrency": concurrency, "wall_time_s": round(wall_time, 2), "endpoints": recorder.summary(wall_time)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the document endpoints")
+    parser.add_argument("--base-url", default="http://127.0.0.1:5000")
+    parser.add_argument("--files", nargs="+", required=True, help="Sample documents (globs allowed)")
+    parser.add_argument("--scenario", choices=["upload", "process", "followup", "mixed"], default="mixed")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=20, help="Scenario iterations per level")
+    parser.add_argument("--guest", action="store_true", help="Send process-document requests without a JWT")
+    parser.add_argument("--unique-uploads", action="store_true", help="Make every upload hash differently")
+    parser.add_argument("--output", help="Write the JSON report here")
+    args = parser.parse_args()
+
+    paths = [p for pattern in args.files for p in glob.glob(pattern)]
+    if not paths:
+        parser.error("No sample files matched --files")
+    corpus = []
+    for path in paths:
+        with open(path, "rb") as f:
+            corpus.append((os.path.basename(path), f.read()))
+
+    report = []
+    for level in [int(c) for c in args.concurrency.split(",")]:
+        result = run_level(args, corpus, level)
+        report.append(result)
+        for endpoint, stats in result["endpoints"].items():
+            print(f"c={level:<4} {endpoint:<28} n={stats['requests']:<5} err={stats['errors']:<4} "
+                  f"{stats['throughput_rps']:>7.2f} req/s  p50={stats['p50_ms']:>8.1f}ms  "
+                  f"p95={stats['p95_ms']:>8.1f}ms  p99={stats['p99_ms']:>8.1f}ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
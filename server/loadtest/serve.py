@@ -0,0 +1,26 @@
+"""Run the backend for load tests: in-memory Mongo, stub LLM, no reloader.
+
+    python -m loadtest.serve --stub-url http://127.0.0.1:5055/v1/chat/completions
+"""
+import argparse
+import os
+
+def main():
+    parser = argparse.ArgumentParser(description="Run InsightPaper backend against local stand-ins")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--stub-url", default="http://127.0.0.1:5055/v1/chat/completions")
+    parser.add_argument("--mongo-uri", default="mongomock://localhost",
+                        help="mongomock://... for in-memory, or a local mongodb:// URI")
+    args = parser.parse_args()
+
+    # Must be set before the app modules read their configuration at import time
+    os.environ["MONGO_URI"] = args.mongo_uri
+    os.environ["TOGETHER_API_URL"] = args.stub_url
+
+    from server import create_app
+    app = create_app()
+    app.run(host=args.host, port=args.port, threaded=True, use_reloader=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Local stand-in for the Together chat/vision completion endpoints.
+
+Point the server at it with TOGETHER_API_URL=http://localhost:5055/v1/chat/completions
+(image_utils reads the same variable, so vision calls land here too).
+
+    python -m loadtest.stub_llm --latency lognormal:1.2:0.5 --error-rate 0.02
+"""
+from flask import Flask, request, jsonify, Response, stream_with_context
+import argparse
+import json
+import logging
+import random
+import time
+import uuid
+import os
+
+logger = logging.getLogger(__name__)
+
+STUB_REPLY = os.getenv(
+    "STUB_LLM_REPLY",
+    "This is a stubbed completion used for load testing. The document discusses its methods, "
+    "results and limitations in several sections."
+)
+
+class LatencyModel:
+    """Sample upstream latency (seconds) from a configurable distribution"""
+
+    def __init__(self, spec: str):
+        parts = spec.split(":")
+        self.kind = parts[0]
+        self.params = [float(p) for p in parts[1:]]
+        if self.kind not in ("fixed", "uniform", "normal", "lognormal", "exponential"):
+            raise ValueError(f"Unknown latency distribution: {self.kind}")
+
+    def sample(self) -> float:
+        p = self.params
+        if self.kind == "fixed":
+            value = p[0] if p else 0.0
+        elif self.kind == "uniform":
+            value = random.uniform(p[0], p[1])
+        elif self.kind == "normal":
+            value = random.gauss(p[0], p[1])
+        elif self.kind == "lognormal":
+            # median, sigma -> easier to reason about than mu
+            value = p[0] * random.lognormvariate(0, p[1])
+        else:
+            value = random.expovariate(1.0 / p[0])
+        return max(0.0, value)
+
+def create_stub_app(latency: str = "fixed:0.5", error_rate: float = 0.0, error_status: int = 503,
+                    stream_chunk_delay: float = 0.02) -> Flask:
+    app = Flask(__name__)
+    latency_model = LatencyModel(latency)
+    app.config["STUB_STATS"] = {"requests": 0, "errors": 0, "streams": 0}
+
+    def completion_payload(model: str, content: str) -> dict:
+        return {
+            "id": f"stub-{uuid.uuid4()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(content.split()), "total_tokens": 0}
+        }
+
+    @app.route("/v1/<path:endpoint>", methods=["POST"])
+    def completions(endpoint):
+        stats = app.config["STUB_STATS"]
+        stats["requests"] += 1
+        data = request.get_json(silent=True) or {}
+        model = data.get("model", "stub-model")
+
+        time.sleep(latency_model.sample())
+
+        if error_rate and random.random() < error_rate:
+            stats["errors"] += 1
+            return jsonify({"error": {"message": "Injected stub failure"}}), error_status
+
+        if not data.get("stream"):
+            return jsonify(completion_payload(model, STUB_REPLY))
+
+        stats["streams"] += 1
+
+        def generate():
+            for word in STUB_REPLY.split(" "):
+                chunk = {
+                    "id": "stub-stream",
+                    "object": "chat.completion.chunk",
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+                time.sleep(stream_chunk_delay)
+            yield "data: [DONE]\n\n"
+
+        return Response(stream_with_context(generate()), mimetype="text/event-stream")
+
+    @app.route("/stats", methods=["GET"])
+    def stats():
+        return jsonify(app.config["STUB_STATS"])
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub Together completion API for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--latency", default="fixed:0.5",
+                        help="fixed:S | uniform:LO:HI | normal:MU:SIGMA | lognormal:MEDIAN:SIGMA | exponential:MEAN")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--stream-chunk-delay", type=float, default=0.02)
+    args = parser.parse_args()
+
+    app = create_stub_app(args.latency, args.error_rate, args.error_status, args.stream_chunk_delay)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == "__main__":
+    main()
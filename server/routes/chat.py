@@ -1,7 +1,9 @@
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask_jwt_extended import jwt_required, get_jwt_identity, verify_jwt_in_request
 from utils.db import chat_sessions_collection, queries_collection, documents_collection, users_collection
 from bson import ObjectId
+from utils.persistence import turn_writer, PersistenceError
+from utils.http_cache import make_etag, not_modified, with_etag
 import logging
 from datetime import datetime
 
@@ -9,6 +11,23 @@ logger = logging.getLogger(__name__)
 
 chat_bp = Blueprint('chat', __name__)
 
+@chat_bp.before_request
+def flush_pending_turns():
+    # Chat turns are written behind responses; make this user's visible before any chat read or edit
+    try:
+        verify_jwt_in_request(optional=True)
+        user_id = get_jwt_identity()
+    except Exception:
+        return None  # Rejected by jwt_required on the route itself
+    if not user_id:
+        return None
+    try:
+        turn_writer.flush(user_id)
+    except PersistenceError as e:
+        logger.error(f"Chat write failed for user_id {user_id}: {str(e)}")
+        return jsonify({"error": "A recent chat update could not be saved, please retry"}), 503
+    return None
+
 @chat_bp.route('/history', methods=['GET'])
 @jwt_required()
 def get_chat_history():
@@ -18,8 +37,18 @@ def get_chat_history():
             logger.warning("User ID not found in JWT token")
             return jsonify({"error": "User ID not found"}), 401
 
+        # Chat versions decide whether the client's copy is current, so an unchanged poll skips the histories
+        versions = sorted(
+            (str(chat["_id"]), chat.get("version", 1))
+            for chat in chat_sessions_collection.find({"user_id": user_id}, {"version": 1})
+        )
+        cached = not_modified(make_etag(user_id, versions))
+        if cached:
+            logger.info(f"Chat history unchanged for user_id: {user_id}")
+            return cached
+
         logger.info(f"Fetching chat history for user_id: {user_id}")
-        chats = chat_sessions_collection.find({"user_id": user_id})
+        chats = chat_sessions_collection.find({"user_id": user_id}, {"memory": 0})
         chat_list = []
         for chat in chats:
             chat_id = str(chat["_id"])
@@ -38,7 +67,8 @@ def get_chat_history():
             chat_list.append(chat_data)
 
         logger.info(f"Returning {len(chat_list)} chats for user_id: {user_id}")
-        return jsonify({"chats": chat_list}), 200
+        etag = make_etag(user_id, sorted((chat["id"], chat["version"]) for chat in chat_list))
+        return with_etag(jsonify({"chats": chat_list}), etag), 200
 
     except Exception as e:
         logger.error(f"Error fetching chat history: {str(e)}", exc_info=True)
@@ -81,8 +111,14 @@ def get_chat(chat_id):
             return jsonify({"error": "Invalid chat ID"}), 400
 
         user_id = get_jwt_identity()
-        chat = chat_sessions_collection.find_one({"_id": ObjectId(chat_id), "user_id": user_id})
+        current = chat_sessions_collection.find_one({"_id": ObjectId(chat_id), "user_id": user_id}, {"version": 1})
+        if not current:
+            return jsonify({"error": "Chat not found or not authorized"}), 404
+        cached = not_modified(make_etag(chat_id, current.get("version", 1)))
+        if cached:
+            return cached
 
+        chat = chat_sessions_collection.find_one({"_id": ObjectId(chat_id), "user_id": user_id}, {"memory": 0})
         if not chat:
             return jsonify({"error": "Chat not found or not authorized"}), 404
 
@@ -98,7 +134,7 @@ def get_chat(chat_id):
         }
 
         logger.info(f"Retrieved chat {chat_id} with {len(chat_data['history'])} history entries")
-        return jsonify(chat_data), 200
+        return with_etag(jsonify(chat_data), make_etag(chat_id, chat_data["version"])), 200
 
     except Exception as e:
         logger.error(f"Error fetching chat: {str(e)}", exc_info=True)
@@ -267,6 +303,8 @@ def update_chat_history(chat_id):
                     "history": new_history,
                     "last_updated": datetime.utcnow()
                 },
+                # Rebuilt from the new history on the next query
+                "$unset": {"memory": ""},
                 "$inc": {"version": 1}
             }
         )
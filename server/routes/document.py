@@ -1,37 +1,92 @@
-from flask import Blueprint, request, jsonify, send_from_directory, current_app, g
+from flask import Blueprint, request, jsonify, send_file, current_app, g, Response, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity, verify_jwt_in_request
 from utils.db import users_collection, documents_collection, chat_sessions_collection, queries_collection
-from utils.file_utils import allowed_file, extract_text_from_pdf, extract_text_from_docx, FileProcessingError
-from utils.image_utils import allowed_image, summarize_image, ImageProcessingError
-from utils.nlp_utils import load_document, process_document_query
+from utils.file_utils import allowed_file, FileProcessingError, MAX_FILE_SIZE
+from utils.image_utils import allowed_image, summarize_image, ImageProcessingError, MAX_IMAGE_SIZE
+from utils.upload_stream import upload_hash, discard_upload
+from utils.blob_store import BlobStore
+from utils.admission import AdmissionError
+from utils.memory_budget import MemoryBudgetError, COMPLETE_INGESTION
+from utils.persistence import turn_writer, PersistenceError
+from utils.http_cache import make_etag, not_modified, with_etag
+from utils.preview_cache import preview_cache, PreviewError
+from utils.guest_cache import guest_cache, new_guest_token, is_valid_guest_token
+from utils.text_store import WITHOUT_TEXT
+from utils.stage_graph import StageGraph
+from pymongo import UpdateOne, InsertOne
+from utils.nlp_utils import (
+    load_document, process_document_query, process_document_queries, compare_documents,
+    conversation_memory, COMPARE_MAX_DOCUMENTS
+)
 from werkzeug.utils import secure_filename
 import os
+import json
 from io import BytesIO
-from docx import Document as DocxDocument
-import uuid
 from datetime import datetime
 import logging
 from bson import ObjectId
 import time
-from werkzeug.exceptions import RequestTimeout
+from werkzeug.exceptions import RequestTimeout, RequestEntityTooLarge
 from flask import abort
-import hashlib
 
 logger = logging.getLogger(__name__)
 
+BATCH_MAX_QUESTIONS = int(os.getenv('BATCH_MAX_QUESTIONS', 20))
+
 document_bp = Blueprint('document', __name__)
 
+def _find_chat_session(chat_id: str, user_id: str, projection: dict):
+    # Turns are written behind responses; make this user's previous ones visible first
+    turn_writer.flush(user_id)
+    return chat_sessions_collection.find_one({"_id": ObjectId(chat_id), "user_id": user_id}, projection)
+
+def _session_memory(chat_id: str, user_id: str, session: dict, history: list = None):
+    """Conversation memory to extend with the next turn.
+
+    Chats from before conversation memory, and chats whose history was edited,
+    have none stored; it is rebuilt from history so the write does not replace
+    the earlier turns with a memory of one.
+    """
+    if session.get("memory") is not None:
+        return session["memory"]
+    if history is None:
+        record = chat_sessions_collection.find_one({"_id": ObjectId(chat_id), "user_id": user_id}, {"history": 1})
+        history = (record or {}).get("history", [])
+    return conversation_memory.from_history(history) if history else None
+
+def _truncation_notice(metadata: dict) -> dict:
+    """Response fields telling the client only part of the document was ingested"""
+    if not metadata or not metadata.get("truncated"):
+        return {}
+    notice = {
+        "truncated": True,
+        "warning": "This document is too large to process in full; answers are based on its first part only"
+    }
+    if "ingested_pages" in metadata:
+        notice["ingested_pages"] = metadata["ingested_pages"]
+    return notice
+
+def _persistence_response(e: PersistenceError):
+    logger.error(f"Chat write failed: {str(e)}")
+    return jsonify({"error": "A recent chat update could not be saved, please retry"}), 503
+
+def _busy_response(e: AdmissionError):
+    logger.warning(f"Request not admitted: {str(e)}")
+    return jsonify({"error": str(e), "retry_after": e.retry_after}), 429, {"Retry-After": str(e.retry_after)}
+
 @document_bp.before_request
 def before_request():
     g.start_time = time.time()
-    g.filepath = None
+    g.blob_name = None
     logger.info(f"Starting request at {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}")
 
 @document_bp.after_request
 def after_request(response):
-    if hasattr(g, 'filepath') and g.filepath and os.path.exists(g.filepath) and not hasattr(g, 'document_id'):
-        logger.info(f"Cleaning up temporary file: {g.filepath}")
-        os.remove(g.filepath)
+    # Uploads not claimed by a stored document drop their blob reference; GC reclaims the file
+    if getattr(g, 'blob_name', None) and not hasattr(g, 'document_id'):
+        logger.info(f"Releasing unreferenced upload blob: {g.blob_name}")
+        current_app.blob_store.release(g.blob_name)
+    current_app.blob_store.maybe_collect_garbage()
     logger.info(f"Request completed in {time.time() - g.start_time:.2f} seconds")
     return response
 
@@ -55,41 +110,47 @@ def upload_file():
             return jsonify({"error": "Only PDF, DOCX, PNG, or JPEG files are allowed"}), 400
 
         user_id = get_jwt_identity()
-        unique_id = str(uuid.uuid4())
-        filename = f"doc_{unique_id}.{file_ext}"
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        g.filepath = filepath
-        
-        file.save(filepath)
-        
-        # Compute file hash
-        sha256_hash = hashlib.sha256()
-        with open(filepath, "rb") as f:
-            for byte_block in iter(lambda: f.read(65536), b""):
-                sha256_hash.update(byte_block)
-        file_hash = sha256_hash.hexdigest()
-        
-        # Check if document is already processed
-        existing_doc = documents_collection.find_one({"file_hash": file_hash, "user_id": user_id})
+
+        # The hash is computed while the request body streams in, so duplicates
+        # are detected before anything is moved into the upload folder
+        file_hash = upload_hash(file)
+        existing_doc = documents_collection.find_one({"file_hash": file_hash, "user_id": user_id, **COMPLETE_INGESTION}, {"_id": 1}) if file_hash else None
         if existing_doc:
             logger.info(f"Found existing document with hash {file_hash}, returning existing document_id")
-            g.document_id = str(existing_doc["_id"])
+            discard_upload(file)
             return jsonify({
                 "message": "File already uploaded",
                 "document_id": str(existing_doc["_id"])
             }), 200
 
+        filename, file_size, file_hash = current_app.blob_store.put_upload(
+            file, file_ext, MAX_IMAGE_SIZE if is_image else MAX_FILE_SIZE
+        )
+        g.blob_name = filename
+        filepath = current_app.blob_store.path_for(filename)
+        
+        if upload_hash(file) is None:
+            existing_doc = documents_collection.find_one({"file_hash": file_hash, "user_id": user_id, **COMPLETE_INGESTION}, {"_id": 1})
+            if existing_doc:
+                logger.info(f"Found existing document with hash {file_hash}, discarding duplicate upload")
+                current_app.blob_store.release(filename)
+                g.blob_name = None
+                return jsonify({
+                    "message": "File already uploaded",
+                    "document_id": str(existing_doc["_id"])
+                }), 200
+
         if is_image:
             file_stream = open(filepath, 'rb')
             try:
-                summary = summarize_image(file_stream)
+                summary = summarize_image(file_stream, content_hash=file_hash)
                 doc_data = {
                     "user_id": user_id,
                     "original_name": secure_filename(file.filename),
                     "stored_name": filename,
                     "upload_date": datetime.utcnow(),
                     "file_type": file_ext,
-                    "size": os.path.getsize(filepath),
+                    "size": file_size,
                     "file_hash": file_hash,
                     "metadata": {
                         "is_image": True,
@@ -107,24 +168,16 @@ def upload_file():
             finally:
                 file_stream.close()
         else:
-            file_stream = open(filepath, 'rb')
-            if file_ext == 'pdf':
-                extracted_text = extract_text_from_pdf(file_stream)
-            else:
-                extracted_text = extract_text_from_docx(file_stream)
-            file_stream.close()
-            
-            documents, metadata, _ = load_document(filepath, user_id)
-            
+            documents, metadata, _ = load_document(filepath, user_id, file_hash=file_hash)
+
             doc_data = {
                 "user_id": user_id,
                 "original_name": secure_filename(file.filename),
                 "stored_name": filename,
                 "upload_date": datetime.utcnow(),
                 "file_type": file_ext,
-                "size": os.path.getsize(filepath),
+                "size": file_size,
                 "file_hash": file_hash,
-                "extracted_text": extracted_text,
                 "metadata": metadata,
                 "version": 1,
                 "chunks": [{
@@ -140,9 +193,18 @@ def upload_file():
             logger.info(f"Document upload and processing completed in {time.time() - start_time:.2f} seconds")
             return jsonify({
                 "message": "File uploaded successfully",
-                "document_id": str(result.inserted_id)
+                "document_id": str(result.inserted_id),
+                **_truncation_notice(metadata)
             }), 201
 
+    except RequestEntityTooLarge as e:
+        logger.warning(f"Upload rejected: {e.description}")
+        return jsonify({"error": e.description}), 413
+    except AdmissionError as e:
+        return _busy_response(e)
+    except MemoryBudgetError as e:
+        logger.warning(f"Document rejected by memory budget: {str(e)}")
+        return jsonify({"error": str(e)}), 413
     except (FileProcessingError, ImageProcessingError) as e:
         logger.error(f"File processing error: {str(e)}")
         return jsonify({"error": str(e)}), 400
@@ -150,39 +212,94 @@ def upload_file():
         logger.error(f"Unexpected upload error: {str(e)}", exc_info=True)
         return jsonify({"error": "Failed to upload file"}), 500
 
+@document_bp.route('/check', methods=['POST'])
+@jwt_required()
+def check_document():
+    # Lets the client skip uploading files the server has already processed
+    try:
+        data = request.get_json() or {}
+        file_hash = (data.get('sha256') or '').lower()
+        size = data.get('size')
+        file_type = (data.get('file_type') or '').lower().lstrip('.')
+
+        if len(file_hash) != 64 or any(c not in '0123456789abcdef' for c in file_hash):
+            return jsonify({"error": "A hex SHA-256 digest is required"}), 400
+
+        user_id = get_jwt_identity()
+        query = {"file_hash": file_hash, "user_id": user_id, **COMPLETE_INGESTION}
+        if isinstance(size, int):
+            query["size"] = size
+        if file_type in ("jpg", "jpeg"):
+            query["file_type"] = {"$in": ["jpg", "jpeg"]}
+        elif file_type:
+            query["file_type"] = file_type
+
+        existing_doc = documents_collection.find_one(query, {"_id": 1, "stored_name": 1, "original_name": 1})
+        if not existing_doc:
+            return jsonify({"exists": False}), 200
+
+        logger.info(f"Pre-upload check hit for hash {file_hash}, document {existing_doc['_id']}")
+        return jsonify({
+            "exists": True,
+            "document_id": str(existing_doc["_id"]),
+            "stored_name": existing_doc.get("stored_name"),
+            "original_name": existing_doc.get("original_name")
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error checking document hash: {str(e)}", exc_info=True)
+        return jsonify({"error": "Failed to check document"}), 500
+
+def _send_upload(filepath: str, filename: str, mimetype: str):
+    """Serve an upload with Range and conditional-GET support"""
+    blob_hash = BlobStore.hash_of(filename)
+    response = send_file(
+        filepath,
+        mimetype=mimetype,
+        as_attachment=False,
+        conditional=True,
+        etag=blob_hash or True,
+        # Content-addressed: the bytes behind a blob name can never change
+        max_age=31536000 if blob_hash else None
+    )
+    if blob_hash:
+        response.cache_control.immutable = True
+    return response
+
 @document_bp.route('/preview/<filename>', methods=['GET'])
 def preview_document(filename):
     try:
-        if not filename.startswith('doc_'):
+        if not BlobStore.is_valid_name(filename):
             return jsonify({"error": "Invalid file"}), 400
         
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+        filepath = current_app.blob_store.path_for(filename)
         if not os.path.exists(filepath):
             return jsonify({"error": "File not found"}), 404
         
         file_ext = filename.rsplit('.', 1)[1].lower()
         if file_ext in ['png', 'jpeg', 'jpg']:
-            return send_from_directory(
-                current_app.config['UPLOAD_FOLDER'],
-                filename,
-                as_attachment=False,
-                mimetype=f'image/{file_ext}'
-            )
+            return _send_upload(filepath, filename, f"image/{'jpeg' if file_ext == 'jpg' else file_ext}")
         elif filename.lower().endswith('.pdf'):
-            return send_from_directory(
-                current_app.config['UPLOAD_FOLDER'],
-                filename,
-                as_attachment=False,
-                mimetype='application/pdf'
-            )
+            return _send_upload(filepath, filename, 'application/pdf')
         elif filename.lower().endswith('.docx'):
-            doc = DocxDocument(filepath)
-            text = "\n".join([para.text for para in doc.paragraphs])
-            return jsonify({
+            # Content-addressed names never change bytes; older uploads fall back to size and mtime
+            blob_hash = BlobStore.hash_of(filename)
+            if blob_hash:
+                etag = make_etag("docx-preview", blob_hash)
+                cache_control = "private, max-age=31536000, immutable"
+            else:
+                stat = os.stat(filepath)
+                etag = make_etag("docx-preview", filename, stat.st_size, stat.st_mtime_ns)
+                cache_control = "private, no-cache"
+            cached = not_modified(etag, cache_control)
+            if cached:
+                return cached
+
+            return with_etag(jsonify({
                 "type": "docx",
-                "content": text,
+                "content": preview_cache.read_text(filename, filepath),
                 "filename": filename
-            })
+            }), etag, cache_control)
         
         return jsonify({"error": "Unsupported file type"}), 400
 
@@ -193,6 +310,64 @@ def preview_document(filename):
         logger.error(f"Unexpected preview error: {str(e)}", exc_info=True)
         return jsonify({"error": "Failed to generate preview"}), 500
 
+def _preview_file(filename: str):
+    """Stored path for a previewable upload, or an error response"""
+    if not BlobStore.is_valid_name(filename) or not filename.lower().endswith(('.pdf', '.docx')):
+        return None, (jsonify({"error": "Invalid file"}), 400)
+    filepath = current_app.blob_store.path_for(filename)
+    if not os.path.exists(filepath):
+        return None, (jsonify({"error": "File not found"}), 404)
+    return filepath, None
+
+@document_bp.route('/preview/<filename>/manifest', methods=['GET'])
+def preview_manifest(filename):
+    try:
+        filepath, error = _preview_file(filename)
+        if error:
+            return error
+        manifest = preview_cache.manifest(filename, filepath)
+        return jsonify({
+            "type": manifest["type"],
+            "pages": manifest["pages"],
+            "filename": filename
+        }), 200
+
+    except (PreviewError, FileProcessingError) as e:
+        logger.error(f"Preview manifest error: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Unexpected preview manifest error: {str(e)}", exc_info=True)
+        return jsonify({"error": "Failed to generate preview"}), 500
+
+@document_bp.route('/preview/<filename>/pages/<int:page>', methods=['GET'])
+def preview_page(filename, page):
+    try:
+        filepath, error = _preview_file(filename)
+        if error:
+            return error
+        # Artifacts of content-addressed files never change
+        immutable = BlobStore.hash_of(filename) is not None
+        cache_control = "private, max-age=31536000, immutable" if immutable else "private, no-cache"
+        etag = make_etag("preview-page", filename, page)
+        cached = not_modified(etag, cache_control)
+        if cached:
+            return cached
+
+        page_path = preview_cache.page(filename, filepath, page)
+        if filename.lower().endswith('.pdf'):
+            response = send_file(page_path, mimetype='image/jpeg', conditional=False)
+            return with_etag(response, etag, cache_control)
+        with open(page_path, 'r', encoding='utf-8') as handle:
+            content = handle.read()
+        return with_etag(jsonify({"type": "docx", "page": page, "content": content}), etag, cache_control)
+
+    except (PreviewError, FileProcessingError) as e:
+        logger.error(f"Preview page error: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Unexpected preview page error: {str(e)}", exc_info=True)
+        return jsonify({"error": "Failed to generate preview"}), 500
+
 @document_bp.route('/cancel-request', methods=['POST'])
 @jwt_required()
 def cancel_request():
@@ -230,8 +405,18 @@ def process_document():
         chat_id = request.form.get("chat_id")
         chat_name = request.form.get("chat_name", "New Chat")
         request_id = request.form.get("request_id")
-
-        if not query_text and not file:
+        attach_document_id = request.form.get("document_id")
+
+        # Guests get a session token that keys their processed documents in the guest cache
+        guest_token = None
+        guest_file_hash = None
+        if not user_id:
+            guest_token = request.form.get("guest_token")
+            if not is_valid_guest_token(guest_token):
+                guest_token = new_guest_token()
+            guest_file_hash = request.form.get("file_hash")
+
+        if not query_text and not file and not attach_document_id:
             return jsonify({"error": "Query or file must be provided"}), 400
 
         if not request_id:
@@ -250,11 +435,23 @@ def process_document():
         documents = None
         metadata = None
         chat_history = []
+        memory = None
+        chat_session = None
         stored_filename = None
         is_image = False
         response = None
         filepath = None
+        file_hash = None
         existing_doc = None
+        guest_entry = None
+
+        # The chat session read does not depend on the upload; start it now
+        stages = StageGraph()
+        if user_id and chat_id and ObjectId.is_valid(chat_id):
+            with_file = bool(file and file.filename != '') or bool(attach_document_id)
+            stages.add("chat_session", lambda: _find_chat_session(
+                chat_id, user_id, {"memory": 1} if with_file else {"history": 1, "memory": 1, "document_id": 1}
+            ))
 
         timing_logs["init"] = time.time() - step_start
         step_start = time.time()
@@ -267,57 +464,34 @@ def process_document():
             if not (is_document or is_image):
                 return jsonify({"error": "Invalid file type. Only PDF, DOCX, PNG, or JPEG allowed"}), 400
                 
-            unique_id = str(uuid.uuid4())
-            stored_filename = f"doc_{unique_id}.{file_ext}"
-            filepath = os.path.join(current_app.config["UPLOAD_FOLDER"], stored_filename)
-            g.filepath = filepath
-            file.save(filepath)
-            logger.info(f"File saved at {filepath} at {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}")
-            
-            # Compute file hash
-            sha256_hash = hashlib.sha256()
-            with open(filepath, "rb") as f:
-                for byte_block in iter(lambda: f.read(65536), b""):
-                    sha256_hash.update(byte_block)
-            file_hash = sha256_hash.hexdigest()
+            # Hash is known once the body has streamed in; only keep the file if it is new
+            file_hash = upload_hash(file)
+            if user_id and file_hash:
+                existing_doc = documents_collection.find_one({"file_hash": file_hash, "user_id": user_id, **COMPLETE_INGESTION}, WITHOUT_TEXT)
+            elif guest_token and file_hash:
+                guest_entry = guest_cache.get(guest_token, file_hash)
+
+            if existing_doc or guest_entry:
+                discard_upload(file)
+            else:
+                stored_filename, file_size, file_hash = current_app.blob_store.put_upload(
+                    file, file_ext, MAX_IMAGE_SIZE if is_image else MAX_FILE_SIZE
+                )
+                g.blob_name = stored_filename
+                filepath = current_app.blob_store.path_for(stored_filename)
+                logger.info(f"File saved at {filepath} at {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}")
+                if user_id and upload_hash(file) is None:
+                    existing_doc = documents_collection.find_one({"file_hash": file_hash, "user_id": user_id, **COMPLETE_INGESTION}, WITHOUT_TEXT)
+                    if existing_doc:
+                        current_app.blob_store.release(stored_filename)
+                        g.blob_name = None
             
-            # Check if document is already processed
-            if user_id:
-                existing_doc = documents_collection.find_one({"file_hash": file_hash, "user_id": user_id})
-                if existing_doc:
-                    logger.info(f"Found existing document with hash {file_hash}, using existing data")
-                    document_id = str(existing_doc["_id"])
-                    g.document_id = document_id
-                    metadata = existing_doc.get("metadata", {})
-                    stored_filename = existing_doc["stored_name"]
-                    filepath = os.path.join(current_app.config["UPLOAD_FOLDER"], stored_filename)
-                    is_image = metadata.get("is_image", False)
-                    if is_image:
-                        image_summary = metadata.get("summary", "No summary available")
-                        if "summar" in query_text.lower():
-                            response = image_summary
-                        else:
-                            response = process_document_query(
-                                filepath,
-                                query_text,
-                                chat_history,
-                                image_context=image_summary,
-                                user_id=user_id
-                            )
-                    else:
-                        documents = [
-                            type("Document", (), {
-                                "page_content": chunk["content"],
-                                "metadata": chunk["metadata"]
-                            })() for chunk in existing_doc.get("chunks", [])
-                        ]
-
-            if not existing_doc:
+            if not existing_doc and not guest_entry:
                 check_aborted()
                 if is_image:
                     file_stream = open(filepath, 'rb')
                     try:
-                        response = summarize_image(file_stream, query_text or "Summarize the content of this image")
+                        response = summarize_image(file_stream, query_text or "Summarize the content of this image", file_hash)
                         metadata = {
                             "is_image": True,
                             "summary": response
@@ -329,7 +503,7 @@ def process_document():
                                 "stored_name": stored_filename,
                                 "upload_date": datetime.utcnow(),
                                 "file_type": file_ext,
-                                "size": os.path.getsize(filepath),
+                                "size": file_size,
                                 "file_hash": file_hash,
                                 "metadata": metadata,
                                 "version": 1
@@ -337,22 +511,15 @@ def process_document():
                             result = documents_collection.insert_one(doc_data)
                             document_id = str(result.inserted_id)
                             g.document_id = document_id
+                        else:
+                            guest_cache.put(guest_token, file_hash, [], metadata, None)
                     finally:
                         file_stream.close()
                 else:
-                    file_stream = open(filepath, 'rb')
-                    if file_ext == 'pdf':
-                        extracted_text = extract_text_from_pdf(file_stream)
-                    else:
-                        extracted_text = extract_text_from_docx(file_stream)
-                    file_stream.close()
-                    
-                    check_aborted()
-                    
-                    documents, metadata, _ = load_document(filepath, user_id)
-                    if not documents and not metadata.get("extracted_text"):
+                    documents, metadata, _ = load_document(filepath, user_id, file_hash=file_hash, guest_token=guest_token)
+                    if not documents and not metadata.get("text_chars"):
                         raise FileProcessingError("Failed to process document content")
-                        
+
                     if user_id:
                         doc_data = {
                             "user_id": user_id,
@@ -360,9 +527,8 @@ def process_document():
                             "stored_name": stored_filename,
                             "upload_date": datetime.utcnow(),
                             "file_type": file_ext,
-                            "size": os.path.getsize(filepath),
+                            "size": file_size,
                             "file_hash": file_hash,
-                            "extracted_text": extracted_text,
                             "metadata": metadata,
                             "version": 1,
                             "chunks": [{
@@ -375,22 +541,43 @@ def process_document():
                         document_id = str(result.inserted_id)
                         g.document_id = document_id
         
+        elif attach_document_id and user_id:
+            # Client already knows the server has this file (see /document/check)
+            if not ObjectId.is_valid(attach_document_id):
+                return jsonify({"error": "Invalid document ID"}), 400
+            existing_doc = documents_collection.find_one({"_id": ObjectId(attach_document_id), "user_id": user_id}, WITHOUT_TEXT)
+            if not existing_doc:
+                return jsonify({"error": "Document not found or not authorized"}), 404
+            file_hash = existing_doc.get("file_hash")
+            logger.info(f"Attaching existing document {attach_document_id} without upload")
+
         elif chat_id and user_id:
             if ObjectId.is_valid(chat_id):
-                chat_session = chat_sessions_collection.find_one({
-                    "_id": ObjectId(chat_id),
-                    "user_id": user_id
-                })
+                chat_session = stages.result("chat_session")
                 if chat_session:
                     chat_history = chat_session.get("history", [])
                     document_id = chat_session.get("document_id")
+
+                    def load_memory(session):
+                        return _session_memory(chat_id, user_id, session, chat_history)
+
+                    def load_document_record(session):
+                        if not document_id:
+                            return None
+                        return documents_collection.find_one({"_id": ObjectId(document_id)}, WITHOUT_TEXT)
+
+                    # Memory rebuild (embeds past turns) overlaps the document read
+                    stages.add("memory", load_memory, after=("chat_session",))
+                    stages.add("document", load_document_record, after=("chat_session",))
+                    memory = stages.result("memory")
                     if document_id:
-                        doc = documents_collection.find_one({"_id": ObjectId(document_id)})
+                        doc = stages.result("document")
                         if doc:
                             metadata = doc.get("metadata", {})
                             is_image = metadata.get("is_image", False)
                             stored_filename = doc["stored_name"]
-                            filepath = os.path.join(current_app.config["UPLOAD_FOLDER"], stored_filename)
+                            file_hash = doc.get("file_hash")
+                            filepath = current_app.blob_store.path_for(stored_filename)
                             if is_image:
                                 image_summary = metadata.get("summary", "No summary available")
                                 if "summar" in query_text.lower():
@@ -401,7 +588,10 @@ def process_document():
                                         query_text,
                                         chat_history,
                                         image_context=image_summary,
-                                        user_id=user_id
+                                        user_id=user_id,
+                                        file_hash=file_hash,
+                                        metadata=metadata,
+                                        memory=memory
                                     )
                             else:
                                 documents = [
@@ -418,6 +608,62 @@ def process_document():
                 logger.warning(f"Invalid chat_id provided: {chat_id}, treating as new chat")
                 chat_id = None
 
+        elif guest_token and guest_file_hash:
+            # Guest follow-up question about a document processed earlier in the session
+            guest_entry = guest_cache.get(guest_token, guest_file_hash)
+            if not guest_entry:
+                return jsonify({"error": "Guest document expired, please upload it again", "guest_token": guest_token}), 410
+            file_hash = guest_file_hash
+
+        # Guest documents come from the cache; the file itself may already be gone
+        if guest_entry:
+            logger.info(f"Using cached guest document {file_hash}")
+            metadata = guest_entry["metadata"]
+            if metadata.get("is_image"):
+                image_summary = metadata.get("summary", "No summary available")
+                if "summar" in query_text.lower():
+                    response = image_summary
+                else:
+                    response = process_document_query(
+                        None,
+                        query_text,
+                        chat_history,
+                        image_context=image_summary,
+                        metadata=metadata
+                    )
+
+        # Reuse an already processed document (dedupe hit or attach by id)
+        if existing_doc and user_id:
+            logger.info(f"Found existing document with hash {file_hash}, using existing data")
+            document_id = str(existing_doc["_id"])
+            g.document_id = document_id
+            metadata = existing_doc.get("metadata", {})
+            stored_filename = existing_doc["stored_name"]
+            filepath = current_app.blob_store.path_for(stored_filename)
+            is_image = metadata.get("is_image", False)
+            if is_image:
+                image_summary = metadata.get("summary", "No summary available")
+                if "summar" in query_text.lower():
+                    response = image_summary
+                else:
+                    response = process_document_query(
+                        filepath,
+                        query_text,
+                        chat_history,
+                        image_context=image_summary,
+                        user_id=user_id,
+                        file_hash=file_hash,
+                        metadata=metadata,
+                        memory=memory
+                    )
+            else:
+                documents = [
+                    type("Document", (), {
+                        "page_content": chunk["content"],
+                        "metadata": chunk["metadata"]
+                    })() for chunk in existing_doc.get("chunks", [])
+                ]
+
         timing_logs["file_processing"] = time.time() - step_start
         step_start = time.time()
 
@@ -429,7 +675,11 @@ def process_document():
                 query_text,
                 chat_history,
                 image_context=None,
-                user_id=user_id
+                user_id=user_id,
+                file_hash=file_hash,
+                metadata=metadata,
+                memory=memory,
+                guest_token=guest_token
             )
 
         timing_logs["query_processing"] = time.time() - step_start
@@ -438,43 +688,19 @@ def process_document():
         check_aborted()
 
         if user_id:
-            # Ensure chat session exists or create a new one
-            if not chat_id or not ObjectId.is_valid(chat_id):
-                logger.info(f"Creating new chat session for user_id: {user_id}")
-                new_chat = {
-                    "user_id": user_id,
-                    "name": chat_name,
-                    "created_at": datetime.utcnow(),
-                    "last_updated": datetime.utcnow(),
-                    "pinned": False,
-                    "history": [],
-                    "document_id": document_id,
-                    "version": 1
-                }
-                result = chat_sessions_collection.insert_one(new_chat)
-                chat_id = str(result.inserted_id)
-                logger.info(f"Created new chat session with chat_id: {chat_id}")
-            else:
-                # Verify chat session exists
-                chat_session = chat_sessions_collection.find_one({
-                    "_id": ObjectId(chat_id),
-                    "user_id": user_id
-                })
+            # A chat_id that was not loaded above (file uploads) still has to belong to the user
+            if chat_id and ObjectId.is_valid(chat_id) and chat_session is None:
+                chat_session = stages.result("chat_session")
                 if not chat_session:
                     logger.warning(f"Chat session not found for chat_id: {chat_id}, creating new one")
-                    new_chat = {
-                        "user_id": user_id,
-                        "name": chat_name,
-                        "created_at": datetime.utcnow(),
-                        "last_updated": datetime.utcnow(),
-                        "pinned": False,
-                        "history": [],
-                        "document_id": document_id,
-                        "version": 1
-                    }
-                    result = chat_sessions_collection.insert_one(new_chat)
-                    chat_id = str(result.inserted_id)
-                    logger.info(f"Created new chat session with chat_id: {chat_id}")
+                    chat_id = None
+                else:
+                    memory = _session_memory(chat_id, user_id, chat_session)
+            new_chat = not chat_id or not ObjectId.is_valid(chat_id)
+            if new_chat:
+                # The id is assigned here; the turn's upsert creates the session
+                chat_id = str(ObjectId())
+                logger.info(f"Creating new chat session {chat_id} for user_id: {user_id}")
 
             # Prepare history entry
             history_entry = [
@@ -482,9 +708,9 @@ def process_document():
                     "type": "user",
                     "content": query_text,
                     "file": {
-                        "name": file.filename if file else None,
+                        "name": file.filename if file else existing_doc.get("original_name"),
                         "stored_name": stored_filename
-                    } if file else None,
+                    } if file or attach_document_id else None,
                     "timestamp": datetime.utcnow().isoformat(),
                     "request_id": request_id
                 },
@@ -495,67 +721,78 @@ def process_document():
                 }
             ]
             logger.info(f"Prepared history entry for chat_id: {chat_id}: {history_entry}")
+            memory = conversation_memory.update(memory, query_text, response)
 
-            # Update chat session with history
-            try:
-                update_result = chat_sessions_collection.update_one(
-                    {"_id": ObjectId(chat_id), "user_id": user_id},
-                    {
-                        "$push": {"history": {"$each": history_entry}},
-                        "$set": {
-                            "name": chat_name,
-                            "last_updated": datetime.utcnow(),
-                            "document_id": document_id
-                        },
-                        "$inc": {"version": 1}
+            # Chat turn and query record are written behind the response
+            now = datetime.utcnow()
+            turn_writer.submit("chat_sessions", UpdateOne(
+                {"_id": ObjectId(chat_id), "user_id": user_id},
+                {
+                    "$push": {"history": {"$each": history_entry}},
+                    "$set": {
+                        "name": chat_name,
+                        "last_updated": now,
+                        "document_id": document_id,
+                        "memory": memory
                     },
-                    upsert=True
-                )
-
-                if update_result.modified_count > 0 or update_result.upserted_id:
-                    logger.info(f"Chat history updated successfully for chat_id: {chat_id}")
-                    # Verify the update by fetching the chat session
-                    updated_chat = chat_sessions_collection.find_one({"_id": ObjectId(chat_id)})
-                    if updated_chat and len(updated_chat.get("history", [])) >= len(history_entry):
-                        logger.info(f"Verified: Chat history contains {len(updated_chat['history'])} entries")
-                    else:
-                        logger.error(f"Verification failed: Chat history not updated correctly for chat_id: {chat_id}")
-                else:
-                    logger.error(f"Failed to update chat history for chat_id: {chat_id}")
-                    return jsonify({"error": "Failed to update chat history"}), 500
-            except Exception as e:
-                logger.error(f"Error updating chat history: {str(e)}")
-                return jsonify({"error": f"Failed to update chat history: {str(e)}"}), 500
-
-            # Update query collection
-            query_data = {
+                    "$setOnInsert": {"created_at": now, "pinned": False},
+                    "$inc": {"version": 1}
+                },
+                upsert=True
+            ), key=user_id)
+            turn_writer.submit("queries", InsertOne({
                 "user_id": user_id,
                 "chat_session_id": chat_id,
                 "query_text": query_text,
                 "response": response,
                 "document_id": document_id,
-                "timestamp": datetime.utcnow(),
+                "timestamp": now,
                 "version": 1
-            }
-            queries_collection.insert_one(query_data)
-            logger.info(f"Query recorded for chat_id: {chat_id}")
+            }), key=user_id)
+            if new_chat:
+                # The client may use the new chat_id against another worker, whose buffer does not hold the upsert
+                turn_writer.flush(user_id)
+            # The new turn's embedding is computed by the writer, off the response path
+            turn_writer.submit(
+                "chat_sessions",
+                conversation_memory.embed_operation({"_id": ObjectId(chat_id), "user_id": user_id}, memory),
+                key=user_id
+            )
+            logger.info(f"Queued chat turn and query record for chat_id: {chat_id}")
 
         timing_logs["db_update"] = time.time() - step_start
+        stages.report(timing_logs)
         logger.info(f"Document processing completed in {time.time() - start_time:.2f} seconds. Timing: {timing_logs}")
 
         # Clean up cancelled_requests entry
         if request_id in current_app.cancelled_requests:
             del current_app.cancelled_requests[request_id]
 
-        return jsonify({
+        result = {
             "response": response,
             "chat_id": chat_id,
-            "document_id": document_id
-        })
+            "document_id": document_id,
+            **_truncation_notice(metadata)
+        }
+        if guest_token:
+            # Guests send these back to ask follow-up questions without re-uploading
+            result["guest_token"] = guest_token
+            result["file_hash"] = file_hash
+        return jsonify(result)
 
     except RequestTimeout:
         logger.warning(f"Request timeout after {time.time() - start_time:.2f} seconds")
         return jsonify({"error": "Request timed out"}), 408
+    except RequestEntityTooLarge as e:
+        logger.warning(f"Upload rejected: {e.description}")
+        return jsonify({"error": e.description}), 413
+    except AdmissionError as e:
+        return _busy_response(e)
+    except PersistenceError as e:
+        return _persistence_response(e)
+    except MemoryBudgetError as e:
+        logger.warning(f"Document rejected by memory budget: {str(e)}")
+        return jsonify({"error": str(e)}), 413
     except FileProcessingError as e:
         logger.error(f"File processing error: {str(e)}")
         return jsonify({"error": str(e)}), 400
@@ -564,4 +801,182 @@ def process_document():
         return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Unexpected error during document processing: {str(e)}", exc_info=True)
-        return jsonify({"error": f"Failed to process document: {str(e)}"}), 500
\ No newline at end of file
+        return jsonify({"error": f"Failed to process document: {str(e)}"}), 500
+
+@document_bp.route('/batch-query', methods=['POST'])
+@jwt_required()
+def batch_query():
+    # Runs a question set over one stored document; results stream as NDJSON when requested
+    start_time = time.time()
+    try:
+        data = request.get_json() or {}
+        document_id = data.get('document_id')
+        questions = data.get('questions')
+        stream = bool(data.get('stream', False))
+
+        if not document_id or not ObjectId.is_valid(document_id):
+            return jsonify({"error": "A valid document_id is required"}), 400
+        if not isinstance(questions, list) or not questions:
+            return jsonify({"error": "questions must be a non-empty list"}), 400
+        questions = [q.strip() for q in questions if isinstance(q, str) and q.strip()]
+        if not questions:
+            return jsonify({"error": "questions must contain non-empty strings"}), 400
+        if len(questions) > BATCH_MAX_QUESTIONS:
+            return jsonify({"error": f"At most {BATCH_MAX_QUESTIONS} questions per batch"}), 400
+
+        user_id = get_jwt_identity()
+        doc = documents_collection.find_one(
+            {"_id": ObjectId(document_id), "user_id": user_id},
+            {"chunks": 0, **WITHOUT_TEXT}
+        )
+        if not doc:
+            return jsonify({"error": "Document not found or not authorized"}), 404
+
+        filepath = current_app.blob_store.path_for(doc["stored_name"])
+        results = process_document_queries(
+            filepath,
+            questions,
+            user_id=user_id,
+            file_hash=doc.get("file_hash"),
+            metadata=doc.get("metadata", {})
+        )
+
+        def record(answered):
+            for result in answered:
+                if "response" in result:
+                    turn_writer.submit("queries", InsertOne({
+                        "user_id": user_id,
+                        "chat_session_id": None,
+                        "query_text": result["query"],
+                        "response": result["response"],
+                        "document_id": document_id,
+                        "batch": True,
+                        "timestamp": datetime.utcnow(),
+                        "version": 1
+                    }), key=user_id)
+            logger.info(f"Batch of {len(questions)} questions for document {document_id} completed in {time.time() - start_time:.2f} seconds")
+
+        if stream:
+            def generate():
+                answered = []
+                for result in results:
+                    answered.append(result)
+                    yield json.dumps(result) + "\n"
+                if answered:
+                    record(answered)
+
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+        answered = sorted(results, key=lambda result: result["index"])
+        record(answered)
+        return jsonify({"document_id": document_id, "results": answered}), 200
+
+    except AdmissionError as e:
+        return _busy_response(e)
+    except MemoryBudgetError as e:
+        logger.warning(f"Document rejected by memory budget: {str(e)}")
+        return jsonify({"error": str(e)}), 413
+    except FileProcessingError as e:
+        logger.error(f"File processing error: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error processing batch query: {str(e)}", exc_info=True)
+        return jsonify({"error": f"Failed to process batch query: {str(e)}"}), 500
+
+@document_bp.route('/compare', methods=['POST'])
+@jwt_required()
+def compare():
+    # One question answered across several of the user's documents
+    start_time = time.time()
+    try:
+        data = request.get_json() or {}
+        query_text = (data.get('query') or '').strip()
+        document_ids = data.get('document_ids')
+        chat_id = data.get('chat_id')
+
+        if not query_text:
+            return jsonify({"error": "Query is required"}), 400
+        if not isinstance(document_ids, list) or any(not isinstance(d, str) or not ObjectId.is_valid(d) for d in document_ids):
+            return jsonify({"error": "document_ids must be a list of valid document ids"}), 400
+        document_ids = list(dict.fromkeys(document_ids))
+        if not 2 <= len(document_ids) <= COMPARE_MAX_DOCUMENTS:
+            return jsonify({"error": f"Compare between 2 and {COMPARE_MAX_DOCUMENTS} documents"}), 400
+
+        user_id = get_jwt_identity()
+        docs = {
+            str(doc["_id"]): doc for doc in documents_collection.find(
+                {"_id": {"$in": [ObjectId(d) for d in document_ids]}, "user_id": user_id},
+                {"chunks": 0, **WITHOUT_TEXT}
+            )
+        }
+        missing = [d for d in document_ids if d not in docs]
+        if missing:
+            return jsonify({"error": f"Documents not found or not authorized: {', '.join(missing)}"}), 404
+
+        sources = [{
+            "name": docs[d].get("original_name") or docs[d]["stored_name"],
+            "file_path": current_app.blob_store.path_for(docs[d]["stored_name"]),
+            "file_hash": docs[d].get("file_hash"),
+            "metadata": docs[d].get("metadata", {})
+        } for d in document_ids]
+        response = compare_documents(query_text, sources, user_id=user_id)
+
+        # Optionally continue an existing chat with the comparison
+        if chat_id and ObjectId.is_valid(chat_id):
+            turn_writer.flush(user_id)
+            chat_session = chat_sessions_collection.find_one(
+                {"_id": ObjectId(chat_id), "user_id": user_id},
+                {"memory": 1}
+            )
+            if chat_session:
+                now = datetime.utcnow()
+                history_entry = [
+                    {
+                        "type": "user",
+                        "content": query_text,
+                        "documents": [{"document_id": d, "name": source["name"]} for d, source in zip(document_ids, sources)],
+                        "timestamp": now.isoformat()
+                    },
+                    {"type": "response", "content": response, "timestamp": now.isoformat()}
+                ]
+                memory = conversation_memory.update(_session_memory(chat_id, user_id, chat_session), query_text, response)
+                session_filter = {"_id": ObjectId(chat_id), "user_id": user_id}
+                turn_writer.submit("chat_sessions", UpdateOne(
+                    session_filter,
+                    {
+                        "$push": {"history": {"$each": history_entry}},
+                        "$set": {"last_updated": now, "memory": memory},
+                        "$inc": {"version": 1}
+                    }
+                ), key=user_id)
+                turn_writer.submit("chat_sessions", conversation_memory.embed_operation(session_filter, memory), key=user_id)
+            else:
+                chat_id = None
+        else:
+            chat_id = None
+
+        turn_writer.submit("queries", InsertOne({
+            "user_id": user_id,
+            "chat_session_id": chat_id,
+            "query_text": query_text,
+            "response": response,
+            "document_ids": document_ids,
+            "timestamp": datetime.utcnow(),
+            "version": 1
+        }), key=user_id)
+        logger.info(f"Compared {len(document_ids)} documents in {time.time() - start_time:.2f} seconds")
+        return jsonify({"response": response, "document_ids": document_ids, "chat_id": chat_id}), 200
+
+    except AdmissionError as e:
+        return _busy_response(e)
+    except PersistenceError as e:
+        return _persistence_response(e)
+    except MemoryBudgetError as e:
+        logger.warning(f"Document rejected by memory budget: {str(e)}")
+        return jsonify({"error": str(e)}), 413
+    except FileProcessingError as e:
+        logger.error(f"File processing error: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error comparing documents: {str(e)}", exc_info=True)
+        return jsonify({"error": f"Failed to compare documents: {str(e)}"}), 500
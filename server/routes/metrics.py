@@ -0,0 +1,76 @@
+from flask import Blueprint, request, jsonify
+from utils.admission import admission_stats
+from utils.scheduler import embedding_scheduler
+from utils.pdf_extraction import extraction_scheduler
+from utils.nlp_utils import query_router, embedding_service, llm_flight, model_router
+from utils.persistence import turn_writer
+from utils.preview_cache import preview_cache
+from utils.guest_cache import guest_cache
+from utils.profiling import profiler, PROFILING_TOKEN
+from utils.memory_budget import memory_stats
+from utils.text_store import text_store
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # When set, required in the X-Metrics-Token header; when unset, only localhost is served
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+metrics_bp = Blueprint('metrics', __name__)
+
+def _is_local_request():
+    return request.remote_addr in LOCAL_ADDRESSES
+
+@metrics_bp.route('', methods=['GET'])
+def get_metrics():
+    try:
+        if METRICS_TOKEN:
+            if request.headers.get('X-Metrics-Token') != METRICS_TOKEN:
+                return jsonify({"error": "Unauthorized"}), 401
+        elif not _is_local_request():
+            return jsonify({"error": "Metrics are only available locally unless METRICS_TOKEN is set"}), 403
+
+        return jsonify({
+            "scheduler": {
+                "embedding": embedding_scheduler.stats(),
+                "extraction": extraction_scheduler.stats()
+            },
+            "admission": admission_stats(),
+            "query_router": query_router.stats(),
+            "model_router": model_router.stats(),
+            "persistence": turn_writer.stats(),
+            "previews": preview_cache.stats(),
+            "embedding_service": embedding_service.stats(),
+            "llm_singleflight": llm_flight.stats(),
+            "guest_cache": guest_cache.stats(),
+            "ingest_memory": memory_stats.stats(),
+            "text_store": text_store.stats(),
+            "profiling": profiler.stats()
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error collecting metrics: {str(e)}", exc_info=True)
+        return jsonify({"error": "Failed to collect metrics"}), 500
+
+@metrics_bp.route('/profiling', methods=['PUT'])
+def configure_profiling():
+    # Runtime toggle; needs a metrics or profiling token, or a local caller when neither is configured
+    try:
+        authorized = (
+            (METRICS_TOKEN and request.headers.get('X-Metrics-Token') == METRICS_TOKEN)
+            or (PROFILING_TOKEN and request.headers.get('X-Profile-Token') == PROFILING_TOKEN)
+            or (not (METRICS_TOKEN or PROFILING_TOKEN) and _is_local_request())
+        )
+        if not authorized:
+            return jsonify({"error": "Unauthorized"}), 401 if (METRICS_TOKEN or PROFILING_TOKEN) else 403
+
+        data = request.get_json() or {}
+        profiler.configure(data.get('sample_rate'), data.get('mode'))
+        return jsonify(profiler.stats()), 200
+
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error configuring profiling: {str(e)}", exc_info=True)
+        return jsonify({"error": "Failed to configure profiling"}), 500
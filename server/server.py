@@ -1,9 +1,19 @@
-from flask import Flask
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager
+from flask_jwt_extended import JWTManager, verify_jwt_in_request, get_jwt_identity
 from routes.auth import auth_bp
 from routes.document import document_bp
 from routes.chat import chat_bp
+from routes.metrics import metrics_bp
+from utils.file_utils import MAX_FILE_SIZE
+from utils.upload_stream import UploadRequest
+from utils.blob_store import BlobStore
+from utils.db import blobs_collection
+from utils.admission import current_user, AdmissionError
+from utils.http_cache import compress_response
+from utils.preview_cache import preview_cache
+from utils.text_store import text_store
+from utils.profiling import profiler
 import os
 import logging
 from logging.handlers import RotatingFileHandler
@@ -11,11 +21,15 @@ from logging.handlers import RotatingFileHandler
 def create_app():
     app = Flask(__name__)
     
+    # Uploads are hashed and size-checked while the body streams in
+    app.request_class = UploadRequest
+    app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE + 1024 * 1024  # File plus form fields
+    
     # Initialize cancelled_requests dictionary
     app.cancelled_requests = {}
     
     # Configure CORS
-    CORS(app, resources={r"/*": {"origins": "*"}})
+    CORS(app, resources={r"/*": {"origins": "*"}}, expose_headers=["ETag"])
     
     # Configure JWT
     app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'your-secret-key')
@@ -24,6 +38,9 @@ def create_app():
     # Configure upload folder
     app.config['UPLOAD_FOLDER'] = os.getenv('UPLOAD_FOLDER', os.path.join(os.getcwd(), 'uploads'))
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    app.blob_store = BlobStore(app.config['UPLOAD_FOLDER'], blobs_collection)
+    app.blob_store.removal_hooks.append(preview_cache.remove)
+    app.blob_store.removal_hooks.append(lambda name: text_store.remove(BlobStore.hash_of(name)))
     
     # Configure logging
     log_dir = os.path.join(os.getcwd(), 'logs')
@@ -41,10 +58,67 @@ def create_app():
     app.logger.addHandler(handler)
     app.logger.setLevel(logging.INFO)
     
+    # Admission control queues work per user; guests share a queue per client address
+    @app.before_request
+    def identify_user():
+        user_id = None
+        try:
+            verify_jwt_in_request(optional=True)
+            user_id = get_jwt_identity()
+        except Exception:
+            pass
+        current_user.set(user_id or f"guest:{request.remote_addr}")
+    
+    # Opt-in profiling: X-Profile-Token header, or a sampled fraction of requests
+    @app.before_request
+    def start_profile():
+        g.profile = profiler.begin(request.headers)
+    
+    def profile_details(status):
+        payload = request.get_json(silent=True) if request.is_json else None
+        request_id = (
+            request.headers.get('X-Request-ID')
+            or request.form.get('request_id')
+            or (payload or {}).get('request_id')
+        )
+        return request_id, {"method": request.method, "path": request.path, "endpoint": request.endpoint, "status": status}
+    
+    @app.after_request
+    def write_profile(response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+        request_id, details = profile_details(response.status_code)
+        if response.is_streamed:
+            # Streamed bodies are produced after this hook; profile until the stream closes
+            response.call_on_close(lambda: profiler.end(profile, request_id, details))
+            return response
+        path = profiler.end(profile, request_id, details)
+        if path:
+            response.headers['X-Profile'] = os.path.basename(path)
+        return response
+    
+    @app.teardown_request
+    def abandon_profile(error):
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profiler.end(profile, *profile_details(f"error: {type(error).__name__}" if error else "error"))
+    
+    @app.errorhandler(AdmissionError)
+    def handle_admission_error(e):
+        response = jsonify({"error": str(e), "retry_after": e.retry_after})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    
+    # Large JSON bodies (chat histories, DOCX previews) are compressed for clients that accept it
+    app.after_request(compress_response)
+    
     # Register blueprints
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(document_bp, url_prefix='/document')
     app.register_blueprint(chat_bp, url_prefix='/chat')
+    app.register_blueprint(metrics_bp, url_prefix='/metrics')
     
     @app.route('/')
     def index():
@@ -0,0 +1,99 @@
+"""Shared test setup: in-memory Mongo and a deterministic embedding model.
+
+Needs pytest and mongomock on top of the server's dependencies; the PDF tests
+also use PyMuPDF to generate fixtures and are skipped without it.
+
+The app modules read their configuration at import time, so the environment is
+set here, before any test module imports them.
+"""
+import hashlib
+import os
+import re
+import sys
+import tempfile
+
+import numpy as np
+import pytest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+TEST_ROOT = tempfile.mkdtemp(prefix="insightpaper-tests-")
+os.environ.setdefault("MONGO_URI", "mongomock://localhost")
+os.environ.setdefault("UPLOAD_FOLDER", os.path.join(TEST_ROOT, "uploads"))
+os.environ.setdefault("PREVIEW_DIR", os.path.join(TEST_ROOT, "previews"))
+os.environ.setdefault("JWT_SECRET_KEY", "insightpaper-test-secret-key-0123456789")
+
+import langchain_community.embeddings as community_embeddings
+from langchain_core.embeddings import Embeddings
+
+class HashEmbeddings(Embeddings):
+    """Bag-of-words hashing embeddings, so tests never download a model"""
+
+    dimensions = 64
+
+    def __init__(self, model_name=None, **kwargs):
+        self.model_name = model_name
+
+    def _vector(self, text):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            vector[int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % self.dimensions] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._vector(text)
+
+community_embeddings.HuggingFaceEmbeddings = HashEmbeddings
+
+@pytest.fixture
+def nlp_utils():
+    from utils import nlp_utils
+    return nlp_utils
+
+class _OneByOne:
+    """Applies bulk_write operations one at a time; mongomock's bulk_write does not accept current pymongo operations"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def bulk_write(self, operations, ordered=True):
+        from pymongo import InsertOne
+        for operation in operations:
+            if isinstance(operation, InsertOne):
+                self.collection.insert_one(operation._doc)
+            else:
+                self.collection.update_one(operation._filter, operation._doc, upsert=operation._upsert)
+
+@pytest.fixture
+def turn_writer(monkeypatch):
+    from utils.persistence import turn_writer
+    monkeypatch.setattr(turn_writer, "collections", {
+        name: _OneByOne(collection) for name, collection in turn_writer.collections.items()
+    })
+    yield turn_writer
+    turn_writer.flush()
+
+@pytest.fixture
+def app(turn_writer):
+    from server import create_app
+    app = create_app()
+    app.config["TESTING"] = True
+    return app
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def auth_headers(app):
+    from flask_jwt_extended import create_access_token
+
+    def headers_for(user_id):
+        with app.app_context():
+            return {"Authorization": f"Bearer {create_access_token(identity=user_id)}"}
+    return headers_for
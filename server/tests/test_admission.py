@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+from utils.admission import FairQueue, AdmissionError
+
+def _hold(queue, user, seconds, cost=1.0, started=None):
+    def run():
+        with queue.slot(cost=cost, user=user):
+            if started is not None:
+                started.set()
+            time.sleep(seconds)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+def test_per_user_limit_queues_the_second_request():
+    queue = FairQueue("test", capacity=4, per_user=1)
+    started = threading.Event()
+    holder = _hold(queue, "alice", 0.2, started=started)
+    started.wait(1)
+    waited = queue.acquire("alice")
+    queue.release("alice", 0.0)
+    holder.join()
+    assert waited >= 0.1
+    assert queue.stats()["queued"] == 1
+
+def test_wait_scales_with_the_work_ahead():
+    # The first upload holds the user's only slot longer than max_wait; the second must queue, not fail
+    queue = FairQueue("test", capacity=2, per_user=1, max_wait=0.2)
+    started = threading.Event()
+    holder = _hold(queue, "alice", 0.6, cost=2, started=started)
+    started.wait(1)
+    waited = queue.acquire("alice", cost=2)
+    queue.release("alice", 0.0, 2)
+    holder.join()
+    assert waited >= 0.4
+    assert queue.stats()["timed_out"] == 0
+
+def test_wait_is_capped():
+    queue = FairQueue("test", capacity=1, per_user=1, max_wait=0.05, max_wait_cap=0.3)
+    started = threading.Event()
+    holder = _hold(queue, "alice", 1.0, cost=50, started=started)
+    started.wait(1)
+    start = time.time()
+    with pytest.raises(AdmissionError):
+        queue.acquire("bob")
+    assert time.time() - start < 0.8
+    holder.join()
+    assert queue.stats()["timed_out"] == 1
+
+def test_full_queue_rejects_immediately():
+    queue = FairQueue("test", capacity=1, per_user=1, max_queue_per_user=1)
+    started = threading.Event()
+    holder = _hold(queue, "alice", 0.3, started=started)
+    started.wait(1)
+    waiter = _hold(queue, "alice", 0)
+    time.sleep(0.05)
+    start = time.time()
+    with pytest.raises(AdmissionError) as error:
+        queue.acquire("alice")
+    assert time.time() - start < 0.1
+    assert error.value.retry_after >= 1
+    holder.join()
+    waiter.join()
+
+def test_users_are_served_round_robin():
+    queue = FairQueue("test", capacity=1, per_user=1)
+    order = []
+    lock = threading.Lock()
+    started = threading.Event()
+    holder = _hold(queue, "blocker", 0.2, started=started)
+    started.wait(1)
+
+    def request(user):
+        with queue.slot(user=user):
+            with lock:
+                order.append(user)
+
+    threads = []
+    for user in ["alice", "alice", "alice", "bob"]:
+        thread = threading.Thread(target=request, args=(user,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.02)
+    holder.join()
+    for thread in threads:
+        thread.join()
+    # Bob arrived last but does not wait behind all of Alice's requests
+    assert order.index("bob") <= 1
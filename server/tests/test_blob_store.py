@@ -0,0 +1,104 @@
+import hashlib
+import io
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import mongomock
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from utils import blob_store as blob_store_module
+from utils.blob_store import BlobStore
+from utils.upload_stream import UPLOAD_TEMP_PREFIX
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(str(tmp_path), mongomock.MongoClient().db.blobs)
+
+def _upload(data: bytes):
+    return FileStorage(stream=io.BytesIO(data), filename="paper.pdf")
+
+def _expire(store, name):
+    store.collection.update_one({"_id": name}, {"$set": {"last_released": datetime.utcnow() - timedelta(days=1)}})
+
+def test_identical_uploads_share_one_file(store):
+    first, _, file_hash = store.put_upload(_upload(b"same bytes"), "pdf")
+    second, _, _ = store.put_upload(_upload(b"same bytes"), "pdf")
+    assert first == second == f"{hashlib.sha256(b'same bytes').hexdigest()}.pdf"
+    assert store.collection.find_one({"_id": first})["refs"] == 2
+    assert open(store.path_for(first), "rb").read() == b"same bytes"
+
+def test_garbage_collection_removes_only_expired_unreferenced_blobs(store):
+    kept, _, _ = store.put_upload(_upload(b"kept"), "pdf")
+    released, _, _ = store.put_upload(_upload(b"released"), "pdf")
+    recent, _, _ = store.put_upload(_upload(b"recent"), "pdf")
+    removed_names = []
+    store.removal_hooks.append(removed_names.append)
+    store.release(released)
+    store.release(recent)
+    _expire(store, released)
+
+    assert store.collect_garbage() == 1
+    assert removed_names == [released]
+    assert not store.exists(released) and store.collection.find_one({"_id": released}) is None
+    assert store.exists(kept) and store.exists(recent)
+
+def test_upload_during_collection_waits_and_keeps_its_file(store, monkeypatch):
+    name, _, _ = store.put_upload(_upload(b"contended"), "pdf")
+    store.release(name)
+    _expire(store, name)
+    path = store.path_for(name)
+
+    in_unlink = threading.Event()
+    resume = threading.Event()
+    real_remove = os.remove
+
+    def slow_remove(target):
+        if target == path:
+            in_unlink.set()
+            resume.wait(5)
+        real_remove(target)
+
+    monkeypatch.setattr(blob_store_module.os, "remove", slow_remove)
+    collector = threading.Thread(target=store.collect_garbage)
+    collector.start()
+    assert in_unlink.wait(5)
+
+    # The blob is claimed: the upload must wait instead of reusing the file being unlinked
+    uploaded = {}
+    uploader = threading.Thread(target=lambda: uploaded.update(name=store.put_upload(_upload(b"contended"), "pdf")[0]))
+    uploader.start()
+    time.sleep(0.2)
+    assert "name" not in uploaded
+
+    resume.set()
+    collector.join(5)
+    uploader.join(5)
+    assert uploaded["name"] == name
+    assert open(path, "rb").read() == b"contended"
+    assert store.collection.find_one({"_id": name})["refs"] == 1
+
+def test_abandoned_claim_does_not_block_uploads(store, monkeypatch):
+    name, _, _ = store.put_upload(_upload(b"abandoned"), "pdf")
+    store.release(name)
+    stale = datetime.utcnow() - timedelta(seconds=blob_store_module.BLOB_GC_LEASE_SECONDS + 5)
+    store.collection.update_one({"_id": name}, {"$set": {"collecting": stale}})
+
+    assert store.put_upload(_upload(b"abandoned"), "pdf")[0] == name
+    record = store.collection.find_one({"_id": name})
+    assert record["refs"] == 1 and "collecting" not in record
+
+def test_old_upload_temp_files_are_swept(store, monkeypatch):
+    old = os.path.join(store.root, f"{UPLOAD_TEMP_PREFIX}{uuid.uuid4().hex}")
+    fresh = os.path.join(store.root, f"{UPLOAD_TEMP_PREFIX}{uuid.uuid4().hex}")
+    for path in (old, fresh):
+        open(path, "wb").close()
+    past = time.time() - blob_store_module.BLOB_TEMP_MAX_AGE_SECONDS - 60
+    os.utime(old, (past, past))
+
+    store.collect_garbage()
+    assert not os.path.exists(old)
+    assert os.path.exists(fresh)
@@ -0,0 +1,112 @@
+import uuid
+
+import pytest
+from bson import ObjectId
+
+from utils.db import chat_sessions_collection, documents_collection
+
+def _history(turns):
+    history = []
+    for number in range(turns):
+        history.append({"type": "user", "content": f"question {number}"})
+        history.append({"type": "response", "content": f"answer {number}"})
+    return history
+
+def _image_document(user_id):
+    return str(documents_collection.insert_one({
+        "user_id": user_id,
+        "original_name": "figure.png",
+        "stored_name": f"{uuid.uuid4().hex}.png",
+        "file_type": "png",
+        "file_hash": uuid.uuid4().hex,
+        "metadata": {"is_image": True, "summary": "A bar chart of results"}
+    }).inserted_id)
+
+def _chat(user_id, with_memory):
+    from utils.nlp_utils import conversation_memory
+    history = _history(2)
+    session = {"user_id": user_id, "name": "Chat", "history": history}
+    if with_memory:
+        session["memory"] = conversation_memory.from_history(history)
+    return str(chat_sessions_collection.insert_one(session).inserted_id)
+
+@pytest.mark.parametrize("with_memory", [True, False])
+def test_attaching_a_document_keeps_earlier_turns_in_memory(client, auth_headers, turn_writer, with_memory):
+    user_id = uuid.uuid4().hex
+    chat_id = _chat(user_id, with_memory)
+    response = client.post("/document/process-document", headers=auth_headers(user_id), data={
+        "query": "summarize the figure",
+        "chat_id": chat_id,
+        "document_id": _image_document(user_id),
+        "request_id": uuid.uuid4().hex
+    })
+    assert response.status_code == 200, response.get_json()
+    assert response.get_json()["chat_id"] == chat_id
+
+    turn_writer.flush()
+    session = chat_sessions_collection.find_one({"_id": ObjectId(chat_id)})
+    assert len(session["history"]) == 6
+    assert session["memory"]["turn_count"] == 3
+    assert [turn["query"] for turn in session["memory"]["turns"]][-1] == "summarize the figure"
+    # Embedded by the turn writer after the response
+    assert session["memory"]["turns"][-1]["embedding"]
+
+@pytest.mark.parametrize("with_memory", [True, False])
+def test_compare_keeps_earlier_turns_in_memory(client, auth_headers, turn_writer, monkeypatch, with_memory):
+    from routes import document
+    monkeypatch.setattr(document, "compare_documents", lambda query, sources, user_id=None: "Both use the same data")
+    user_id = uuid.uuid4().hex
+    chat_id = _chat(user_id, with_memory)
+    response = client.post("/document/compare", headers=auth_headers(user_id), json={
+        "query": "How do they differ?",
+        "document_ids": [_image_document(user_id), _image_document(user_id)],
+        "chat_id": chat_id
+    })
+    assert response.status_code == 200, response.get_json()
+
+    turn_writer.flush()
+    session = chat_sessions_collection.find_one({"_id": ObjectId(chat_id)})
+    assert session["memory"]["turn_count"] == 3
+
+def test_new_chat_is_written_before_its_id_is_returned(client, auth_headers, turn_writer, monkeypatch):
+    flushed = []
+    real_flush = turn_writer.flush
+
+    def flush(key=None):
+        flushed.append((key, turn_writer.has_pending(key)))
+        real_flush(key)
+
+    monkeypatch.setattr(turn_writer, "flush", flush)
+    user_id = uuid.uuid4().hex
+    response = client.post("/document/process-document", headers=auth_headers(user_id), data={
+        "query": "summarize the figure",
+        "document_id": _image_document(user_id),
+        "request_id": uuid.uuid4().hex
+    })
+    assert response.status_code == 200, response.get_json()
+    assert (user_id, True) in flushed
+    assert chat_sessions_collection.find_one({"_id": ObjectId(response.get_json()["chat_id"])}) is not None
+
+def test_turn_is_embedded_by_the_writer_not_the_response(turn_writer, monkeypatch):
+    from pymongo import UpdateOne
+    from utils.nlp_utils import conversation_memory
+    calls = []
+    real_embed = conversation_memory.embedding_model.embed_query
+    monkeypatch.setattr(conversation_memory.embedding_model, "embed_query", lambda text: calls.append(text) or real_embed(text))
+
+    memory = conversation_memory.from_history(_history(3))
+    memory = conversation_memory.update(memory, "what about methods", "They use a survey")
+    assert calls == []
+    assert memory["turns"][-1]["embedding"] is None
+
+    session_filter = {"_id": chat_sessions_collection.insert_one({"user_id": "u"}).inserted_id}
+    turn_writer.submit("chat_sessions", UpdateOne(session_filter, {"$set": {"memory": memory}}), key="u")
+    turn_writer.submit("chat_sessions", conversation_memory.embed_operation(session_filter, memory), key="u")
+    turn_writer.flush("u")
+    assert len(calls) == 1
+
+    stored = chat_sessions_collection.find_one(session_filter)["memory"]
+    # Packed float16, 2 bytes per dimension, on every turn
+    assert all(len(turn["embedding"]) == 2 * 64 for turn in stored["turns"])
+    query_vector = conversation_memory.embedding_model.embed_query("question 0 answer 0")
+    assert [turn["query"] for turn in conversation_memory.select_turns(stored, query_vector)][0] == "question 0"
@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+from utils.embedding_service import EmbeddingService
+
+class _Model:
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def embed_documents(self, texts):
+        self.gate.wait(5)
+        self.calls.append(list(texts))
+        if self.fail:
+            raise RuntimeError("model unavailable")
+        return [[float(len(text))] for text in texts]
+
+    def embed_query(self, text):
+        raise AssertionError("queries go through embed_documents batches")
+
+def test_concurrent_queries_share_a_batch():
+    model = _Model()
+    service = EmbeddingService(model, max_batch=8, max_wait_ms=50)
+    results = {}
+
+    def query(text):
+        results[text] = service.embed_query(text)
+
+    threads = [threading.Thread(target=query, args=("q" * n,)) for n in range(1, 6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert results == {"q" * n: [float(n)] for n in range(1, 6)}
+    assert sum(len(call) for call in model.calls) == 5
+    assert len(model.calls) < 5
+    assert service.stats()["max_batch"] > 1
+
+def test_identical_queries_are_shared_then_cached():
+    model = _Model()
+    model.gate.clear()
+    service = EmbeddingService(model, max_wait_ms=0)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(service.embed_query("same"))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    deadline = time.time() + 5
+    while service.stats()["shared"] < 2 and time.time() < deadline:
+        time.sleep(0.005)
+    model.gate.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == [[4.0]] * 3
+    assert service.embed_query("same") == [4.0]
+    assert model.calls == [["same"]]
+    stats = service.stats()
+    assert stats["shared"] == 2 and stats["cache_hits"] == 1
+
+def test_cache_is_bounded():
+    model = _Model()
+    service = EmbeddingService(model, max_wait_ms=0, cache_size=2)
+    for text in ("a", "bb", "ccc"):
+        service.embed_query(text)
+    service.embed_query("a")
+    assert model.calls[-1] == ["a"]
+    assert service.stats()["cached"] == 2
+
+def test_batch_failure_reaches_every_caller_and_is_not_cached():
+    model = _Model(fail=True)
+    service = EmbeddingService(model, max_wait_ms=0)
+    with pytest.raises(RuntimeError):
+        service.embed_query("x")
+    model.fail = False
+    assert service.embed_query("x") == [1.0]
+    assert service.stats()["failed"] == 1
+
+def test_documents_pass_through():
+    model = _Model()
+    service = EmbeddingService(model)
+    assert service.embed_documents(["ab", "c"]) == [[2.0], [1.0]]
+    assert service.stats()["requests"] == 0
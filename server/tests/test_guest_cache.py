@@ -0,0 +1,77 @@
+import time
+
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+
+from utils.guest_cache import GuestCache, new_guest_token, is_valid_guest_token
+from utils.ingest_pipeline import build_vector_store
+
+def _documents(count, dimensions=8):
+    documents = [
+        Document(page_content=f"chunk {n}", metadata={"id": str(n), "embedding": [float(n)] * dimensions})
+        for n in range(count)
+    ]
+    vectors = [doc.metadata["embedding"] for doc in documents]
+    return documents, build_vector_store(None, documents, vectors=vectors)
+
+def test_tokens_are_valid():
+    assert is_valid_guest_token(new_guest_token())
+    assert not is_valid_guest_token("short")
+    assert not is_valid_guest_token("x" * 30 + "/..")
+
+def test_cached_chunks_drop_their_embedding_lists():
+    cache = GuestCache()
+    documents, store = _documents(3)
+    assert cache.put("token", "hash", documents, {}, store)
+    entry = cache.get("token", "hash")
+    assert all("embedding" not in doc.metadata for doc in entry["documents"])
+    # The index still answers searches without them
+    assert entry["vector_store"].similarity_search_by_vector(np.full(8, 2.0).tolist(), k=1)[0].page_content == "chunk 2"
+
+def test_entries_are_private_to_their_token():
+    cache = GuestCache()
+    documents, store = _documents(2)
+    cache.put("token-a", "hash", documents, {}, store)
+    assert cache.get("token-b", "hash") is None
+    assert cache.get("token-a", "hash") is not None
+
+def test_entries_expire():
+    cache = GuestCache(ttl=0.05)
+    documents, store = _documents(1)
+    cache.put("token", "hash", documents, {}, store)
+    time.sleep(0.1)
+    assert cache.get("token", "hash") is None
+    assert cache.stats()["expired"] == 1
+
+def test_least_recently_used_entries_are_evicted_over_the_byte_cap():
+    def put(cache, name):
+        documents, store = _documents(4)
+        return cache.put("token", name, documents, {}, store)
+
+    probe = GuestCache()
+    put(probe, "probe")
+    entry_size = probe.stats()["bytes"]
+
+    cache = GuestCache(max_bytes=entry_size * 2, max_per_token=10)
+    put(cache, "first")
+    put(cache, "second")
+    cache.get("token", "first")
+    put(cache, "third")
+    assert cache.get("token", "second") is None
+    assert cache.get("token", "first") is not None
+    assert cache.stats()["bytes"] <= entry_size * 2
+
+def test_each_token_keeps_only_its_latest_documents():
+    cache = GuestCache(max_per_token=2)
+    for name in ("one", "two", "three"):
+        documents, store = _documents(1)
+        cache.put("token", name, documents, {}, store)
+    assert cache.get("token", "one") is None
+    assert cache.stats()["entries"] == 2
+
+def test_oversized_documents_are_not_cached():
+    cache = GuestCache(max_bytes=10)
+    documents, store = _documents(4)
+    assert not cache.put("token", "hash", documents, {}, store)
+    assert cache.stats()["rejected"] == 1
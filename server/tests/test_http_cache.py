@@ -0,0 +1,58 @@
+import gzip
+import uuid
+
+import pytest
+from flask import Flask, jsonify
+
+from utils import http_cache
+from utils.http_cache import compress_response
+
+@pytest.fixture
+def small_app():
+    app = Flask(__name__)
+    app.after_request(compress_response)
+
+    @app.route("/big")
+    def big():
+        return jsonify({"text": "insight " * 1000})
+
+    @app.route("/small")
+    def small():
+        return jsonify({"text": "hi"})
+
+    return app.test_client()
+
+def test_large_json_is_gzipped(small_app, monkeypatch):
+    monkeypatch.setattr(http_cache, "brotli", None)
+    response = small_app.get("/big", headers={"Accept-Encoding": "gzip, br"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert b"insight" in gzip.decompress(response.data)
+
+def test_brotli_preferred_when_installed(small_app):
+    brotli = pytest.importorskip("brotli")
+    response = small_app.get("/big", headers={"Accept-Encoding": "gzip, br"})
+    assert response.headers["Content-Encoding"] == "br"
+    assert b"insight" in brotli.decompress(response.data)
+
+def test_small_or_unaccepted_bodies_are_left_alone(small_app):
+    assert "Content-Encoding" not in small_app.get("/small", headers={"Accept-Encoding": "gzip"}).headers
+    response = small_app.get("/big", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in response.headers
+    assert b"insight" in response.data
+
+def test_chat_revalidates_until_it_changes(client, auth_headers):
+    headers = auth_headers(uuid.uuid4().hex)
+    chat_id = client.post("/chat/create", headers=headers, json={"name": "Notes"}).get_json()["chat_id"]
+    first = client.get(f"/chat/{chat_id}", headers=headers)
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    assert etag.startswith("W/")
+
+    again = client.get(f"/chat/{chat_id}", headers={**headers, "If-None-Match": etag})
+    assert again.status_code == 304 and again.data == b""
+
+    assert client.put(f"/chat/{chat_id}/rename", headers=headers, json={"name": "Renamed"}).status_code == 200
+    changed = client.get(f"/chat/{chat_id}", headers={**headers, "If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.get_json()["name"] == "Renamed"
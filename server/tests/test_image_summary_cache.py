@@ -0,0 +1,29 @@
+import uuid
+
+from utils.image_utils import ImageSummaryCache
+
+def _phash():
+    return uuid.uuid4().hex[:16]
+
+def _near(phash):
+    # Flip the lowest bit: Hamming distance 1
+    return f"{int(phash, 16) ^ 1:016x}"
+
+def test_near_duplicates_only_for_the_same_owner():
+    cache = ImageSummaryCache()
+    phash = _phash()
+    cache.put(phash, "Summarize", "alice's chart", "alice", "a" * 64)
+    assert cache.get(_near(phash), "summarize ", "alice", "b" * 64) == "alice's chart"
+    assert cache.get(_near(phash), "Summarize", "bob", "b" * 64) is None
+    # Not even the exact perceptual hash is shared without identical content
+    assert cache.get(phash, "Summarize", "bob") is None
+
+def test_identical_content_is_shared():
+    cache = ImageSummaryCache()
+    phash = _phash()
+    content_hash = uuid.uuid4().hex * 2
+    cache.put(phash, "Summarize", "shared figure", "alice", content_hash)
+    assert cache.get(phash, "Summarize", "bob", content_hash) == "shared figure"
+    # Also from the collection, in a fresh process
+    assert ImageSummaryCache().get(phash, "Summarize", "carol", content_hash) == "shared figure"
+    assert ImageSummaryCache().get(phash, "Summarize", "carol") is None
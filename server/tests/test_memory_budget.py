@@ -0,0 +1,106 @@
+import functools
+import hashlib
+import tracemalloc
+import uuid
+
+import pytest
+
+from utils import memory_budget
+from utils.memory_budget import IngestMemoryTracker, MemoryBudgetError, MB
+
+@pytest.fixture
+def rss(monkeypatch):
+    """Controllable process RSS, in MB"""
+    value = {"mb": 100}
+    monkeypatch.setattr(memory_budget, "current_rss", lambda: int(value["mb"] * MB))
+    return value
+
+def test_degrade_stops_ingestion_over_budget(rss):
+    with IngestMemoryTracker(MB, budget_mb=50, policy="degrade") as tracker:
+        rss["mb"] = 140
+        assert tracker.check() is False
+        rss["mb"] = 160
+        assert tracker.check() is True
+    assert tracker.degraded
+    assert tracker.peak_growth == 60 * MB
+
+def test_reject_raises_over_budget(rss):
+    with pytest.raises(MemoryBudgetError):
+        with IngestMemoryTracker(MB, budget_mb=50, policy="reject") as tracker:
+            rss["mb"] = 160
+            tracker.check()
+
+def test_budget_scales_with_concurrent_ingestions(rss):
+    with IngestMemoryTracker(MB, budget_mb=50) as first, IngestMemoryTracker(MB, budget_mb=50) as second:
+        # Growth of both documents together is within two budgets
+        rss["mb"] = 190
+        assert first.check() is False
+        assert second.check() is False
+    with IngestMemoryTracker(MB, budget_mb=50) as alone:
+        rss["mb"] = 250
+        assert alone.check() is True
+
+def test_process_limit_caps_the_budget(rss, monkeypatch):
+    monkeypatch.setattr(memory_budget, "INGEST_MEMORY_PROCESS_LIMIT_MB", 200)
+    with IngestMemoryTracker(MB, budget_mb=1000) as tracker:
+        rss["mb"] = 190
+        assert tracker.check() is False
+        rss["mb"] = 210
+        assert tracker.check() is True
+
+def test_tracemalloc_stays_on_for_other_trackers(rss, monkeypatch):
+    monkeypatch.setattr(memory_budget, "MEMORY_TRACEMALLOC", True)
+    try:
+        with IngestMemoryTracker(MB) as first:
+            with IngestMemoryTracker(MB):
+                pass
+            assert tracemalloc.is_tracing()
+            with first.stage("ingest"):
+                pass
+        assert "python_peak_mb" in first.stages["ingest"]
+    finally:
+        tracemalloc.stop()
+
+def _pdf(path, pages):
+    pymupdf = pytest.importorskip("pymupdf")
+    document = pymupdf.open()
+    for number in range(pages):
+        page = document.new_page()
+        text = " ".join(f"Page {number} sentence {i} about methods and results." for i in range(60))
+        page.insert_textbox(page.rect + (36, 36, -36, -36), text, fontsize=9)
+    document.save(str(path))
+    document.close()
+
+class _AlwaysOver(IngestMemoryTracker):
+    def check(self):
+        self.degraded = True
+        return True
+
+def test_truncated_document_is_reported_and_not_reused(client, auth_headers, monkeypatch, tmp_path):
+    from utils import nlp_utils
+    from utils.db import documents_collection
+    from utils.text_store import text_store
+    monkeypatch.setattr(nlp_utils, "IngestMemoryTracker", _AlwaysOver)
+    monkeypatch.setattr(nlp_utils, "IngestPipeline", functools.partial(nlp_utils.IngestPipeline, batch_size=4))
+    path = tmp_path / f"{uuid.uuid4().hex}.pdf"
+    _pdf(path, 12)
+    user_id = uuid.uuid4().hex
+    headers = auth_headers(user_id)
+
+    def upload():
+        with open(path, "rb") as handle:
+            return client.post("/document/upload", headers=headers, data={"file": (handle, "paper.pdf")},
+                               content_type="multipart/form-data")
+
+    first = upload()
+    assert first.status_code == 201, first.get_json()
+    body = first.get_json()
+    assert body["truncated"] is True
+    assert 0 < body["ingested_pages"] < 12
+
+    second = upload()
+    assert second.status_code == 201, second.get_json()
+    assert second.get_json()["document_id"] != body["document_id"]
+    assert documents_collection.count_documents({"user_id": user_id}) == 2
+    # Partial text is not stored under the file's hash
+    assert not text_store.exists(hashlib.sha256(path.read_bytes()).hexdigest())
@@ -0,0 +1,27 @@
+import pytest
+
+from routes import metrics
+
+REMOTE = {"REMOTE_ADDR": "203.0.113.5"}
+
+@pytest.fixture
+def no_tokens(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", None)
+    monkeypatch.setattr(metrics, "PROFILING_TOKEN", None)
+
+def test_metrics_local_only_without_token(client, no_tokens):
+    assert client.get("/metrics").status_code == 200
+    assert client.get("/metrics", environ_base=REMOTE).status_code == 403
+
+def test_metrics_token_required_when_set(client, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "secret")
+    # Local callers need it too once a token is configured
+    assert client.get("/metrics").status_code == 401
+    response = client.get("/metrics", headers={"X-Metrics-Token": "secret"}, environ_base=REMOTE)
+    assert response.status_code == 200
+    assert "admission" in response.get_json()
+
+def test_profiling_toggle_local_only_without_token(client, no_tokens):
+    response = client.put("/metrics/profiling", json={"sample_rate": 0}, environ_base=REMOTE)
+    assert response.status_code == 403
+    assert client.put("/metrics/profiling", json={"sample_rate": 0}).status_code == 200
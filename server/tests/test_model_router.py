@@ -0,0 +1,75 @@
+import os
+
+from utils.model_router import ModelRouter, LLM_SHORT_QUERY_WORDS
+
+def _router():
+    return ModelRouter("large", "fast")
+
+def test_depth_goes_to_the_large_model():
+    router = _router()
+    assert router.choose("compare the two", {"comparison": 0.6}, {})["route"] == "comparison"
+    assert router.choose("a table please", {}, {"structure": "table"})["route"] == "comparison"
+    technical = router.choose("explain the method", {"technical_detail": 0.8}, {})
+    assert technical["route"] == "technical" and technical["model"] == "large"
+    assert router.choose("key points", {}, {"structure": "bullet"})["route"] == "summary"
+
+def test_light_questions_go_to_the_fast_model():
+    router = _router()
+    casual = router.choose("hi", {"casual_chat": 0.9}, {})
+    assert casual["model"] == "fast" and casual["temperature"] == 0.7
+    assert router.choose("who wrote it", {"metadata_query": 0.9}, {})["model"] == "fast"
+    short = router.choose("and why?", {}, {}, follow_up=True)
+    assert short["route"] == "short" and short["model"] == "fast"
+
+def test_long_or_first_questions_are_general():
+    router = _router()
+    long_query = " ".join(["word"] * (LLM_SHORT_QUERY_WORDS + 1))
+    assert router.choose(long_query, {}, {}, follow_up=True)["route"] == "general"
+    general = router.choose("and why?", {}, {})
+    assert general["route"] == "general" and general["model"] == "large"
+    assert general["max_tokens"] == router.max_tokens["general"]
+
+def test_fast_model_defaults_to_large():
+    assert ModelRouter("large").decision("casual")["model"] == "large"
+
+def test_stats_per_route():
+    router = _router()
+    router.decision("casual")
+    router.record("casual", 0.2)
+    router.record("casual", 0.4, ok=False)
+    stats = router.stats()["casual"]
+    assert stats["decisions"] == 1 and stats["calls"] == 2 and stats["errors"] == 1
+    assert stats["avg_ms"] == 300.0 and stats["max_ms"] == 400.0
+
+def test_call_llm_api_uses_the_decision(nlp_utils, monkeypatch):
+    sent = {}
+
+    class _Response:
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {"choices": [{"message": {"content": "ok"}}]}
+
+    def post(url, json, headers, timeout):
+        sent.update(json)
+        return _Response()
+
+    monkeypatch.setattr(nlp_utils.requests, "post", post)
+    decision = nlp_utils.model_router.decision("short")
+    assert nlp_utils.call_llm_api("prompt", decision) == "ok"
+    assert sent["model"] == decision["model"]
+    assert sent["max_tokens"] == decision["max_tokens"]
+
+def test_warns_when_fast_model_is_the_large_model(caplog):
+    with caplog.at_level("WARNING", logger="utils.model_router"):
+        ModelRouter("large")
+    assert "LLAMA_FAST_MODEL" in caplog.text
+    caplog.clear()
+    with caplog.at_level("WARNING", logger="utils.model_router"):
+        ModelRouter("large", "fast")
+    assert caplog.text == ""
+
+def test_default_fast_model_differs(nlp_utils):
+    if "LLAMA_FAST_MODEL" not in os.environ:
+        assert nlp_utils.LLAMA_FAST_MODEL != nlp_utils.LLAMA_MODEL
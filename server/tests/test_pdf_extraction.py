@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from utils import pdf_extraction
+from utils.pdf_extraction import PdfPageStream, extract_pdf, page_ranges
+
+pymupdf = pytest.importorskip("pymupdf")
+
+def _pdf(path, pages):
+    document = pymupdf.open()
+    for number in range(pages):
+        page = document.new_page()
+        page.insert_text((72, 72), f"Section {number}", fontsize=16)
+        page.insert_text((72, 110), f"Body text of page {number}. See Figure {number + 1}.", fontsize=10)
+    document.save(str(path))
+    document.close()
+    return str(path)
+
+def test_page_ranges_cover_all_pages():
+    ranges = page_ranges(37, 4, max_pages=5)
+    assert ranges[0][0] == 0 and ranges[-1][1] == 37
+    assert all(end - start <= 5 for start, end in ranges)
+    assert all(ranges[i][1] == ranges[i + 1][0] for i in range(len(ranges) - 1))
+
+def test_default_start_method_is_not_fork():
+    assert pdf_extraction.PDF_POOL_START_METHOD in ("forkserver", "spawn")
+
+@pytest.mark.parametrize("backend", ["pypdfium2", "pymupdf"])
+def test_concurrent_in_process_extraction(tmp_path, backend):
+    pytest.importorskip(backend)
+    paths = [_pdf(tmp_path / f"doc{number}.pdf", 3 + number) for number in range(6)]
+    expected = [extract_pdf(path, backend)["pages"] for path in paths]
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        results = list(pool.map(lambda path: extract_pdf(path, backend)["pages"], paths * 4))
+    assert results == expected * 4
+
+def test_large_document_is_extracted_in_the_pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(pdf_extraction, "PDF_EXTRACT_WORKERS", 2)
+    monkeypatch.setattr(pdf_extraction, "PDF_PARALLEL_MIN_PAGES", 4)
+    monkeypatch.setattr(pdf_extraction, "PDF_STREAM_RANGE_PAGES", 3)
+    path = _pdf(tmp_path / "long.pdf", 10)
+    stream = PdfPageStream(path)
+    pages = [page["text"] for page in stream]
+    assert stream.ranges > 1
+    assert len(pages) == 10
+    assert all(f"page {number}." in text for number, text in enumerate(pages))
+
+@pytest.mark.parametrize("backend", ["pypdfium2", "pymupdf"])
+def test_rendering_alongside_extraction(tmp_path, backend):
+    pytest.importorskip(backend)
+    from utils.pdf_extraction import render_pages
+    path = _pdf(tmp_path / "render.pdf", 4)
+
+    def render(_):
+        return [(index, image.size) for index, image in render_pages(path, [0, 1, 2, 3], 200, backend)]
+
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        renders = [pool.submit(render, n) for n in range(6)]
+        extractions = [pool.submit(extract_pdf, path, backend) for _ in range(6)]
+        assert all(len(future.result()["pages"]) == 4 for future in extractions)
+        for future in renders:
+            assert [index for index, _ in future.result()] == [0, 1, 2, 3]
+            assert all(abs(size[0] - 200) <= 1 for _, size in future.result())
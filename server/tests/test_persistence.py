@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+from pymongo import InsertOne
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from utils import persistence
+from utils.persistence import TurnWriter, PersistenceError
+
+class RecordingCollection:
+    """bulk_write stand-in: records documents, can fail or block on demand"""
+
+    def __init__(self):
+        self.written = []
+        self.failures = []  # Exceptions raised by the next calls, in order
+        self.gate = None
+
+    def bulk_write(self, operations, ordered=True):
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.failures:
+            raise self.failures.pop(0)
+        self.written.extend(operation._doc for operation in operations)
+
+@pytest.fixture
+def writer(monkeypatch):
+    monkeypatch.setattr(TurnWriter, "_ensure_thread", lambda self: None)
+    monkeypatch.setattr(persistence, "PERSIST_RETRY_DELAY", 0)
+    collection = RecordingCollection()
+    return TurnWriter({"chat_sessions": collection}), collection
+
+def test_keyed_flush_writes_only_that_key(writer):
+    turns, collection = writer
+    turns.submit("chat_sessions", InsertOne({"n": 1}), key="alice")
+    turns.submit("chat_sessions", InsertOne({"n": 2}), key="bob")
+    turns.submit("chat_sessions", InsertOne({"n": 3}), key="alice")
+    turns.flush("alice")
+    assert collection.written == [{"n": 1}, {"n": 3}]
+    assert turns.has_pending("bob") and not turns.has_pending("alice")
+    turns.flush()
+    assert collection.written[-1] == {"n": 2}
+
+def test_keyed_flush_waits_for_the_keys_writes_in_flight(writer):
+    turns, collection = writer
+    collection.gate = threading.Event()
+    turns.submit("chat_sessions", InsertOne({"n": 1}), key="alice")
+    background = threading.Thread(target=turns.flush)
+    background.start()
+    time.sleep(0.05)
+
+    turns.submit("chat_sessions", InsertOne({"n": 2}), key="alice")
+    reader = threading.Thread(target=turns.flush, args=("alice",))
+    reader.start()
+    time.sleep(0.05)
+    assert reader.is_alive()
+
+    collection.gate.set()
+    background.join(5)
+    reader.join(5)
+    assert collection.written == [{"n": 1}, {"n": 2}]
+
+def test_transient_errors_are_retried(writer):
+    turns, collection = writer
+    collection.failures = [AutoReconnect("primary stepped down")]
+    turns.submit("chat_sessions", InsertOne({"n": 1}), key="alice")
+    turns.flush("alice")
+    assert collection.written == [{"n": 1}]
+    assert turns.stats()["retries"] == 1
+
+def test_failures_are_reported_to_the_next_flush_of_their_key(writer):
+    turns, collection = writer
+    collection.failures = [AutoReconnect("down")] * persistence.PERSIST_RETRIES
+    turns.submit("chat_sessions", InsertOne({"n": 1}), key="alice")
+    turns.submit("chat_sessions", InsertOne({"n": 2}), key="bob")
+    turns.flush()  # Background flush: nobody to tell yet
+    assert turns.stats()["failed"] == 2
+    with pytest.raises(PersistenceError):
+        turns.flush("alice")
+    turns.flush("alice")  # Reported once
+    with pytest.raises(PersistenceError):
+        turns.flush("bob")
+
+def test_rejected_operation_does_not_drop_the_rest_of_the_batch(writer):
+    turns, collection = writer
+    collection.failures = [BulkWriteError({"writeErrors": [{"index": 1, "errmsg": "duplicate key"}], "nInserted": 1})]
+    for n in range(4):
+        turns.submit("chat_sessions", InsertOne({"n": n}), key="bob" if n == 1 else "alice")
+    turns.flush()
+    # The server applied the first operation before the error (the stand-in records nothing for
+    # the failed call) and rejected the second; the rest go in a follow-up bulk_write
+    assert collection.written == [{"n": 2}, {"n": 3}]
+    assert turns.stats()["written"] == 3
+    turns.flush("alice")
+    with pytest.raises(PersistenceError):
+        turns.flush("bob")
+
+def test_submitters_flush_inline_when_the_backlog_is_full(writer, monkeypatch):
+    turns, collection = writer
+    monkeypatch.setattr(persistence, "PERSIST_MAX_PENDING", 3)
+    for n in range(3):
+        turns.submit("chat_sessions", InsertOne({"n": n}), key="alice")
+    assert len(collection.written) == 3
+    assert turns.stats()["inline_flushes"] == 1
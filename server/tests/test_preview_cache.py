@@ -0,0 +1,34 @@
+import os
+import uuid
+
+from utils import text_store as text_store_module
+from utils.preview_cache import PreviewCache, paginate_text
+
+def test_paginate_breaks_between_paragraphs():
+    text = "\n".join(["alpha beta"] * 6)
+    pages = paginate_text(text, page_chars=25)
+    assert pages == ["alpha beta\nalpha beta"] * 3
+    assert paginate_text("", page_chars=25) == [""]
+    # A paragraph longer than a page is cut at a word boundary
+    assert paginate_text("one two three four", page_chars=9) == ["one two", "three", "four"]
+
+def test_docx_preview_pages_from_stored_text(tmp_path, monkeypatch):
+    from utils.text_store import text_store
+    monkeypatch.setattr(text_store_module, "TEXT_STORE_PART_BYTES", 256)
+    monkeypatch.setattr(text_store_module, "TEXT_STORE_READ_CHARS", 500)
+    file_hash = uuid.uuid4().hex * 2
+    text = "\n".join(f"Paragraph {number} " + "wörds " * 40 for number in range(200))
+    assert text_store.put(file_hash, text)
+    assert text_store.collection.find_one({"_id": file_hash})["parts"] > 1
+
+    def whole_text(*args):
+        raise AssertionError("preview should stream the stored text")
+
+    monkeypatch.setattr(text_store, "read", whole_text)
+    cache = PreviewCache(root=str(tmp_path))
+    name = f"{file_hash}.docx"
+    # The DOCX itself is not needed when the text is stored
+    manifest = cache.manifest(name, os.path.join(str(tmp_path), "missing.docx"))
+    assert manifest["chars"] == len(text)
+    assert manifest["pages"] == len(paginate_text(text))
+    assert cache.read_text(name, "missing.docx") == "\n".join(paginate_text(text))
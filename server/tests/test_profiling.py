@@ -0,0 +1,54 @@
+import contextvars
+import threading
+import time
+
+from utils.profiling import RequestProfile, attach_thread, current_profile
+from utils.stage_graph import StageGraph
+
+def _spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+def own_work(stop):
+    _spin(stop)
+
+def other_request_work(stop):
+    _spin(stop)
+
+def test_profile_samples_only_its_own_threads():
+    stop = threading.Event()
+    # Another request's busy thread, running without this profile
+    other = threading.Thread(target=other_request_work, args=(stop,), name="other-request")
+    other.start()
+    profile = RequestProfile("sampling", "test")
+    token = current_profile.set(profile)
+    try:
+        profile.start()
+        worker = threading.Thread(
+            target=contextvars.copy_context().run, args=(attach_thread(own_work), stop), name="worker"
+        )
+        worker.start()
+        time.sleep(0.15)
+        stop.set()
+        worker.join(5)
+        other.join(5)
+        profile.stop()
+    finally:
+        current_profile.reset(token)
+    stacks = list(profile.samples)
+    assert any("own_work" in stack and stack.startswith("worker;") for stack in stacks)
+    assert not any("other_request_work" in stack for stack in stacks)
+    # Detached once done
+    assert set(profile._threads) == {profile.thread_id}
+
+def test_stage_threads_join_the_profile():
+    profile = RequestProfile("sampling", "test")
+    seen = []
+    token = current_profile.set(profile)
+    try:
+        stages = StageGraph()
+        stages.add("work", lambda: seen.append(threading.get_ident() in profile._threads))
+        stages.result("work")
+    finally:
+        current_profile.reset(token)
+    assert seen == [True]
@@ -0,0 +1,30 @@
+import pytest
+
+@pytest.mark.parametrize("query", [
+    "What is his main contribution?",
+    "Does this paper use a control group?",
+    "Give me the history of the field",
+])
+def test_greeting_keywords_do_not_match_inside_words(nlp_utils, query):
+    assert nlp_utils.analyze_query_intent(query)["casual_chat"] == 0
+
+def test_greeting_is_casual(nlp_utils):
+    scores = nlp_utils.analyze_query_intent("hi there, how are you?")
+    assert scores["casual_chat"] == 1.0
+
+def test_question_about_his_work_is_not_routed_as_casual(nlp_utils):
+    scores = nlp_utils.analyze_query_intent("What is his main contribution?")
+    style = nlp_utils.determine_response_style(scores, {})
+    decision = nlp_utils.model_router.choose("What is his main contribution?", scores, style)
+    assert decision["route"] != "casual"
+
+@pytest.mark.parametrize("query, intent", [
+    ("Which methods did they use?", "technical_detail"),
+    ("What are the key results?", "technical_detail"),
+    ("Who are the authors?", "metadata_query"),
+    ("How many figures are there?", "metadata_query"),
+    ("What are the differences between the two models?", "comparison"),
+])
+def test_plural_keywords_match(nlp_utils, query, intent):
+    scores = nlp_utils.analyze_query_intent(query)
+    assert max(scores, key=scores.get) == intent
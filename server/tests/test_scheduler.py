@@ -0,0 +1,76 @@
+import threading
+import time
+
+from utils import scheduler
+from utils.scheduler import (
+    PriorityScheduler, ScheduledEmbeddings, INTERACTIVE, BULK, ingest_priority, work_priority
+)
+
+def test_ingest_priority_by_size():
+    assert ingest_priority(total_pages=scheduler.SCHEDULER_SMALL_DOC_PAGES) == INTERACTIVE
+    assert ingest_priority(total_pages=scheduler.SCHEDULER_SMALL_DOC_PAGES + 1) == BULK
+    assert ingest_priority(size=scheduler.SCHEDULER_SMALL_DOC_BYTES + 1) == BULK
+
+def _wait_queued(pool, priority, count):
+    deadline = time.time() + 5
+    while pool.stats()[priority]["queued"] < count and time.time() < deadline:
+        time.sleep(0.005)
+
+def test_interactive_goes_before_waiting_bulk():
+    pool = PriorityScheduler("test", 1)
+    order = []
+    pool.acquire(BULK)
+
+    def worker(priority):
+        with pool.slot(priority):
+            order.append(priority)
+
+    bulk = threading.Thread(target=worker, args=(BULK,))
+    bulk.start()
+    _wait_queued(pool, BULK, 1)
+    interactive = threading.Thread(target=worker, args=(INTERACTIVE,))
+    interactive.start()
+    _wait_queued(pool, INTERACTIVE, 1)
+    pool.release(BULK)
+    bulk.join(5)
+    interactive.join(5)
+    assert order == [INTERACTIVE, BULK]
+    stats = pool.stats()
+    assert stats["free"] == 1
+    assert stats[BULK]["completed"] == 2 and stats[INTERACTIVE]["completed"] == 1
+
+def test_aged_bulk_work_is_not_starved(monkeypatch):
+    monkeypatch.setattr(scheduler, "SCHEDULER_BULK_AGING", 0.05)
+    pool = PriorityScheduler("test", 1)
+    bulk_ticket = (time.time(),)
+    pool._waiting[BULK].append(bulk_ticket)
+    pool._waiting[INTERACTIVE].append((time.time(),))
+    # Interactive work is waiting, so fresh bulk work holds back until it has aged
+    assert not pool._eligible(bulk_ticket, BULK)
+    time.sleep(0.06)
+    assert pool._eligible(bulk_ticket, BULK)
+
+class _Recording:
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(len(texts))
+        return [[float(len(text))] for text in texts]
+
+    def embed_query(self, text):
+        return [float(len(text))]
+
+def test_bulk_batches_are_sliced():
+    model = _Recording()
+    embeddings = ScheduledEmbeddings(model, PriorityScheduler("test", 1), bulk_slice=4)
+    texts = [str(i) * i for i in range(10)]
+    token = work_priority.set(BULK)
+    try:
+        vectors = embeddings.embed_documents(texts)
+    finally:
+        work_priority.reset(token)
+    assert model.calls == [4, 4, 2]
+    assert vectors == [[float(i)] for i in range(10)]
+    assert embeddings.embed_documents(texts[:6]) == vectors[:6]
+    assert model.calls[-1] == 6
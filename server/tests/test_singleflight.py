@@ -0,0 +1,69 @@
+import threading
+
+import pytest
+
+from utils.singleflight import SingleFlight, fingerprint
+
+def test_fingerprint_ignores_key_order():
+    assert fingerprint({"model": "m", "max_tokens": 5}) == fingerprint({"max_tokens": 5, "model": "m"})
+    assert fingerprint({"model": "m"}) != fingerprint({"model": "n"})
+
+def _overlapping(flight, key, func, callers):
+    """Run callers concurrently; func blocks until every follower has joined"""
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(_call(flight, key, func)))
+        for _ in range(callers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+def _call(flight, key, func):
+    try:
+        return flight.do(key, func)
+    except Exception as e:
+        return e
+
+def _blocking(flight, key, callers, outcome):
+    calls = []
+
+    def func():
+        calls.append(True)
+        # Hold the call open until the others are waiting on it
+        while flight._waiters.get(key, 0) < callers:
+            threading.Event().wait(0.005)
+        return outcome()
+    return func, calls
+
+def test_overlapping_calls_share_one_result():
+    flight = SingleFlight("test")
+    func, calls = _blocking(flight, "key", 3, lambda: "answer")
+    assert _overlapping(flight, "key", func, 3) == ["answer"] * 3
+    assert len(calls) == 1
+    stats = flight.stats()
+    assert stats["leaders"] == 1 and stats["shared"] == 2
+    assert stats["in_flight"] == 0 and stats["max_waiters"] == 3
+
+def test_failure_is_shared_and_not_kept():
+    flight = SingleFlight("test")
+
+    def fail():
+        raise ValueError("upstream down")
+
+    func, calls = _blocking(flight, "key", 2, fail)
+    results = _overlapping(flight, "key", func, 2)
+    assert len(calls) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flight.stats()["failed"] == 1
+    # The next call runs again instead of replaying the error
+    assert flight.do("key", lambda: "recovered") == "recovered"
+
+def test_sequential_calls_are_not_cached():
+    flight = SingleFlight("test")
+    assert flight.do("key", lambda: 1) == 1
+    assert flight.do("key", lambda: 2) == 2
+    with pytest.raises(KeyError):
+        flight.do("other", lambda: {}["missing"])
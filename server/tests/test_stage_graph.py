@@ -0,0 +1,127 @@
+import threading
+import time
+
+import pytest
+
+from utils.stage_graph import StageGraph
+
+def test_stages_get_their_inputs_in_order():
+    stages = StageGraph()
+    stages.add("a", lambda: 2)
+    stages.add("b", lambda: 3)
+    stages.add("sum", lambda a, b: a * 10 + b, after=("a", "b"))
+    assert stages.result("sum") == 23
+
+def test_result_runs_unstarted_stage_in_caller():
+    stages = StageGraph()
+    gate = threading.Event()
+    stages.add("slow", lambda: gate.wait(5) and "input")
+    stages.add("next", lambda value: (value, threading.current_thread().name), after=("slow",))
+    caller = threading.current_thread().name
+    threading.Timer(0.05, gate.set).start()
+    value, thread = stages.result("next")
+    assert value == "input"
+    # Either a pool worker or the caller ran it, but it ran exactly once
+    assert thread.startswith("stage") or thread == caller
+
+def test_cancel_drops_pending_stages():
+    stages = StageGraph()
+    gate = threading.Event()
+    ran = []
+    stages.add("first", lambda: gate.wait(5))
+    stages.add("speculative", lambda _: ran.append(True), after=("first",))
+    stages.cancel()
+    gate.set()
+    time.sleep(0.1)
+    assert ran == []
+    timing = stages.report({})
+    assert timing["stages"]["speculative"] == "cancelled"
+
+def test_report_follows_critical_path():
+    stages = StageGraph()
+    stages.add("fast", lambda: time.sleep(0.01))
+    stages.add("slow", lambda: time.sleep(0.05))
+    stages.add("end", lambda *_: None, after=("fast", "slow"))
+    stages.result("end")
+    timing = stages.report({})
+    assert timing["critical_path"] == "slow > end"
+    assert timing["critical_path_ms"] >= 50
+
+def test_casual_answer_stops_speculative_load(nlp_utils, monkeypatch):
+    load_started = threading.Event()
+    load_stopped = threading.Event()
+
+    def load_document(file_path, user_id, query, file_hash, guest_token, should_stop):
+        load_started.set()
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            if should_stop():
+                load_stopped.set()
+                break
+            time.sleep(0.01)
+        return [], {"truncated": True}, None
+
+    def route(query, metadata, handle_metadata_query):
+        load_started.wait(5)
+        return {"route": "casual"}
+
+    monkeypatch.setattr(nlp_utils, "load_document", load_document)
+    monkeypatch.setattr(nlp_utils.query_router, "route", route)
+    monkeypatch.setattr(nlp_utils, "call_llm_api", lambda prompt, decision: f"{decision['route']} answer")
+
+    # Not keyword-casual, so the load starts alongside routing
+    answer = nlp_utils.process_document_query("paper.pdf", "what do you think about it")
+    assert answer == "casual answer"
+    # Stopped and finished before the request returned
+    assert load_stopped.is_set()
+
+def test_failed_query_does_not_leave_the_load_running(nlp_utils, monkeypatch):
+    load_started = threading.Event()
+    load_finished = threading.Event()
+
+    def load_document(file_path, user_id, query, file_hash, guest_token, should_stop):
+        load_started.set()
+        while not should_stop():
+            time.sleep(0.01)
+        load_finished.set()
+        return [], {}, None
+
+    def route(query, metadata, handle_metadata_query):
+        load_started.wait(5)
+        raise RuntimeError("router down")
+
+    monkeypatch.setattr(nlp_utils, "load_document", load_document)
+    monkeypatch.setattr(nlp_utils.query_router, "route", route)
+    answer = nlp_utils.process_document_query("paper.pdf", "what do you think about it")
+    assert answer.startswith("An unexpected error occurred")
+    assert load_finished.is_set()
+
+def test_closing_the_graph_stops_and_waits_for_running_stages():
+    started = threading.Event()
+    finished = []
+    ran = []
+    with pytest.raises(ValueError):
+        with StageGraph() as stages:
+            def long_stage():
+                started.set()
+                while not stages.stopped.wait(0.01):
+                    pass
+                finished.append(True)
+
+            stages.add("long", long_stage)
+            stages.add("never", lambda _: ran.append(True), after=("long",))
+            assert started.wait(5)
+            raise ValueError("request failed")
+    assert finished == [True]
+    assert ran == []
+
+def test_stopped_load_is_not_stored(nlp_utils, tmp_path):
+    from utils.text_store import text_store
+    path = tmp_path / "notes.docx"
+    path.write_bytes(b"not needed")
+    documents, metadata, vector_store = nlp_utils.load_document(
+        str(path), "someone", file_hash="f" * 64, should_stop=lambda: True
+    )
+    assert documents == [] and vector_store is None
+    assert metadata["truncated"] is True
+    assert not text_store.exists("f" * 64)
@@ -0,0 +1,57 @@
+import random
+import uuid
+
+import mongomock
+import pytest
+
+from utils import text_store as text_store_module
+from utils.text_store import TextStore
+
+def _store(codec):
+    if codec == "zstd":
+        pytest.importorskip("zstandard")
+    return TextStore(mongomock.MongoClient().db.texts, codec=codec)
+
+def _text(chars):
+    # Multi-byte characters so part and read boundaries fall inside them
+    rng = random.Random(chars)
+    return "".join(rng.choice("abc déf ĝħ 数据 🙂\n") for _ in range(chars))
+
+@pytest.mark.parametrize("codec", ["zlib", "zstd"])
+def test_round_trip_across_parts(codec, monkeypatch):
+    monkeypatch.setattr(text_store_module, "TEXT_STORE_PART_BYTES", 1024)
+    monkeypatch.setattr(text_store_module, "TEXT_STORE_READ_CHARS", 1000)
+    store = _store(codec)
+    text = _text(50000)
+    assert store.put("h1", text)
+    head = store.collection.find_one({"_id": "h1"})
+    assert head["codec"] == codec and head["parts"] > 1
+    assert store.read("h1") == text
+    # Already stored: no second copy
+    assert not store.put("h1", "other")
+    store.remove("h1")
+    assert store.read("h1") is None
+    assert store.collection.count_documents({}) == 0
+
+def test_empty_text_is_stored():
+    store = _store("zlib")
+    assert store.put("empty", "")
+    assert store.read("empty") == ""
+    assert store.read("missing") is None
+    assert store.stats()["misses"] == 1
+
+def test_inline_text_is_migrated_on_read():
+    from utils.db import documents_collection
+    store = _store("zlib")
+    file_hash = uuid.uuid4().hex
+    documents_collection.insert_one({
+        "file_hash": file_hash, "extracted_text": "legacy text", "metadata": {"extracted_text": "legacy text"}
+    })
+    assert store.read(file_hash) == "legacy text"
+    record = documents_collection.find_one({"file_hash": file_hash})
+    assert "extracted_text" not in record and "extracted_text" not in record["metadata"]
+    assert store.stats()["migrated"] == 1
+
+def test_unavailable_codec_falls_back_to_zlib():
+    store = TextStore(mongomock.MongoClient().db.texts, codec="lz4")
+    assert store.codec == "zlib"
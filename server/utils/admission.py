@@ -0,0 +1,256 @@
+import os
+import math
+import time
+import logging
+import threading
+import contextvars
+from collections import OrderedDict, deque, Counter
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+ADMISSION_LLM_CONCURRENCY = int(os.getenv("ADMISSION_LLM_CONCURRENCY", 8))
+ADMISSION_LLM_PER_USER = int(os.getenv("ADMISSION_LLM_PER_USER", 2))
+ADMISSION_EMBED_CONCURRENCY = int(os.getenv("ADMISSION_EMBED_CONCURRENCY", 2))
+ADMISSION_EMBED_PER_USER = int(os.getenv("ADMISSION_EMBED_PER_USER", 1))
+ADMISSION_INGEST_CONCURRENCY = int(os.getenv("ADMISSION_INGEST_CONCURRENCY", 2))
+ADMISSION_INGEST_PER_USER = int(os.getenv("ADMISSION_INGEST_PER_USER", 1))
+ADMISSION_QUEUE_PER_USER = int(os.getenv("ADMISSION_QUEUE_PER_USER", 8))  # Waiting requests per user and queue
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", 64))  # Waiting requests per queue overall
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", 30))  # Seconds a queued request waits beyond the expected time of the work ahead
+ADMISSION_MAX_WAIT_CAP = float(os.getenv("ADMISSION_MAX_WAIT_CAP", 600))  # Upper bound on that total wait
+
+# User on whose behalf the current request runs; copy the context into worker threads
+current_user = contextvars.ContextVar("current_user", default="anonymous")
+
+class AdmissionError(Exception):
+    """Raised when a request cannot be admitted; retry_after is a hint in seconds"""
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class _Waiter:
+    __slots__ = ("user", "cost", "event", "granted", "enqueued")
+
+    def __init__(self, user: str, cost: float):
+        self.user = user
+        self.cost = cost
+        self.event = threading.Event()
+        self.granted = False
+        self.enqueued = time.time()
+
+class FairQueue:
+    """Concurrency limiter with deficit round-robin between users.
+
+    At most `capacity` holders run at once and at most `per_user` per user. When
+    full, callers wait in a per-user queue; freed slots go to users in round-robin
+    order, each user's deficit growing by `quantum` per round, so a user submitting
+    expensive work (high cost) cannot starve others. Queues are bounded and a full
+    queue rejects immediately with AdmissionError.
+
+    A queued caller waits for the expected duration of the work ahead of it (its
+    own running and queued work, and everyone's, from the learned seconds per unit
+    of cost) plus max_wait, up to max_wait_cap. Each time a slot is released the
+    estimate is refreshed, so a caller behind one long ingestion is not rejected
+    while that ingestion is still making progress.
+    """
+
+    def __init__(self, name: str, capacity: int, per_user: int, quantum: float = 1.0,
+                 max_queue_per_user: int = ADMISSION_QUEUE_PER_USER, max_queue: int = ADMISSION_QUEUE_SIZE,
+                 max_wait: float = ADMISSION_MAX_WAIT, max_wait_cap: float = ADMISSION_MAX_WAIT_CAP):
+        self.name = name
+        self.capacity = max(1, capacity)
+        self.per_user = max(1, per_user)
+        self.quantum = quantum
+        self.max_queue_per_user = max_queue_per_user
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_wait_cap = max(max_wait, max_wait_cap)
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()  # user -> deque of waiters, in round-robin order
+        self._deficit = {}
+        self._running = Counter()
+        self._in_flight = 0
+        self._waiting = 0
+        self._service_time = 1.0  # EWMA of seconds a slot is held, for Retry-After
+        self._unit_time = 1.0  # EWMA of seconds a slot is held per unit of cost, for queue waits
+        self._running_cost = Counter()
+        self._queued_cost = 0.0
+        self._releases = 0
+        self.counters = Counter()
+        self._wait_total = 0.0
+
+    def _grant(self, waiter: _Waiter):
+        waiter.granted = True
+        self._in_flight += 1
+        self._running[waiter.user] += 1
+        self._running_cost[waiter.user] += waiter.cost
+        waiter.event.set()
+
+    def _dispatch(self):
+        """Hand free slots to queued users by deficit round-robin. Caller holds the lock."""
+        while self._in_flight < self.capacity and self._queues:
+            eligible = [user for user in self._queues if self._running[user] < self.per_user]
+            if not eligible:
+                return
+            # Skip whole rounds in which nobody's deficit would cover its head request
+            rounds = min(
+                max(0, math.ceil((self._queues[user][0].cost - self._deficit[user]) / self.quantum))
+                for user in eligible
+            )
+            for user in eligible:
+                self._deficit[user] += rounds * self.quantum
+            for user in eligible:
+                queue = self._queues[user]
+                if queue[0].cost <= self._deficit[user]:
+                    waiter = queue.popleft()
+                    self._deficit[user] -= waiter.cost
+                    self._waiting -= 1
+                    self._queued_cost -= waiter.cost
+                    if queue:
+                        self._queues.move_to_end(user)
+                    else:
+                        del self._queues[user]
+                        del self._deficit[user]
+                    self._grant(waiter)
+                    break
+
+    def _expected_wait(self, waiter: _Waiter) -> float:
+        """Seconds until the work ahead of a queued waiter should be done. Caller holds the lock."""
+        own = self._running_cost[waiter.user]
+        for queued in self._queues.get(waiter.user, ()):
+            if queued is waiter:
+                break
+            own += queued.cost
+        everyone = sum(self._running_cost.values()) + self._queued_cost - waiter.cost
+        return self._unit_time * max(own / self.per_user, everyone / self.capacity)
+
+    def _deadline(self, waiter: _Waiter) -> float:
+        """Caller holds the lock"""
+        now = time.time()
+        return min(now + self.max_wait + self._expected_wait(waiter), waiter.enqueued + self.max_wait_cap)
+
+    def retry_after(self) -> int:
+        return int(min(60, max(1, math.ceil(self._service_time * (self._waiting + 1) / self.capacity))))
+
+    def acquire(self, user: str, cost: float = 1.0) -> float:
+        """Block until admitted; returns seconds spent waiting"""
+        waiter = _Waiter(user, cost)
+        with self._lock:
+            if self._in_flight < self.capacity and self._running[user] < self.per_user and user not in self._queues:
+                self._grant(waiter)
+                self.counters["admitted"] += 1
+                return 0.0
+            queue = self._queues.get(user)
+            if (queue is not None and len(queue) >= self.max_queue_per_user) or self._waiting >= self.max_queue:
+                self.counters["rejected"] += 1
+                retry_after = self.retry_after()
+                logger.warning(f"Admission queue {self.name} full for user {user}, retry after {retry_after}s")
+                raise AdmissionError(f"Server is busy ({self.name}), please retry shortly", retry_after)
+            if queue is None:
+                queue = self._queues[user] = deque()
+                self._deficit[user] = 0.0
+            queue.append(waiter)
+            self._waiting += 1
+            self._queued_cost += cost
+            self._dispatch()
+            deadline = self._deadline(waiter)
+            releases = self._releases
+
+        while not waiter.event.wait(max(0.0, min(deadline - time.time(), 1.0))):
+            with self._lock:
+                if waiter.granted:
+                    break
+                if self._releases != releases:
+                    # Work ahead finished; expect the rest from now on
+                    releases = self._releases
+                    deadline = max(deadline, self._deadline(waiter))
+                if time.time() >= deadline:
+                    break
+        with self._lock:
+            waited = time.time() - waiter.enqueued
+            if not waiter.granted:
+                queue = self._queues.get(user)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    self._waiting -= 1
+                    self._queued_cost -= waiter.cost
+                    if not queue:
+                        del self._queues[user]
+                        del self._deficit[user]
+                self.counters["timed_out"] += 1
+                retry_after = self.retry_after()
+                raise AdmissionError(f"Timed out waiting for {self.name} capacity", retry_after)
+            self.counters["admitted"] += 1
+            self.counters["queued"] += 1
+            self._wait_total += waited
+            return waited
+
+    def release(self, user: str, held: float, cost: float = 1.0):
+        with self._lock:
+            self._in_flight -= 1
+            self._running[user] -= 1
+            self._running_cost[user] -= cost
+            if self._running[user] <= 0:
+                del self._running[user]
+                del self._running_cost[user]
+            self._service_time = 0.9 * self._service_time + 0.1 * held
+            self._unit_time = 0.9 * self._unit_time + 0.1 * held / max(cost, 1e-6)
+            self._releases += 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, cost: float = 1.0, user: Optional[str] = None):
+        user = user or current_user.get()
+        self.acquire(user, cost)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.release(user, time.time() - start, cost)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            queued = self.counters["queued"]
+            return {
+                "in_flight": self._in_flight,
+                "waiting": self._waiting,
+                "waiting_users": len(self._queues),
+                "capacity": self.capacity,
+                "per_user": self.per_user,
+                "admitted": self.counters["admitted"],
+                "queued": queued,
+                "rejected": self.counters["rejected"],
+                "timed_out": self.counters["timed_out"],
+                "avg_wait_ms": round(self._wait_total / queued * 1000, 2) if queued else 0.0,
+                "avg_service_ms": round(self._service_time * 1000, 2),
+                "ms_per_cost": round(self._unit_time * 1000, 2)
+            }
+
+class AdmittedEmbeddings(Embeddings):
+    """Embeddings wrapper that takes a fair-queue slot per document batch, costed by text count.
+
+    Single query embeddings are not queued here; the scheduler runs them at
+    interactive priority.
+    """
+
+    def __init__(self, model: Embeddings, queue: FairQueue):
+        self.model = model
+        self.queue = queue
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self.queue.slot(cost=max(1, len(texts))):
+            return self.model.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.model.embed_query(text)
+
+llm_queue = FairQueue("llm", ADMISSION_LLM_CONCURRENCY, ADMISSION_LLM_PER_USER)
+embedding_queue = FairQueue("embedding", ADMISSION_EMBED_CONCURRENCY, ADMISSION_EMBED_PER_USER, quantum=32)
+ingest_queue = FairQueue("ingest", ADMISSION_INGEST_CONCURRENCY, ADMISSION_INGEST_PER_USER, quantum=4)  # Cost in MB
+
+def admission_stats() -> Dict[str, Any]:
+    return {queue.name: queue.stats() for queue in (llm_queue, embedding_queue, ingest_queue)}
@@ -0,0 +1,203 @@
+import os
+import re
+import time
+import logging
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+from utils.file_utils import MAX_FILE_SIZE
+from utils.upload_stream import HashingUploadFile, UPLOAD_TEMP_PREFIX, save_upload
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+BLOB_SHARD_DEPTH = int(os.getenv('BLOB_SHARD_DEPTH', 2))  # Directory levels of two hex chars each
+BLOB_GC_GRACE_SECONDS = int(os.getenv('BLOB_GC_GRACE_SECONDS', 3600))
+BLOB_GC_INTERVAL_SECONDS = int(os.getenv('BLOB_GC_INTERVAL_SECONDS', 600))
+BLOB_GC_LEASE_SECONDS = int(os.getenv('BLOB_GC_LEASE_SECONDS', 60))  # A collection claim older than this is abandoned
+BLOB_TEMP_MAX_AGE_SECONDS = int(os.getenv('BLOB_TEMP_MAX_AGE_SECONDS', 3600))  # Leftover .upload_* files are removed after this
+BLOB_ACQUIRE_RETRY_SECONDS = 0.05
+
+BLOB_NAME_PATTERN = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]+$')
+LEGACY_NAME_PATTERN = re.compile(r'^doc_[0-9a-f-]+\.[a-z0-9]+$')
+
+class BlobStore:
+    """Content-addressed upload storage.
+
+    Files are named <sha256>.<ext> and sharded by hash prefix, so identical uploads
+    share one copy. Each document record holds a reference; blobs whose count drops
+    to zero are deleted by collect_garbage after a grace period. Collection first
+    claims the blob's record (a "collecting" lease), and acquire refuses claimed
+    records until the file is gone and the record deleted, so an upload can never
+    reuse a file that is about to be unlinked. Legacy flat doc_<uuid>.<ext> files in
+    the root are still resolved.
+    """
+
+    def __init__(self, root: str, collection):
+        self.root = root
+        self.collection = collection
+        self._last_gc = 0.0
+        self._gc_lock = threading.Lock()
+        self.removal_hooks = []  # Called with the blob name after garbage collection deletes it
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def blob_name(file_hash: str, ext: str) -> str:
+        return f"{file_hash}.{ext.lower()}"
+
+    @staticmethod
+    def is_valid_name(name: str) -> bool:
+        return bool(BLOB_NAME_PATTERN.match(name) or LEGACY_NAME_PATTERN.match(name))
+
+    @staticmethod
+    def hash_of(name: str) -> str:
+        """Content hash for blob names, None for legacy files"""
+        return name.split('.', 1)[0] if BLOB_NAME_PATTERN.match(name) else None
+
+    def path_for(self, name: str) -> str:
+        if not BLOB_NAME_PATTERN.match(name):
+            return os.path.join(self.root, name)
+        shards = [name[i * 2:i * 2 + 2] for i in range(BLOB_SHARD_DEPTH)]
+        return os.path.join(self.root, *shards, name)
+
+    def exists(self, name: str) -> bool:
+        return self.is_valid_name(name) and os.path.exists(self.path_for(name))
+
+    def put_upload(self, file_storage, ext: str, max_size: int = MAX_FILE_SIZE):
+        """Store an uploaded file and take a reference on it. Returns (name, size, sha256)."""
+        stream = file_storage.stream
+        if isinstance(stream, HashingUploadFile):
+            size, file_hash = stream.size, stream.sha256
+            temp_path = None
+        else:
+            fd, temp_path = tempfile.mkstemp(dir=self.root, prefix=UPLOAD_TEMP_PREFIX)
+            os.close(fd)
+            size, file_hash = save_upload(file_storage, temp_path, max_size)
+
+        name = self.blob_name(file_hash, ext)
+        # Reference first so a concurrent collect_garbage cannot claim the blob
+        self.acquire(name, size=size)
+        dest_path = self.path_for(name)
+        if os.path.exists(dest_path):
+            if temp_path:
+                os.remove(temp_path)
+            else:
+                stream.discard()
+            logger.info(f"Blob {name} already stored, reusing it")
+        else:
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            if temp_path:
+                os.replace(temp_path, dest_path)
+            else:
+                stream.commit(dest_path)
+            logger.info(f"Stored new blob {name} ({size} bytes)")
+        return name, size, file_hash
+
+    def acquire(self, name: str, size: int = None):
+        update = {"$inc": {"refs": 1}, "$setOnInsert": {"created_at": datetime.utcnow()}, "$unset": {"collecting": ""}}
+        if size is not None:
+            update["$set"] = {"size": size}
+        while True:
+            # A record being collected does not match, so the upsert collides with it until collection is done
+            abandoned = datetime.utcnow() - timedelta(seconds=BLOB_GC_LEASE_SECONDS)
+            try:
+                self.collection.update_one(
+                    {"_id": name, "$or": [{"collecting": {"$exists": False}}, {"collecting": {"$lt": abandoned}}]},
+                    update,
+                    upsert=True
+                )
+                return
+            except DuplicateKeyError:
+                time.sleep(BLOB_ACQUIRE_RETRY_SECONDS)
+
+    def release(self, name: str):
+        if not name or not BLOB_NAME_PATTERN.match(name):
+            return
+        self.collection.update_one(
+            {"_id": name},
+            {"$inc": {"refs": -1}, "$set": {"last_released": datetime.utcnow()}}
+        )
+
+    def collect_garbage(self) -> int:
+        """Delete unreferenced blobs older than the grace period, and abandoned upload temp files"""
+        now = datetime.utcnow()
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)  # BSON dates keep milliseconds; the claim is matched by value
+        cutoff = now - timedelta(seconds=BLOB_GC_GRACE_SECONDS)
+        abandoned = now - timedelta(seconds=BLOB_GC_LEASE_SECONDS)
+        removed = 0
+        candidates = self.collection.find(
+            {"refs": {"$lte": 0}, "last_released": {"$lt": cutoff}},
+            {"_id": 1}
+        )
+        for record in candidates:
+            name = record["_id"]
+            # Claim while still unreferenced; from here on acquire waits instead of taking a reference
+            claimed = self.collection.find_one_and_update(
+                {
+                    "_id": name, "refs": {"$lte": 0}, "last_released": {"$lt": cutoff},
+                    "$or": [{"collecting": {"$exists": False}}, {"collecting": {"$lt": abandoned}}]
+                },
+                {"$set": {"collecting": now}}
+            )
+            if not claimed:
+                continue
+            path = self.path_for(name)
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError as e:
+                logger.error(f"Failed to remove blob {name}: {str(e)}")
+                self.collection.update_one({"_id": name, "collecting": now}, {"$unset": {"collecting": ""}})
+                continue
+            # Derived data (previews, stored text) goes before the claim is released to new uploads
+            for hook in self.removal_hooks:
+                try:
+                    hook(name)
+                except Exception as e:
+                    logger.error(f"Blob removal hook failed for {name}: {str(e)}")
+            self.collection.delete_one({"_id": name, "collecting": now})
+            removed += 1
+        removed_temps = self._sweep_temp_files()
+        if removed or removed_temps:
+            logger.info(f"Blob garbage collection removed {removed} file(s) and {removed_temps} abandoned upload(s)")
+        return removed
+
+    def _sweep_temp_files(self) -> int:
+        """Remove upload temp files left behind by crashed or killed requests"""
+        cutoff = time.time() - BLOB_TEMP_MAX_AGE_SECONDS
+        removed = 0
+        try:
+            entries = list(os.scandir(self.root))
+        except OSError as e:
+            logger.error(f"Failed to scan {self.root} for upload temp files: {str(e)}")
+            return 0
+        for entry in entries:
+            if not entry.name.startswith(UPLOAD_TEMP_PREFIX) or not entry.is_file(follow_symlinks=False):
+                continue
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Failed to remove upload temp file {entry.name}: {str(e)}")
+        return removed
+
+    def maybe_collect_garbage(self):
+        """Run collect_garbage in the background at most once per interval"""
+        now = time.time()
+        if now - self._last_gc < BLOB_GC_INTERVAL_SECONDS or not self._gc_lock.acquire(blocking=False):
+            return
+        self._last_gc = now
+
+        def run():
+            try:
+                self.collect_garbage()
+            except Exception as e:
+                logger.error(f"Blob garbage collection failed: {str(e)}", exc_info=True)
+            finally:
+                self._gc_lock.release()
+
+        threading.Thread(target=run, name="blob-gc", daemon=True).start()
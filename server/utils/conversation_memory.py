@@ -0,0 +1,178 @@
+import os
+import re
+import logging
+import numpy as np
+from bson import Binary
+from pymongo import UpdateOne
+from typing import List, Dict, Any, Optional, Callable
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+MEMORY_RECENT_TURNS = int(os.getenv("MEMORY_RECENT_TURNS", 2))  # Turns always included, newest last
+MEMORY_RELEVANT_TURNS = int(os.getenv("MEMORY_RELEVANT_TURNS", 2))  # Older turns picked by similarity
+MEMORY_MIN_SIMILARITY = float(os.getenv("MEMORY_MIN_SIMILARITY", 0.35))
+MEMORY_MAX_TURNS = int(os.getenv("MEMORY_MAX_TURNS", 12))  # Turns kept with embeddings; older ones live in the summary only
+MEMORY_TURN_CHARS = int(os.getenv("MEMORY_TURN_CHARS", 600))
+MEMORY_SUMMARY_MAX_CHARS = int(os.getenv("MEMORY_SUMMARY_MAX_CHARS", 1500))
+
+SENTENCE_END = re.compile(r'(?<=[.!?])\s')
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join((text or "").split())
+    return text if len(text) <= limit else text[:limit].rsplit(" ", 1)[0] + "..."
+
+def _summary_line(turn: Dict[str, Any]) -> str:
+    """One line per turn: the question and the first sentence of the answer"""
+    answer = SENTENCE_END.split(" ".join(turn["response"].split()), 1)[0]
+    return f"- Asked: {_clip(turn['query'], 150)} | Answered: {_clip(answer, 200)}"
+
+def _pack(vector) -> Binary:
+    """float16 bytes: a quarter of the BSON size of a list of doubles, plenty for turn similarity"""
+    return Binary(np.asarray(vector, dtype=np.float16).tobytes())
+
+def _unpack(embedding) -> np.ndarray:
+    if isinstance(embedding, bytes):
+        return np.frombuffer(embedding, dtype=np.float16).astype(np.float32)
+    return np.asarray(embedding, dtype=np.float32)  # Lists written before packing
+
+def format_recent_history(chat_history: List[Dict], turns: int = MEMORY_RECENT_TURNS) -> str:
+    """Bounded fallback for callers without a memory: the last few entries, clipped"""
+    entries = chat_history[-turns * 2:] if turns else []
+    return "\n".join(f"{entry['type'].upper()}: {_clip(entry['content'], MEMORY_TURN_CHARS)}" for entry in entries)
+
+class ConversationMemory:
+    """Per-chat memory that keeps prompts bounded as a conversation grows.
+
+    The memory is a plain dict stored on the chat session. The last
+    MEMORY_MAX_TURNS turns are kept (clipped) with a float16 embedding of the
+    question and answer; when a turn leaves the recent window a one-line extract is
+    appended to a rolling summary capped at MEMORY_SUMMARY_MAX_CHARS. The prompt
+    gets the summary, the older turns most similar to the current question and the
+    most recent turns. A new turn is stored without its embedding; embed_operation
+    computes it in the turn writer, off the response path.
+    """
+
+    def __init__(self, embedding_model):
+        self.embedding_model = embedding_model
+
+    @staticmethod
+    def empty() -> Dict[str, Any]:
+        return {"summary": [], "summary_dropped": 0, "turns": [], "turn_count": 0}
+
+    @staticmethod
+    def _turn_text(query: str, response: str) -> str:
+        return f"{query}\n{_clip(response, MEMORY_TURN_CHARS)}"
+
+    def _append(self, memory: Dict[str, Any], query: str, response: str, embedding) -> Dict[str, Any]:
+        turns = memory["turns"]
+        turns.append({
+            "query": _clip(query, MEMORY_TURN_CHARS),
+            "response": _clip(response, MEMORY_TURN_CHARS),
+            "embedding": _pack(embedding) if embedding is not None and len(embedding) else None,
+            "index": memory["turn_count"]
+        })
+        memory["turn_count"] += 1
+
+        # The turn that just left the recent window joins the rolling summary
+        if len(turns) > MEMORY_RECENT_TURNS:
+            memory["summary"].append(_summary_line(turns[-MEMORY_RECENT_TURNS - 1]))
+            while len(memory["summary"]) > 1 and sum(len(line) + 1 for line in memory["summary"]) > MEMORY_SUMMARY_MAX_CHARS:
+                memory["summary"].pop(0)
+                memory["summary_dropped"] += 1
+        if len(turns) > MEMORY_MAX_TURNS:
+            del turns[:len(turns) - MEMORY_MAX_TURNS]
+        return memory
+
+    def update(self, memory: Optional[Dict[str, Any]], query: str, response: str) -> Dict[str, Any]:
+        """Add one question/answer turn, not embedded yet; returns the memory to store on the chat session"""
+        return self._append(memory or self.empty(), query, response or "", None)
+
+    def embed_operation(self, session_filter: Dict[str, Any], memory: Dict[str, Any]) -> Callable[[], Optional[UpdateOne]]:
+        """Deferred write embedding the newest turn, for the turn writer; submit it after the memory itself"""
+        turn = memory["turns"][-1]
+        text = self._turn_text(turn["query"], turn["response"])
+        index = turn["index"]
+
+        def operation() -> Optional[UpdateOne]:
+            try:
+                vector = self.embedding_model.embed_query(text)
+            except Exception as e:
+                logger.error(f"Failed to embed conversation turn: {str(e)}")
+                return None
+            # Matches nothing once a newer memory has dropped the turn
+            return UpdateOne(
+                {**session_filter, "memory.turns.index": index},
+                {"$set": {"memory.turns.$.embedding": _pack(vector)}}
+            )
+        return operation
+
+    def from_history(self, chat_history: List[Dict]) -> Dict[str, Any]:
+        """Build a memory for a chat that predates it, embedding all turns in one batch"""
+        pairs = []
+        pending_query = None
+        for entry in chat_history:
+            if entry.get("type") == "user":
+                pending_query = entry.get("content", "")
+            elif entry.get("type") == "response" and pending_query is not None:
+                pairs.append((pending_query, entry.get("content") or ""))
+                pending_query = None
+
+        memory = self.empty()
+        if not pairs:
+            return memory
+        # Turns that will only survive in the summary do not need embeddings
+        embedded_from = max(0, len(pairs) - MEMORY_MAX_TURNS)
+        try:
+            vectors = self.embedding_model.embed_documents(
+                [self._turn_text(query, response) for query, response in pairs[embedded_from:]]
+            )
+        except Exception as e:
+            logger.error(f"Failed to embed chat history: {str(e)}")
+            vectors = [None for _ in pairs[embedded_from:]]
+        vectors = [None for _ in range(embedded_from)] + list(vectors)
+        for (query, response), vector in zip(pairs, vectors):
+            self._append(memory, query, response, vector)
+        logger.info(f"Built conversation memory from {len(pairs)} existing turns")
+        return memory
+
+    def select_turns(self, memory: Dict[str, Any], query_vector) -> List[Dict[str, Any]]:
+        """Older turns (outside the recent window) most similar to the query, in chat order"""
+        older = [turn for turn in memory["turns"][:-MEMORY_RECENT_TURNS or None] if turn.get("embedding")]
+        if not older or query_vector is None or MEMORY_RELEVANT_TURNS <= 0:
+            return []
+        vectors = [_unpack(turn["embedding"]) for turn in older]
+        query = np.asarray(query_vector, dtype=np.float32)
+        if any(vector.shape != query.shape for vector in vectors):
+            return []
+        matrix = np.stack(vectors)
+        scores = matrix @ query / np.maximum(np.linalg.norm(matrix, axis=1) * np.linalg.norm(query), 1e-12)
+        best = [i for i in np.argsort(-scores)[:MEMORY_RELEVANT_TURNS] if scores[i] >= MEMORY_MIN_SIMILARITY]
+        return [older[i] for i in sorted(best)]
+
+    def context(self, memory: Dict[str, Any], query: str, query_vector=None) -> str:
+        """Prompt section for the conversation so far; size is bounded regardless of chat length"""
+        if not memory or not memory.get("turns"):
+            return ""
+        if query_vector is None:
+            query_vector = self.embedding_model.embed_query(query)
+
+        parts = []
+        if memory["summary"]:
+            header = "CONVERSATION SUMMARY"
+            if memory["summary_dropped"]:
+                header += f" ({memory['summary_dropped']} earlier turns omitted)"
+            parts.append(f"{header}:\n" + "\n".join(memory["summary"]))
+
+        relevant = self.select_turns(memory, query_vector)
+        if relevant:
+            parts.append("RELATED EARLIER EXCHANGES:\n" + "\n".join(
+                f"USER: {turn['query']}\nRESPONSE: {turn['response']}" for turn in relevant
+            ))
+
+        recent = memory["turns"][-MEMORY_RECENT_TURNS:] if MEMORY_RECENT_TURNS else []
+        if recent:
+            parts.append("PREVIOUS CONVERSATION:\n" + "\n".join(
+                f"USER: {turn['query']}\nRESPONSE: {turn['response']}" for turn in recent
+            ))
+        return "\n\n".join(parts)
@@ -6,7 +6,12 @@ import os  # Import os for environment variable access
 load_dotenv()
 
 # Initialize MongoDB client with connection string from environment variable
-client = MongoClient(os.getenv("MONGO_URI"))
+MONGO_URI = os.getenv("MONGO_URI")
+if MONGO_URI and MONGO_URI.startswith("mongomock://"):
+    import mongomock  # In-memory stand-in for the load-test harness and tests; not needed in production (pip install mongomock)
+    client = mongomock.MongoClient()
+else:
+    client = MongoClient(MONGO_URI)
 
 # Connect to the "InsightPaper" database
 db = client.get_database("InsightPaper")
@@ -15,4 +20,7 @@ db = client.get_database("InsightPaper")
 users_collection = db["users"]  # Collection for user data
 documents_collection = db["documents"]  # Collection for document data
 chat_sessions_collection = db["chat_sessions"]  # Collection for chat session data
-queries_collection = db["queries"]  # Collection for query data
\ No newline at end of file
+queries_collection = db["queries"]  # Collection for query data
+blobs_collection = db["blobs"]  # Collection for upload blob reference counts
+image_summaries_collection = db["image_summaries"]  # Collection for perceptual-hash image summary cache
+document_texts_collection = db["document_texts"]  # Collection for compressed extracted text, keyed by file hash
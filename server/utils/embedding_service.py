@@ -0,0 +1,134 @@
+import os
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, Any, List
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+EMBED_SERVICE_MAX_BATCH = int(os.getenv("EMBED_SERVICE_MAX_BATCH", 32))  # Queries per model call
+EMBED_SERVICE_MAX_WAIT_MS = float(os.getenv("EMBED_SERVICE_MAX_WAIT_MS", 2))  # How long a batch waits for company
+EMBED_SERVICE_CACHE_SIZE = int(os.getenv("EMBED_SERVICE_CACHE_SIZE", 1024))  # Recent query vectors kept
+EMBED_SERVICE_TIMEOUT = float(os.getenv("EMBED_SERVICE_TIMEOUT", 30))  # Seconds a caller waits for its vector
+
+class EmbeddingService(Embeddings):
+    """Micro-batching front for query embeddings.
+
+    embed_query puts the text on a queue and waits on a future. One dispatcher
+    thread takes whatever is queued (up to EMBED_SERVICE_MAX_BATCH, waiting at most
+    EMBED_SERVICE_MAX_WAIT_MS for more) and embeds it with a single embed_documents
+    call, so concurrent queries share one model call instead of contending for it.
+    Identical texts in flight share a future, and recent vectors are kept in an LRU.
+    Document batches pass straight through.
+    """
+
+    def __init__(self, model: Embeddings, max_batch: int = EMBED_SERVICE_MAX_BATCH,
+                 max_wait_ms: float = EMBED_SERVICE_MAX_WAIT_MS, cache_size: int = EMBED_SERVICE_CACHE_SIZE):
+        self.model = model
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.cache_size = cache_size
+        self._queue = queue.Queue()
+        self._cache = OrderedDict()
+        self._in_flight = {}  # text -> Future
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.counters = {"requests": 0, "cache_hits": 0, "shared": 0, "batches": 0, "embedded": 0, "failed": 0}
+        self._batch_max = 0
+        self._latency_total = 0.0
+
+    def _ensure_thread(self):
+        # Started lazily, and again in a forked worker process
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="embedding-service", daemon=True)
+            self._thread.start()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.model.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        start = time.time()
+        with self._lock:
+            self.counters["requests"] += 1
+            vector = self._cache.get(text)
+            if vector is not None:
+                self._cache.move_to_end(text)
+                self.counters["cache_hits"] += 1
+                return list(vector)
+            future = self._in_flight.get(text)
+            if future is None:
+                self._ensure_thread()
+                future = self._in_flight[text] = Future()
+                self._queue.put(text)
+            else:
+                self.counters["shared"] += 1
+        vector = future.result(timeout=EMBED_SERVICE_TIMEOUT)
+        with self._lock:
+            self._latency_total += time.time() - start
+        return list(vector)
+
+    def _next_batch(self) -> List[str]:
+        texts = [self._queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(texts) < self.max_batch:
+            try:
+                # Anything queued while the previous batch ran is taken without waiting
+                texts.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                texts.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return texts
+
+    def _run(self):
+        while True:
+            texts = self._next_batch()
+            try:
+                vectors = self.model.embed_documents(texts)
+                error = None
+            except Exception as e:
+                logger.error(f"Embedding batch of {len(texts)} queries failed: {str(e)}")
+                vectors, error = None, e
+            with self._lock:
+                self.counters["batches"] += 1
+                self._batch_max = max(self._batch_max, len(texts))
+                futures = [self._in_flight.pop(text) for text in texts]
+                if error is None:
+                    self.counters["embedded"] += len(texts)
+                    for text, vector in zip(texts, vectors):
+                        self._cache[text] = vector
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+                else:
+                    self.counters["failed"] += len(texts)
+            for index, future in enumerate(futures):
+                if error is None:
+                    future.set_result(vectors[index])
+                else:
+                    future.set_exception(error)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            batches = self.counters["batches"]
+            waited = self.counters["requests"] - self.counters["cache_hits"]
+            return {
+                **self.counters,
+                "queued": self._queue.qsize(),
+                "cached": len(self._cache),
+                "avg_batch": round(self.counters["embedded"] / batches, 2) if batches else 0.0,
+                "max_batch": self._batch_max,
+                "avg_latency_ms": round(self._latency_total / waited * 1000, 2) if waited else 0.0
+            }
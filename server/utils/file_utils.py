@@ -46,20 +46,6 @@ def validate_file_size(file_stream):
         raise FileProcessingError(f"File size exceeds {MAX_FILE_SIZE/1024/1024}MB limit")
     return size
 
-def extract_text_from_pdf(file_stream):
-    """Extract text from PDF using pdfplumber"""
-    try:
-        validate_file_size(file_stream)
-        with pdfplumber.open(file_stream) as pdf:
-            text = ""
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                text += page_text or ""
-            return text
-    except Exception as e:
-        logger.error(f"PDF read error: {str(e)}")
-        raise FileProcessingError(f"Failed to read PDF: {str(e)}")
-
 def extract_text_from_docx(file_stream):
     """Extract text from DOCX using python-docx"""
     try:
@@ -117,8 +103,8 @@ def extract_docx_metadata(file_path: str) -> dict:
     
     return metadata
 
-def extract_pdf_metadata(file_path: str) -> dict:
-    """Extract metadata from PDF files"""
+def extract_pdf_metadata(file_path: str, extraction: dict = None) -> dict:
+    """Extract metadata from PDF files, reusing an extract_pdf result when given"""
     metadata = {
         "title": os.path.basename(file_path),
         "author": "Unknown",
@@ -131,6 +117,8 @@ def extract_pdf_metadata(file_path: str) -> dict:
         "total_pages": 0,
         "sections": []
     }
+    if extraction is not None:
+        return _pdf_metadata_from_extraction(metadata, extraction)
     try:
         with pdfplumber.open(file_path) as pdf:
             metadata["total_pages"] = len(pdf.pages)
@@ -165,6 +153,30 @@ def extract_pdf_metadata(file_path: str) -> dict:
     
     return metadata
 
+def _pdf_metadata_from_extraction(metadata: dict, extraction: dict) -> dict:
+    """Fill PDF metadata from counts gathered during text extraction"""
+    info = extraction.get("info") or {}
+    metadata.update({
+        "title": info.get('Title') or metadata['title'],
+        "author": info.get('Author') or metadata['author'],
+        "keywords": info.get('Keywords') or metadata['keywords'],
+        "subject": info.get('Subject') or metadata['subject'],
+        "total_pages": extraction["total_pages"],
+        "image_count": extraction["image_count"],
+        "figure_count": extraction["figure_count"],
+        "table_count": extraction["table_count"],
+        "extraction_backend": extraction["backend"]
+    })
+
+    first_page_text = extraction["pages"][0] if extraction["pages"] else ""
+    metadata["is_research"] = any(
+        re.search(pattern, first_page_text, re.IGNORECASE)
+        for pattern in [r'abstract', r'introduction', r'methodology', r'references']
+    )
+    section_matches = re.findall(r'^(?:[1-9]\.\s+)?([A-Z][A-Za-z\s]+?)\s*$', first_page_text, re.MULTILINE)
+    metadata["sections"] = [s.strip() for s in section_matches if len(s.strip()) > 5]
+    return metadata
+
 def extract_metadata(file_path: str) -> dict:
     """Extract metadata based on file type"""
     if file_path.endswith('.pdf'):
@@ -0,0 +1,119 @@
+import os
+import time
+import secrets
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+GUEST_CACHE_TTL = int(os.getenv("GUEST_CACHE_TTL", 1800))  # Seconds from upload; not extended by use
+GUEST_CACHE_MAX_BYTES = int(os.getenv("GUEST_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+GUEST_CACHE_MAX_PER_TOKEN = int(os.getenv("GUEST_CACHE_MAX_PER_TOKEN", 4))  # Documents per guest session
+
+GUEST_TOKEN_BYTES = 24
+CHUNK_OVERHEAD_BYTES = 1024  # Document object and its metadata dict, beyond the text itself
+
+def new_guest_token() -> str:
+    return secrets.token_urlsafe(GUEST_TOKEN_BYTES)
+
+def is_valid_guest_token(token: Optional[str]) -> bool:
+    return bool(token) and 16 <= len(token) <= 64 and token.replace("-", "").replace("_", "").isalnum()
+
+def _estimate_size(documents: List[Any], metadata: Dict[str, Any], vector_store) -> int:
+    """Rough resident size: chunks and the FAISS index"""
+    size = 0
+    for doc in documents or []:
+        size += len(doc.page_content) + CHUNK_OVERHEAD_BYTES
+    if vector_store is not None:
+        size += vector_store.index.ntotal * vector_store.index.d * 4
+    return size
+
+class GuestCache:
+    """In-memory working set of documents processed for guests.
+
+    Guests have no documents record, so without this every follow-up question
+    re-uploads and re-ingests the file. Entries are keyed by (guest token, file
+    hash), so one guest cannot read another's document, and hold the chunks,
+    metadata and FAISS store. Each entry expires GUEST_CACHE_TTL seconds after it
+    was stored; the total is capped at GUEST_CACHE_MAX_BYTES by evicting the least
+    recently used entries.
+    """
+
+    def __init__(self, ttl: int = GUEST_CACHE_TTL, max_bytes: int = GUEST_CACHE_MAX_BYTES,
+                 max_per_token: int = GUEST_CACHE_MAX_PER_TOKEN):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_per_token = max(1, max_per_token)
+        self._entries = OrderedDict()  # (token, file_hash) -> entry, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "stored": 0, "expired": 0, "evicted": 0, "rejected": 0}
+
+    def _drop(self, key, reason: str):
+        entry = self._entries.pop(key)
+        self._bytes -= entry["size"]
+        self.counters[reason] += 1
+
+    def _purge_expired(self, now: float):
+        for key in [key for key, entry in self._entries.items() if entry["expires_at"] <= now]:
+            self._drop(key, "expired")
+
+    def get(self, token: str, file_hash: str) -> Optional[Dict[str, Any]]:
+        """Cached entry with documents, metadata and vector_store, or None when missing or expired"""
+        if not token or not file_hash:
+            return None
+        with self._lock:
+            self._purge_expired(time.time())
+            entry = self._entries.get((token, file_hash))
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end((token, file_hash))
+            self.counters["hits"] += 1
+            return entry
+
+    def put(self, token: str, file_hash: str, documents: List[Any], metadata: Dict[str, Any], vector_store) -> bool:
+        if not token or not file_hash:
+            return False
+        # Guest chunks are never written to the database, and FAISS holds the vectors; a list
+        # of Python floats costs about 32 bytes per dimension, four times the index itself
+        for doc in documents or []:
+            doc.metadata.pop("embedding", None)
+        size = _estimate_size(documents, metadata, vector_store)
+        if size > self.max_bytes:
+            self.counters["rejected"] += 1
+            logger.info(f"Guest document {file_hash} too large to cache ({size} bytes)")
+            return False
+        now = time.time()
+        with self._lock:
+            self._purge_expired(now)
+            key = (token, file_hash)
+            if key in self._entries:
+                self._drop(key, "evicted")
+            # A guest session keeps only its most recent documents
+            owned = [other for other in self._entries if other[0] == token]
+            for other in owned[:max(0, len(owned) - self.max_per_token + 1)]:
+                self._drop(other, "evicted")
+            while self._entries and self._bytes + size > self.max_bytes:
+                self._drop(next(iter(self._entries)), "evicted")
+            self._entries[key] = {
+                "documents": documents,
+                "metadata": metadata,
+                "vector_store": vector_store,
+                "size": size,
+                "expires_at": now + self.ttl
+            }
+            self._bytes += size
+            self.counters["stored"] += 1
+        logger.info(f"Cached guest document {file_hash} ({size} bytes) for {self.ttl}s")
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._purge_expired(time.time())
+            return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes, **self.counters}
+
+guest_cache = GuestCache()
@@ -0,0 +1,71 @@
+import os
+import gzip
+import hashlib
+import logging
+from flask import request, Response
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+try:
+    import brotli
+except ImportError:  # Optional (pip install brotli); gzip is used without it
+    brotli = None
+
+# Configuration
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", 1024))  # Smaller bodies are sent as-is
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", 6))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", 5))
+COMPRESSIBLE_MIMETYPES = {"application/json", "text/plain", "text/html", "text/css", "application/javascript"}
+
+def make_etag(*parts: Any) -> str:
+    """Opaque tag from the given version fields; sent weak so it survives content encoding"""
+    return hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:20]
+
+def with_etag(response, etag: str, cache_control: str = "private, no-cache"):
+    """Attach the validator; no-cache makes clients revalidate with If-None-Match on every use"""
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = cache_control
+    return response
+
+def not_modified(etag: str, cache_control: str = "private, no-cache"):
+    """304 response when the request's If-None-Match matches etag, else None"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    return with_etag(Response(status=304), etag, cache_control)
+
+def _encoding_for(accept_encoding) -> str:
+    if brotli is not None and accept_encoding["br"]:
+        return "br"
+    if accept_encoding["gzip"]:
+        return "gzip"
+    return None
+
+def compress_response(response):
+    """after_request hook: brotli (when installed) or gzip for large, buffered text responses"""
+    if (
+        response.status_code != 200
+        or response.direct_passthrough  # Files and ranges are streamed from disk
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = _encoding_for(request.accept_encodings)
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+
+    if encoding == "br":
+        compressed = brotli.compress(body, quality=COMPRESS_BROTLI_QUALITY)
+    else:
+        compressed = gzip.compress(body, compresslevel=COMPRESS_GZIP_LEVEL)
+    if len(compressed) >= len(body):
+        return response
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    logger.debug(f"Compressed {request.path} with {encoding}: {len(body)} -> {len(compressed)} bytes")
+    return response
@@ -2,10 +2,14 @@ import os
 import base64
 import logging
 import requests
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from io import BytesIO
 from PIL import Image
 from dotenv import load_dotenv
+from typing import Optional
+from utils.admission import llm_queue, AdmissionError, current_user
 
 # Configure logger for the image_utils module
 logger = logging.getLogger(__name__)
@@ -20,6 +24,11 @@ TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY", "your_key_here")
 # Updated URL - replace with the correct endpoint from TogetherAI's documentation
 TOGETHER_API_URL = os.getenv("TOGETHER_API_URL", "https://api.together.xyz/v1/vision/completions")
 LLAMA_VISION_MODEL = os.getenv("LLAMA_VISION_MODEL", "meta-llama/Llama-3.3-70B-Vision-Free")
+VISION_MAX_DIM = int(os.getenv('VISION_MAX_DIM', 1120))  # Longest side sent to the vision model
+VISION_JPEG_QUALITY = int(os.getenv('VISION_JPEG_QUALITY', 85))
+PHASH_SIZE = 8  # 8x8 gradient grid -> 64-bit hash
+IMAGE_SUMMARY_CACHE_SIZE = int(os.getenv('IMAGE_SUMMARY_CACHE_SIZE', 512))
+IMAGE_PHASH_MAX_DISTANCE = int(os.getenv('IMAGE_PHASH_MAX_DISTANCE', 4))  # Max differing bits for a cache hit
 
 # Custom exception for image processing errors
 class ImageProcessingError(Exception):
@@ -49,28 +58,147 @@ def validate_image(file_stream):
         logger.error(f"Invalid image file: {str(e)}")
         raise ImageProcessingError(f"Invalid image file: {str(e)}")
 
-# Function to encode image to base64
-def encode_image_to_base64(file_stream):
-    """Convert image to base64 string"""
+# Function to compute a perceptual (difference) hash of a decoded image
+def perceptual_hash(img) -> str:
+    """64-bit dHash: stable across re-encoding, resizing and small edits"""
+    small = img.convert('L').resize((PHASH_SIZE + 1, PHASH_SIZE), Image.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(PHASH_SIZE):
+        for col in range(PHASH_SIZE):
+            left = pixels[row * (PHASH_SIZE + 1) + col]
+            right = pixels[row * (PHASH_SIZE + 1) + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    return f"{bits:016x}"
+
+# Function to decode, downscale and re-encode an image in one pass
+def prepare_image(file_stream):
+    """Decode once, shrink to the vision model's input size and return (data_url, phash)"""
+    file_stream.seek(0, os.SEEK_END)
+    size = file_stream.tell()
+    file_stream.seek(0)
+    if size > MAX_IMAGE_SIZE:
+        raise ImageProcessingError(f"Image size exceeds {MAX_IMAGE_SIZE/1024/1024}MB limit")
+
     try:
-        validate_image(file_stream)
         img = Image.open(file_stream)
+        # JPEG can decode directly at a reduced scale, skipping most of the work
+        img.draft('RGB', (VISION_MAX_DIM, VISION_MAX_DIM))
+        img.load()  # Full decode doubles as the integrity check
+    except Exception as e:
+        logger.error(f"Invalid image file: {str(e)}")
+        raise ImageProcessingError(f"Invalid image file: {str(e)}")
+
+    try:
+        phash = perceptual_hash(img)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail((VISION_MAX_DIM, VISION_MAX_DIM), Image.LANCZOS)
+
         buffered = BytesIO()
-        img_format = img.format if img.format else 'PNG'
-        img.save(buffered, format=img_format)
-        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
+        img.save(buffered, format='JPEG', quality=VISION_JPEG_QUALITY, optimize=True)
         file_stream.seek(0)
-        return f"data:image/{img_format.lower()};base64,{img_str}"
+        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
+        logger.info(f"Prepared image {img.size[0]}x{img.size[1]}: {size} bytes -> {buffered.tell()} bytes JPEG")
+        return f"data:image/jpeg;base64,{img_str}", phash
     except Exception as e:
         logger.error(f"Error encoding image: {str(e)}")
         raise ImageProcessingError(f"Failed to encode image: {str(e)}")
 
+# Function to encode image to base64
+def encode_image_to_base64(file_stream):
+    """Convert image to a downscaled base64 JPEG data URL"""
+    return prepare_image(file_stream)[0]
+
+def _hamming(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+class ImageSummaryCache:
+    """Summaries keyed by perceptual hash and query, so near-duplicate images skip the API.
+
+    Near matches (Hamming distance) are only served to the owner of the original
+    image; other users get a cached summary only for byte-identical content (same
+    content hash). An in-process LRU answers both; the image_summaries collection
+    persists exact hashes across restarts and workers.
+    """
+
+    def __init__(self, max_entries: int = 512, max_distance: int = 4):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self._entries = OrderedDict()  # (owner, phash, query) -> (summary, content_hash)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    def get(self, phash: str, query: str, owner: str, content_hash: Optional[str] = None):
+        query_key = self._normalize(query)
+        with self._lock:
+            for key, (summary, stored_hash) in reversed(self._entries.items()):
+                if key[2] != query_key:
+                    continue
+                if (key[0] == owner and _hamming(key[1], phash) <= self.max_distance) or \
+                        (content_hash and stored_hash == content_hash):
+                    self._entries.move_to_end(key)
+                    return summary
+        lookups = [{"owner": owner, "phash": phash, "query": query_key}]
+        if content_hash:
+            lookups.append({"content_hash": content_hash, "query": query_key})
+        try:
+            from utils.db import image_summaries_collection
+            record = image_summaries_collection.find_one({"$or": lookups})
+        except Exception as e:
+            logger.warning(f"Image summary cache lookup failed: {str(e)}")
+            record = None
+        if record:
+            self._remember(owner, phash, query_key, record["summary"], record.get("content_hash"))
+            return record["summary"]
+        return None
+
+    def put(self, phash: str, query: str, summary: str, owner: str, content_hash: Optional[str] = None):
+        query_key = self._normalize(query)
+        self._remember(owner, phash, query_key, summary, content_hash)
+        try:
+            from utils.db import image_summaries_collection
+            image_summaries_collection.update_one(
+                {"owner": owner, "phash": phash, "query": query_key},
+                {"$set": {"summary": summary, "content_hash": content_hash, "created_at": datetime.utcnow()}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"Image summary cache write failed: {str(e)}")
+
+    def _remember(self, owner: str, phash: str, query_key: str, summary: str, content_hash: Optional[str]):
+        key = (owner, phash, query_key)
+        with self._lock:
+            self._entries[key] = (summary, content_hash)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+image_summary_cache = ImageSummaryCache(IMAGE_SUMMARY_CACHE_SIZE, IMAGE_PHASH_MAX_DISTANCE)
+
 # Function to summarize image using TogetherAI's Llama-vision-free model
-def summarize_image(file_stream, query: str = "Summarize the content of this image"):
-    """Summarize image content using Llama-vision-free model"""
+def summarize_image(file_stream, query: str = "Summarize the content of this image", content_hash: Optional[str] = None):
+    """Summarize image content using Llama-vision-free model.
+
+    Pass the upload's content hash so an identical image summarized for another
+    user can be reused; near duplicates are only reused for the same user.
+    """
+    owner = current_user.get()
     try:
-        # Encode image to base64
-        base64_image = encode_image_to_base64(file_stream)
+        # Decode, downscale and fingerprint the image in one pass
+        base64_image, phash = prepare_image(file_stream)
+        cached_summary = image_summary_cache.get(phash, query, owner, content_hash)
+        if cached_summary:
+            logger.info(f"Image summary cache hit for phash {phash}")
+            return cached_summary
         
         # Prepare API request
         headers = {
@@ -93,7 +221,8 @@ def summarize_image(file_stream, query: str = "Summarize the content of this ima
         }
         
         # Make API call
-        response = requests.post(TOGETHER_API_URL, json=data, headers=headers, timeout=30)
+        with llm_queue.slot():
+            response = requests.post(TOGETHER_API_URL, json=data, headers=headers, timeout=30)
         response.raise_for_status()
         
         # Extract response
@@ -103,8 +232,11 @@ def summarize_image(file_stream, query: str = "Summarize the content of this ima
         
         summary = result["choices"][0]["message"]["content"]
         logger.info(f"Image summarized successfully")
+        image_summary_cache.put(phash, query, summary, owner, content_hash)
         return summary
     
+    except (ImageProcessingError, AdmissionError):
+        raise
     except requests.Timeout:
         logger.error("Image summarization API request timed out")
         return "Image summarization is currently unavailable due to a timeout. Please try again later."
@@ -0,0 +1,172 @@
+import os
+import time
+import uuid
+import queue
+import logging
+import threading
+import contextvars
+import numpy as np
+from typing import List, Any, Iterable, Tuple, Optional, Callable
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from utils.scheduler import work_priority
+from utils.profiling import attach_thread
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+INGEST_EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", 32))
+INGEST_QUEUE_BATCHES = int(os.getenv("INGEST_QUEUE_BATCHES", 4))  # Chunk batches buffered ahead of the embedder
+
+_DONE = object()
+
+class _ProducerFailure:
+    def __init__(self, error: Exception):
+        self.error = error
+
+class IngestPipeline:
+    """Overlap parsing, splitting and embedding of a document.
+
+    A producer thread pulls source documents (pages or DOCX elements) from a
+    generator, splits each one as soon as it arrives and hands fixed-size chunk
+    batches to the calling thread through a bounded queue. The caller embeds each
+    batch and adds it to a FAISS index straight away, so extraction of later pages
+    runs while earlier ones are embedded and at most INGEST_QUEUE_BATCHES batches
+    of un-embedded chunks are held at a time.
+    """
+
+    def __init__(self, embedding_model, text_splitter, batch_size: int = INGEST_EMBED_BATCH_SIZE,
+                 queue_batches: int = INGEST_QUEUE_BATCHES):
+        self.embedding_model = embedding_model
+        self.text_splitter = text_splitter
+        self.batch_size = max(1, batch_size)
+        self.queue = queue.Queue(maxsize=max(1, queue_batches))
+        self.stop = threading.Event()
+        self.timing = {"produce": 0.0, "embed_wait": 0.0, "embed": 0.0, "index": 0.0, "batches": 0, "failed_batches": 0}
+        self.truncated = False
+
+    def _put(self, item) -> bool:
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, documents: Iterable[Any]):
+        start = time.time()
+        try:
+            batch = []
+            for doc in documents:
+                if self.stop.is_set():
+                    return
+                try:
+                    split = self.text_splitter.split_documents([doc])
+                except Exception as e:
+                    logger.error(f"Error splitting document: {str(e)}")
+                    continue
+                for chunk in split:
+                    if not chunk.page_content or not chunk.page_content.strip():
+                        continue
+                    chunk.id = chunk.metadata["id"] = str(uuid.uuid4())
+                    batch.append(chunk)
+                    if len(batch) >= self.batch_size:
+                        if not self._put(batch):
+                            return
+                        batch = []
+            if batch:
+                self._put(batch)
+            self._put(_DONE)
+        except Exception as e:
+            self._put(_ProducerFailure(e))
+        finally:
+            self.timing["produce"] = time.time() - start
+
+    def run(self, documents: Iterable[Any], priority: str = None,
+            should_stop: Optional[Callable[[], bool]] = None) -> Tuple[List[Any], Optional[Any]]:
+        """Consume a document generator; returns (chunks, faiss index) with embeddings in chunk metadata.
+
+        priority sets the scheduler class for the extraction and embedding work.
+        should_stop is checked after each batch; when it returns True the rest of
+        the document is skipped and truncated is set.
+        """
+        faiss = dependable_faiss_import()
+        chunks = []
+        index = None
+        priority_token = work_priority.set(priority) if priority else None
+        # The producer runs as the same user and priority as the caller
+        producer = threading.Thread(
+            target=contextvars.copy_context().run, args=(attach_thread(self._produce), documents), name="ingest-producer", daemon=True
+        )
+        producer.start()
+        try:
+            while True:
+                wait_start = time.time()
+                batch = self.queue.get()
+                self.timing["embed_wait"] += time.time() - wait_start
+                if batch is _DONE:
+                    break
+                if isinstance(batch, _ProducerFailure):
+                    raise batch.error
+
+                embed_start = time.time()
+                try:
+                    vectors = np.asarray(
+                        self.embedding_model.embed_documents([chunk.page_content for chunk in batch]),
+                        dtype=np.float32
+                    )
+                except Exception as e:
+                    # Skip the failed batch and keep ingesting the rest
+                    logger.error(f"Error embedding batch {self.timing['batches'] + 1}: {str(e)}")
+                    self.timing["failed_batches"] += 1
+                    continue
+                finally:
+                    self.timing["embed"] += time.time() - embed_start
+                    self.timing["batches"] += 1
+
+                index_start = time.time()
+                if index is None:
+                    index = faiss.IndexFlatL2(vectors.shape[1])
+                index.add(vectors)
+                for chunk, vector in zip(batch, vectors):
+                    chunk.metadata["embedding"] = vector.tolist()
+                chunks.extend(batch)
+                self.timing["index"] += time.time() - index_start
+                if should_stop and should_stop():
+                    self.truncated = True
+                    break
+        finally:
+            self.stop.set()
+            producer.join()
+            if priority_token:
+                work_priority.reset(priority_token)
+
+        logger.info(
+            f"Ingested {len(chunks)} chunks in {self.timing['batches']} batch(es) at {priority or work_priority.get()} priority: "
+            f"produce {self.timing['produce']:.2f}s, embed {self.timing['embed']:.2f}s, "
+            f"waiting on producer {self.timing['embed_wait']:.2f}s"
+        )
+        return chunks, index
+
+def build_vector_store(embedding_model, chunks: List[Any], index=None, vectors=None) -> Optional[FAISS]:
+    """Wrap an already populated FAISS index (or precomputed vectors) in a LangChain store without re-embedding"""
+    if index is None:
+        if vectors is None or not len(vectors):
+            return None
+        faiss = dependable_faiss_import()
+        vectors = np.asarray(vectors, dtype=np.float32)
+        index = faiss.IndexFlatL2(vectors.shape[1])
+        index.add(vectors)
+    if index.ntotal != len(chunks):
+        raise ValueError(f"Index holds {index.ntotal} vectors for {len(chunks)} chunks")
+
+    ids = [chunk.metadata["id"] for chunk in chunks]
+    docstore = InMemoryDocstore(dict(zip(ids, chunks)))
+    return FAISS(
+        embedding_function=embedding_model,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=dict(enumerate(ids))
+    )
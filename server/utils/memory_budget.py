@@ -0,0 +1,229 @@
+import os
+import time
+import logging
+import threading
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+from utils.file_utils import FileProcessingError
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+INGEST_MEMORY_BUDGET_MB = float(os.getenv("INGEST_MEMORY_BUDGET_MB", 1024))  # Per document, growth over the start of ingestion
+INGEST_MEMORY_PROCESS_LIMIT_MB = float(os.getenv("INGEST_MEMORY_PROCESS_LIMIT_MB", 0))  # Worker RSS ceiling; 0 disables
+INGEST_MEMORY_POLICY = os.getenv("INGEST_MEMORY_POLICY", "degrade")  # degrade (keep what fits) or reject
+INGEST_MEMORY_MIN_MB = float(os.getenv("INGEST_MEMORY_MIN_MB", 64))  # Below this much headroom ingestion does not start
+MEMORY_SAMPLE_INTERVAL = float(os.getenv("MEMORY_SAMPLE_INTERVAL", 0.05))  # Seconds between RSS samples
+MEMORY_TRACEMALLOC = os.getenv("MEMORY_TRACEMALLOC", "false").lower() == "true"  # Also record Python allocation peaks
+
+MB = 1024 * 1024
+
+# Document query matching only complete ingestions; a document kept in part is never reused for a new upload
+COMPLETE_INGESTION = {"metadata.truncated": {"$ne": True}}
+SIZE_BUCKETS = [(1, "<1MB"), (5, "1-5MB"), (20, "5-20MB"), (float("inf"), ">20MB")]
+
+try:
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+_tracing_lock = threading.Lock()
+
+def _start_tracing():
+    """Start tracemalloc once for the process; never stopped, since concurrent trackers share it"""
+    with _tracing_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+class MemoryBudgetError(FileProcessingError):
+    """Raised when a document cannot be ingested within the memory budget"""
+    pass
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/statm", "r") as handle:
+            return int(handle.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil  # Optional (pip install psutil), for platforms without /proc
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        import resource
+        # Peak rather than current RSS; kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _size_bucket(size: int) -> str:
+    for limit, label in SIZE_BUCKETS:
+        if size < limit * MB:
+            return label
+    return SIZE_BUCKETS[-1][1]
+
+class IngestMemoryTracker:
+    """Memory accounting for one document ingestion.
+
+    A sampler thread records RSS every MEMORY_SAMPLE_INTERVAL seconds so short
+    peaks are seen; growth over the RSS at start is attributed to the current stage
+    (with MEMORY_TRACEMALLOC, Python allocation peaks are recorded as well). RSS is
+    process-wide, so while several documents are ingested at once the budget is
+    scaled by their number rather than charging one document for the others'
+    growth. check() is called between embedding batches: over budget it either
+    asks the pipeline to stop (degrade) or raises MemoryBudgetError.
+    """
+
+    _active = 0
+    _active_lock = threading.Lock()
+
+    def __init__(self, file_size: int, budget_mb: float = INGEST_MEMORY_BUDGET_MB,
+                 policy: str = INGEST_MEMORY_POLICY):
+        self.file_size = file_size
+        self.budget = int(budget_mb * MB)
+        self.policy = policy
+        self.baseline = 0
+        self.headroom = None
+        self.peak = 0
+        self.stages = {}
+        self.degraded = False
+        self._stage = None
+        self._stage_peak = 0
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def __enter__(self):
+        self.baseline = self.peak = current_rss()
+        if INGEST_MEMORY_PROCESS_LIMIT_MB:
+            headroom = int(INGEST_MEMORY_PROCESS_LIMIT_MB * MB) - self.baseline
+            if headroom < INGEST_MEMORY_MIN_MB * MB:
+                memory_stats.record_rejection()
+                raise MemoryBudgetError("Server is low on memory, please retry this document later")
+            self.headroom = headroom
+        if MEMORY_TRACEMALLOC:
+            _start_tracing()
+        with IngestMemoryTracker._active_lock:
+            IngestMemoryTracker._active += 1
+        self._sampler = threading.Thread(target=self._sample, name="memory-sampler", daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._sampler.join()
+        self._observe(current_rss())
+        with IngestMemoryTracker._active_lock:
+            IngestMemoryTracker._active -= 1
+        if exc_type is MemoryBudgetError:
+            memory_stats.record_rejection()
+        elif exc_type is None:
+            memory_stats.record(self)
+        return False
+
+    def _observe(self, rss: int):
+        self.peak = max(self.peak, rss)
+        self._stage_peak = max(self._stage_peak, rss)
+
+    def _sample(self):
+        while not self._stop.wait(MEMORY_SAMPLE_INTERVAL):
+            self._observe(current_rss())
+
+    @property
+    def peak_growth(self) -> int:
+        return max(0, self.peak - self.baseline)
+
+    @contextmanager
+    def stage(self, name: str):
+        self._stage = name
+        self._stage_peak = current_rss()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            self._observe(current_rss())
+            record = {"peak_growth_mb": round(max(0, self._stage_peak - self.baseline) / MB, 1)}
+            if tracemalloc.is_tracing():
+                record["python_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / MB, 1)
+            self.stages[name] = record
+            self._stage = None
+
+    def check(self) -> bool:
+        """True when ingestion should stop early; raises under the reject policy"""
+        self._observe(current_rss())
+        allowed = self.budget * max(1, IngestMemoryTracker._active)
+        if self.headroom is not None:
+            allowed = min(allowed, self.headroom)
+        if self.peak_growth <= allowed:
+            return False
+        message = (
+            f"Ingestion grew memory by {self.peak_growth / MB:.0f}MB during {self._stage or 'ingest'}, "
+            f"over the {allowed / MB:.0f}MB budget"
+        )
+        if self.policy == "reject":
+            logger.warning(f"{message}; rejecting document")
+            raise MemoryBudgetError("Document is too large to process within the server's memory budget")
+        if not self.degraded:
+            logger.warning(f"{message}; keeping the part ingested so far")
+        self.degraded = True
+        return True
+
+class MemoryStats:
+    """Peak ingestion memory by document size, for /metrics"""
+
+    def __init__(self, recent: int = 20):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._recent = deque(maxlen=recent)
+        self.rejected = 0
+        self.degraded = 0
+
+    def record(self, tracker: IngestMemoryTracker):
+        growth_mb = tracker.peak_growth / MB
+        size_mb = tracker.file_size / MB
+        with self._lock:
+            bucket = self._buckets.setdefault(_size_bucket(tracker.file_size), {
+                "documents": 0, "peak_growth_total_mb": 0.0, "peak_growth_max_mb": 0.0, "size_total_mb": 0.0
+            })
+            bucket["documents"] += 1
+            bucket["peak_growth_total_mb"] += growth_mb
+            bucket["peak_growth_max_mb"] = max(bucket["peak_growth_max_mb"], growth_mb)
+            bucket["size_total_mb"] += size_mb
+            if tracker.degraded:
+                self.degraded += 1
+            self._recent.append({
+                "at": time.time(),
+                "size_mb": round(size_mb, 2),
+                "peak_growth_mb": round(growth_mb, 1),
+                "peak_rss_mb": round(tracker.peak / MB, 1),
+                "degraded": tracker.degraded,
+                "stages": tracker.stages
+            })
+
+    def record_rejection(self):
+        with self._lock:
+            self.rejected += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            buckets = {
+                label: {
+                    "documents": bucket["documents"],
+                    "avg_peak_growth_mb": round(bucket["peak_growth_total_mb"] / bucket["documents"], 1),
+                    "max_peak_growth_mb": round(bucket["peak_growth_max_mb"], 1),
+                    "growth_per_file_mb": round(bucket["peak_growth_total_mb"] / max(bucket["size_total_mb"], 0.01), 1)
+                }
+                for label, bucket in self._buckets.items()
+            }
+            return {
+                "rss_mb": round(current_rss() / MB, 1),
+                "budget_mb": INGEST_MEMORY_BUDGET_MB,
+                "process_limit_mb": INGEST_MEMORY_PROCESS_LIMIT_MB or None,
+                "policy": INGEST_MEMORY_POLICY,
+                "degraded": self.degraded,
+                "rejected": self.rejected,
+                "by_size": buckets,
+                "recent": list(self._recent)
+            }
+
+memory_stats = MemoryStats()
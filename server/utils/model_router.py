@@ -0,0 +1,97 @@
+import os
+import logging
+import threading
+from collections import Counter
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+LLM_SHORT_QUERY_WORDS = int(os.getenv("LLM_SHORT_QUERY_WORDS", 8))  # Follow-ups up to this long count as short
+# Output caps by route; answers that need more are the large model's job
+LLM_MAX_TOKENS = {
+    "casual": int(os.getenv("LLM_MAX_TOKENS_CASUAL", 256)),
+    "metadata": int(os.getenv("LLM_MAX_TOKENS_METADATA", 256)),
+    "short": int(os.getenv("LLM_MAX_TOKENS_SHORT", 512)),
+    "summary": int(os.getenv("LLM_MAX_TOKENS_SUMMARY", 900)),
+    "comparison": int(os.getenv("LLM_MAX_TOKENS_COMPARISON", 1500)),
+    "technical": int(os.getenv("LLM_MAX_TOKENS_TECHNICAL", 1500)),
+    "general": int(os.getenv("LLM_MAX_TOKENS_GENERAL", 1200))
+}
+
+FAST_ROUTES = ("casual", "metadata", "short")
+
+class ModelRouter:
+    """Pick the model, output cap and temperature for an LLM call.
+
+    Decided from analyze_query_intent scores and the response style: greetings,
+    metadata questions the stored metadata could not answer directly, and short
+    follow-ups that ask for no depth go to the fast model; summaries, comparisons
+    and technical questions go to the large model. Each route has its own
+    max_tokens. Decisions and call latency are counted per route for /metrics.
+    """
+
+    def __init__(self, large_model: str, fast_model: Optional[str] = None, max_tokens: Dict[str, int] = None):
+        self.large_model = large_model
+        self.fast_model = fast_model or large_model
+        self.max_tokens = max_tokens or LLM_MAX_TOKENS
+        if self.fast_model == self.large_model:
+            logger.warning(f"Fast and large model are both {large_model}; routing only changes max_tokens (set LLAMA_FAST_MODEL)")
+        self._lock = threading.Lock()
+        self.route_counts = Counter()
+        self.call_counts = Counter()
+        self.call_errors = Counter()
+        self.call_time = Counter()
+        self.call_max = Counter()
+
+    def decision(self, route: str) -> Dict[str, Any]:
+        """Model, max_tokens and temperature for a route"""
+        with self._lock:
+            self.route_counts[route] += 1
+        return {
+            "route": route,
+            "model": self.fast_model if route in FAST_ROUTES else self.large_model,
+            "max_tokens": self.max_tokens[route],
+            "temperature": 0.7 if route == "casual" else 0.3
+        }
+
+    def choose(self, query: str, intent_scores: Dict[str, float], response_style: Dict[str, str],
+               follow_up: bool = False) -> Dict[str, Any]:
+        if response_style.get("structure") == "table" or intent_scores.get("comparison", 0) > 0.4:
+            route = "comparison"
+        elif intent_scores.get("technical_detail", 0) > 0.5 or response_style.get("tone") == "academic":
+            route = "technical"
+        elif intent_scores.get("summary_request", 0) > 0.5 or response_style.get("structure") == "bullet":
+            route = "summary"
+        elif intent_scores.get("metadata_query", 0) > 0.5:
+            route = "metadata"
+        elif intent_scores.get("casual_chat", 0) > 0.5:
+            route = "casual"
+        elif follow_up and len(query.split()) <= LLM_SHORT_QUERY_WORDS:
+            route = "short"
+        else:
+            route = "general"
+        return self.decision(route)
+
+    def record(self, route: str, elapsed: float, ok: bool = True):
+        with self._lock:
+            self.call_counts[route] += 1
+            self.call_time[route] += elapsed
+            self.call_max[route] = max(self.call_max[route], elapsed)
+            if not ok:
+                self.call_errors[route] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                route: {
+                    "model": self.fast_model if route in FAST_ROUTES else self.large_model,
+                    "max_tokens": self.max_tokens[route],
+                    "decisions": self.route_counts[route],
+                    "calls": self.call_counts[route],
+                    "errors": self.call_errors[route],
+                    "avg_ms": round(self.call_time[route] / self.call_counts[route] * 1000, 2) if self.call_counts[route] else 0.0,
+                    "max_ms": round(self.call_max[route] * 1000, 2)
+                }
+                for route in set(self.route_counts) | set(self.call_counts)
+            }
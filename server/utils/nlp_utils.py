@@ -1,35 +1,74 @@
-from langchain_community.document_loaders import PyPDFLoader, UnstructuredWordDocumentLoader
+from langchain_community.document_loaders import UnstructuredWordDocumentLoader
+from langchain_core.documents import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import HuggingFaceEmbeddings
 import logging
 import requests
 import re
-from utils.file_utils import extract_metadata, extract_text_from_pdf, extract_text_from_docx, FileProcessingError
+from utils.file_utils import extract_metadata, extract_pdf_metadata, extract_text_from_docx, FileProcessingError, MAX_FILE_SIZE
+from utils.pdf_extraction import PdfPageStream
+from utils.preview_cache import preview_cache
+from utils.guest_cache import guest_cache
+from utils.ingest_pipeline import IngestPipeline, build_vector_store
+from utils.query_router import QueryRouter
+from utils.conversation_memory import ConversationMemory, format_recent_history
+from utils.section_index import (
+    build_section_spans, assign_sections_from_spans, tag_element_sections,
+    assign_sections_by_keywords, section_index_for
+)
 from utils.image_utils import allowed_image
-from typing import List, Tuple, Optional, Dict, Any
+from utils.admission import AdmittedEmbeddings, AdmissionError, embedding_queue, llm_queue, ingest_queue
+from utils.scheduler import ScheduledEmbeddings, embedding_scheduler, ingest_priority
+from utils.embedding_service import EmbeddingService
+from utils.profiling import profiled, attach_thread
+from utils.memory_budget import IngestMemoryTracker, COMPLETE_INGESTION
+from utils.text_store import text_store, WITHOUT_TEXT
+from utils.stage_graph import StageGraph
+from utils.singleflight import SingleFlight, fingerprint
+from utils.model_router import ModelRouter
+from typing import List, Tuple, Optional, Dict, Any, Iterator, Callable
 import os
 import time
 from datetime import datetime
 import hashlib
 import numpy as np
-from concurrent.futures import ThreadPoolExecutor
 import uuid
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 logger = logging.getLogger(__name__)
 
 # Configuration
-embeddings = HuggingFaceEmbeddings(
-    model_name=os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+# Concurrent query embeddings are coalesced by the service before taking an interactive scheduler slot
+embedding_service = EmbeddingService(
+    ScheduledEmbeddings(
+        HuggingFaceEmbeddings(model_name=os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")),
+        embedding_scheduler
+    )
 )
+embeddings = AdmittedEmbeddings(embedding_service, embedding_queue)
 TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY", "your_key_here")
 TOGETHER_API_URL = os.getenv("TOGETHER_API_URL", "https://api.together.xyz/v1/chat/completions")
-LLAMA_MODEL = os.getenv("LLAMA_MODEL", "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free")
+LLAMA_MODEL = os.getenv("LLAMA_MODEL", "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free")  # Large model: summaries, comparisons, technical answers
+# Small model for casual, short and metadata answers; set it to LLAMA_MODEL to send everything to the large model
+LLAMA_FAST_MODEL = os.getenv("LLAMA_FAST_MODEL", "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo")
 MAX_CONTEXT_LENGTH = int(os.getenv("MAX_CONTEXT_LENGTH", 8000))
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 1500))
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 200))
-MAX_WORKERS = int(os.getenv("MAX_WORKERS", 2))  # Reduced to minimize overhead
-BASE_BATCH_SIZE = 8  # Base batch size, will adjust dynamically
+MAX_SECTION_TITLES = 30
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", 4))  # Concurrent LLM calls per batch request
+COMPARE_MAX_DOCUMENTS = int(os.getenv("COMPARE_MAX_DOCUMENTS", 4))
+DOCUMENT_LABELS = "ABCDEFGHIJ"
+LLM_SINGLEFLIGHT = os.getenv("LLM_SINGLEFLIGHT", "true").lower() == "true"  # Coalesce identical in-flight LLM calls
+
+# Routes greetings and metadata questions before any retrieval work
+query_router = QueryRouter(embeddings)
+# Rolling summary plus relevant prior turns, stored per chat session
+conversation_memory = ConversationMemory(embeddings)
+llm_flight = SingleFlight("llm")
+# Chooses model and output cap per call from query intent and response style
+model_router = ModelRouter(LLAMA_MODEL, LLAMA_FAST_MODEL)
 
 def compute_file_hash(file_path: str) -> str:
     """Compute SHA-256 hash of a file."""
@@ -39,77 +78,70 @@ def compute_file_hash(file_path: str) -> str:
             sha256_hash.update(byte_block)
     return sha256_hash.hexdigest()
 
-def embed_documents_batch(documents: List[Any], query: Optional[str] = None) -> List[np.ndarray]:
-    """Embed documents in batches with dynamic batch size."""
-    # Filter out invalid chunks
-    valid_docs = [doc for doc in documents if doc.page_content and isinstance(doc.page_content, str) and len(doc.page_content.strip()) > 0]
-    if not valid_docs:
-        logger.warning("No valid chunks to embed after filtering")
-        return []
-
-    # Dynamic batch size based on document count and query type
-    total_docs = len(valid_docs)
-    batch_size = min(BASE_BATCH_SIZE, total_docs)  # At least 1 batch
-    if query and "summar" in query.lower():
-        # For summary queries, process fewer chunks to speed up
-        valid_docs = valid_docs[:min(50, total_docs)]  # Limit to 50 chunks for summaries
-        batch_size = min(4, total_docs)  # Smaller batch size for faster processing
-    logger.info(f"Embedding {len(valid_docs)} chunks with batch size {batch_size}")
-
-    embeddings_list = []
-    for i in range(0, len(valid_docs), batch_size):
-        batch = valid_docs[i:i + batch_size]
-        chunks = [doc.page_content for doc in batch]
-        try:
-            batch_embeddings = embeddings.embed_documents(chunks)
-            embeddings_list.extend([np.array(emb) for emb in batch_embeddings])
-        except Exception as e:
-            logger.error(f"Error embedding batch {i//batch_size + 1}: {str(e)}")
-            # Skip failed batch, continue with remaining
-            embeddings_list.extend([np.zeros(embeddings.model_dim)] * len(batch))
-    return embeddings_list
+@profiled()
+def load_document(file_path: str, user_id: Optional[str] = None, query: Optional[str] = None, file_hash: Optional[str] = None, guest_token: Optional[str] = None, should_stop: Optional[Callable[[], bool]] = None) -> Tuple[Optional[List[Any]], Dict, Any]:
+    """Load document, split into chunks, create FAISS index, and return with metadata.
 
-def load_document(file_path: str, user_id: Optional[str] = None, query: Optional[str] = None) -> Tuple[Optional[List[Any]], Dict, Any]:
-    """Load document, split into chunks, create FAISS index, and return with metadata."""
+    Pass file_hash when the caller already knows it to avoid re-reading the file.
+    Guests (guest_token, no user_id) are served from and added to the guest cache,
+    which also works once the uploaded file itself is gone. should_stop is polled
+    between embedding batches; when it returns True ingestion ends early and the
+    result is marked truncated, so it is neither stored nor reused.
+    """
     timing = {"start": time.time()}
+    if guest_token and not user_id:
+        cached = guest_cache.get(guest_token, file_hash)
+        if cached:
+            logger.info(f"Guest document {file_hash} served from cache")
+            return cached["documents"], dict(cached["metadata"]), cached["vector_store"]
+        documents, metadata, vector_store = load_document(file_path, None, query, file_hash, should_stop=should_stop)
+        # Documents kept in part are ingested again next time instead of being served from the cache
+        if (documents or metadata.get("text_chars") or metadata.get("is_image")) and not metadata.get("truncated"):
+            guest_cache.put(guest_token, file_hash or compute_file_hash(file_path), documents, metadata, vector_store)
+        return documents, metadata, vector_store
+
     if not file_path or not os.path.exists(file_path):
-        return [], {"extracted_text": ""}, None
+        return [], {"text_chars": 0}, None
     
     try:
         # Compute file hash to check for existing processing
         timing["hash_start"] = time.time()
-        file_hash = compute_file_hash(file_path)
+        if not file_hash:
+            file_hash = compute_file_hash(file_path)
         timing["hash"] = time.time() - timing["hash_start"]
 
         # Check if document is already processed
         from utils.db import documents_collection
-        query_db = {"file_hash": file_hash}
+        query_db = {"file_hash": file_hash, **COMPLETE_INGESTION}
         if user_id:
             query_db["user_id"] = user_id
-        existing_doc = documents_collection.find_one(query_db)
+        existing_doc = documents_collection.find_one(query_db, WITHOUT_TEXT)
+        if should_stop and should_stop():
+            # Answered without the document before the index was rebuilt
+            return [], {"truncated": True, "text_chars": 0}, None
         if existing_doc and existing_doc.get("chunks"):
             timing["existing_check"] = time.time() - timing["start"]
             logger.info(f"Found existing document with hash {file_hash}, skipping processing")
-            split_docs = [
-                type("Document", (), {
-                    "page_content": chunk["content"],
-                    "metadata": chunk["metadata"],
-                    "id": chunk["metadata"].get("id", str(uuid.uuid4()))
-                })() for chunk in existing_doc["chunks"]
-            ]
+            split_docs = []
+            stored_vectors = []
+            for chunk in existing_doc["chunks"]:
+                chunk_metadata = dict(chunk["metadata"])
+                chunk_metadata.setdefault("id", str(uuid.uuid4()))
+                split_docs.append(Document(id=chunk_metadata["id"], page_content=chunk["content"], metadata=chunk_metadata))
+                stored_vectors.append(chunk.get("embedding") or chunk_metadata.get("embedding"))
             metadata = existing_doc.get("metadata", {})
-            metadata["extracted_text"] = existing_doc.get("extracted_text", "")
             vector_store = None
             if split_docs:
-                embeddings_list = [chunk["embedding"] for chunk in existing_doc["chunks"] if "embedding" in chunk]
-                if embeddings_list:
-                    embeddings_np = [np.array(emb) for emb in embeddings_list]
-                    doc_ids = [doc.id for doc in split_docs]
+                # Rebuild the index from stored embeddings instead of re-embedding every chunk
+                if all(stored_vectors):
                     try:
-                        vector_store = FAISS.from_documents(split_docs, embeddings, ids=doc_ids)
+                        vector_store = build_vector_store(embeddings, split_docs, vectors=stored_vectors)
                     except Exception as e:
                         logger.error(f"Failed to create FAISS index from existing embeddings: {str(e)}")
                         vector_store = None
+                else:
+                    logger.warning(f"Existing document {file_hash} has chunks without embeddings, re-embedding")
+                    vector_store = FAISS.from_documents(split_docs, embeddings, ids=[doc.id for doc in split_docs])
             timing["total"] = time.time() - timing["start"]
             logger.info(f"Loaded existing document in {timing['total']:.2f} seconds: {timing}")
             return split_docs, metadata, vector_store
@@ -119,134 +151,113 @@ def load_document(file_path: str, user_id: Optional[str] = None, query: Optional
             timing["image_check"] = time.time() - timing["start"]
             metadata = {
                 "is_image": True,
-                "extracted_text": "",
                 "file_type": os.path.splitext(file_path)[1].lower().lstrip(".")
             }
             logger.info(f"Image file detected: {file_path}, returning empty documents")
             return [], metadata, None
 
-        # Extract metadata
-        timing["metadata_start"] = time.time()
-        metadata = extract_metadata(file_path)
-        timing["metadata"] = time.time() - timing["metadata_start"]
-        
-        # Extract full text
-        timing["text_extract_start"] = time.time()
-        file_stream = open(file_path, 'rb')
-        if file_path.endswith(".pdf"):
-            extracted_text = extract_text_from_pdf(file_stream)
-        elif file_path.endswith(".docx"):
-            extracted_text = extract_text_from_docx(file_stream)
-        else:
-            file_stream.close()
-            raise FileProcessingError(f"Unsupported file type: {file_path}")
-        file_stream.close()
-        metadata["extracted_text"] = extracted_text
-        timing["text_extract"] = time.time() - timing["text_extract_start"]
-        
-        # Load document with appropriate loader
-        timing["loader_start"] = time.time()
-        if file_path.endswith(".pdf"):
-            loader = PyPDFLoader(file_path, extract_images=False)
-        elif file_path.endswith(".docx"):
-            loader = UnstructuredWordDocumentLoader(file_path, mode="elements")
-        else:
-            raise FileProcessingError(f"Unsupported file type: {file_path}")
-        
-        docs = list(loader.lazy_load())
-        timing["loader"] = time.time() - timing["loader_start"]
-        
-        # Split documents into chunks in parallel
-        timing["splitter_start"] = time.time()
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=CHUNK_SIZE,
-            chunk_overlap=CHUNK_OVERLAP,
-            separators=["\n\n", "\n", ". ", "? ", "! ", " ", ""],
-            is_separator_regex=False
-        )
-        
-        def split_doc(doc):
-            try:
-                return text_splitter.split_documents([doc])
-            except Exception as e:
-                logger.error(f"Error splitting document: {str(e)}")
-                return []
-        
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            split_docs = []
-            futures = [executor.submit(split_doc, doc) for doc in docs]
-            for future in futures:
-                split_docs.extend(future.result())
-        timing["splitter"] = time.time() - timing["splitter_start"]
-        
-        # Identify sections and assign IDs
-        timing["section_start"] = time.time()
-        section_patterns = {
-            "abstract": r"abstract|summary",
-            "introduction": r"introduction|background",
-            "methods": r"method|methodology|approach|experiment",
-            "results": r"result|finding|outcome|data",
-            "discussion": r"discussion|conclusion|implication",
-            "references": r"reference|bibliography",
-            "appendix": r"appendix|supplement"
-        }
+        if os.path.getsize(file_path) > MAX_FILE_SIZE:
+            raise FileProcessingError(f"File size exceeds {MAX_FILE_SIZE/1024/1024}MB limit")
 
-        for doc in split_docs:
-            first_200 = doc.page_content[:200].lower()
-            for section, pattern in section_patterns.items():
-                if re.search(pattern, first_200):
-                    doc.metadata["section"] = section
-                    break
-            else:
-                doc.metadata["section"] = "other"
-            doc.metadata["id"] = str(uuid.uuid4())
-        timing["section"] = time.time() - timing["section_start"]
-        
-        # Create FAISS vector store
-        timing["faiss_start"] = time.time()
-        vector_store = None
-        if split_docs:
-            embeddings_list = embed_documents_batch(split_docs, query)
-            
-            # Ensure embeddings and documents align
-            valid_pairs = [(doc, emb) for doc, emb in zip(split_docs, embeddings_list) if np.any(emb)]
-            if valid_pairs:
-                split_docs, embeddings_list = zip(*valid_pairs)
-                split_docs = list(split_docs)
-                embeddings_list = list(embeddings_list)
-            else:
-                split_docs = []
-                embeddings_list = []
+        # New documents are parsed and embedded under a per-user fair share of ingestion slots
+        # Memory growth is tracked per stage and capped by the ingestion memory budget
+        file_size = os.path.getsize(file_path)
+        with ingest_queue.slot(cost=max(1, file_size / (1024 * 1024))), IngestMemoryTracker(file_size) as memory:
+            if should_stop and should_stop():
+                # Answered without the document while waiting for the slot
+                logger.info(f"Ingestion of {file_hash} no longer needed, skipping it")
+                return [], {"truncated": True, "text_chars": 0}, None
+            # Stream pages (PDF) or elements (DOCX) through split -> embed -> index
+            timing["ingest_start"] = time.time()
+            text_splitter = RecursiveCharacterTextSplitter(
+                chunk_size=CHUNK_SIZE,
+                chunk_overlap=CHUNK_OVERLAP,
+                separators=["\n\n", "\n", ". ", "? ", "! ", " ", ""],
+                is_separator_regex=False,
+                add_start_index=True
+            )
+            pipeline = IngestPipeline(embeddings, text_splitter)
+            stop = (lambda: should_stop() or memory.check()) if should_stop else memory.check
+            with memory.stage("ingest"):
+                if file_path.endswith(".pdf"):
+                    page_stream = PdfPageStream(file_path)
+                    source_docs = (
+                        Document(page_content=page["text"], metadata={"source": file_path, "page": page_number})
+                        for page_number, page in enumerate(page_stream)
+                    )
+                    split_docs, index = pipeline.run(source_docs, ingest_priority(total_pages=page_stream.total_pages), stop)
 
-            for doc, embedding in zip(split_docs, embeddings_list):
-                doc.metadata["embedding"] = embedding.tolist() if isinstance(embedding, np.ndarray) else embedding
-                
-            doc_ids = [doc.metadata["id"] for doc in split_docs]
-            if split_docs:
-                try:
-                    vector_store = FAISS.from_documents(split_docs, embeddings, ids=doc_ids)
-                    vector_count = vector_store.index.ntotal
-                    logger.info(f"FAISS vector store created with {vector_count} vectors for document: {file_path}")
-                    if vector_count > 0:
-                        sample_vector = vector_store.index.reconstruct(0)
-                        logger.debug(f"Sample FAISS vector (first): {sample_vector[:5]}... (length: {len(sample_vector)})")
-                    else:
-                        logger.warning("FAISS vector store is empty, no vectors stored")
-                except Exception as e:
-                    logger.error(f"Failed to create FAISS index: {str(e)}")
-                    vector_store = None
-            else:
-                logger.warning("No valid chunks after embedding for FAISS")
-        else:
-            logger.warning("No document chunks to store in FAISS for document: {file_path}")
-        timing["faiss"] = time.time() - timing["faiss_start"]
-        
-        timing["total"] = time.time() - timing["start"]
-        logger.info(f"Document processing timing: {timing}")
-        
-        return split_docs, metadata, vector_store
+                    extraction = page_stream.result()
+                    metadata = extract_pdf_metadata(file_path, extraction)
+                    extracted_text = extraction["text"]
+                    metadata["section_spans"] = build_section_spans(extraction["headings"])
+                    if extraction["headings"]:
+                        metadata["sections"] = [h["title"] for h in extraction["headings"][:MAX_SECTION_TITLES]]
+                elif file_path.endswith(".docx"):
+                    metadata = extract_metadata(file_path)
+                    with open(file_path, 'rb') as file_stream:
+                        extracted_text = extract_text_from_docx(file_stream)
+                    loader = UnstructuredWordDocumentLoader(file_path, mode="elements")
+                    metadata["section_spans"] = []
+                    split_docs, index = pipeline.run(
+                        tag_element_sections(loader.lazy_load(), metadata["section_spans"]),
+                        ingest_priority(size=file_size),
+                        stop
+                    )
+                else:
+                    raise FileProcessingError(f"Unsupported file type: {file_path}")
+            if pipeline.truncated:
+                # Over the memory budget: answer from the part that fits rather than fail.
+                # A load stopped by should_stop ends up here too; its caller discards it
+                metadata["truncated"] = True
+                metadata["ingested_chunks"] = len(split_docs)
+                if file_path.endswith(".pdf"):
+                    metadata["ingested_pages"] = max((doc.metadata.get("page", 0) for doc in split_docs), default=-1) + 1
+            # Full text lives compressed in the text store, read only where it is needed
+            metadata["text_chars"] = len(extracted_text)
+            if user_id and not pipeline.truncated:
+                text_store.put(file_hash, extracted_text)
+            timing["ingest"] = time.time() - timing["ingest_start"]
+            preview_cache.schedule(
+                os.path.basename(file_path), file_path, extracted_text if file_path.endswith(".docx") else None
+            )
+            timing.update({f"ingest_{key}": value for key, value in pipeline.timing.items()})
 
-    except FileProcessingError as e:
+            # Identify sections from layout headings, falling back to keywords
+            timing["section_start"] = time.time()
+            with memory.stage("sections"):
+                spans = metadata.get("section_spans")
+                if file_path.endswith(".pdf") and spans:
+                    assign_sections_from_spans(split_docs, spans)
+                elif spans:
+                    # DOCX chunks before the first section heading
+                    for doc in split_docs:
+                        doc.metadata.setdefault("section", "other")
+                assign_sections_by_keywords(split_docs)
+            timing["section"] = time.time() - timing["section_start"]
+
+            # Wrap the incrementally built index; no second embedding pass
+            timing["faiss_start"] = time.time()
+            vector_store = None
+            with memory.stage("vector_store"):
+                if split_docs:
+                    try:
+                        vector_store = build_vector_store(embeddings, split_docs, index=index)
+                        logger.info(f"FAISS vector store created with {vector_store.index.ntotal} vectors for document: {file_path}")
+                    except Exception as e:
+                        logger.error(f"Failed to create FAISS index: {str(e)}")
+                        vector_store = None
+                else:
+                    logger.warning(f"No document chunks to store in FAISS for document: {file_path}")
+            timing["faiss"] = time.time() - timing["faiss_start"]
+            timing["memory_peak_growth_mb"] = round(memory.peak_growth / (1024 * 1024), 1)
+
+            timing["total"] = time.time() - timing["start"]
+            logger.info(f"Document processing timing: {timing}")
+
+            return split_docs, metadata, vector_store
+
+    except (FileProcessingError, AdmissionError) as e:
         logger.error(f"Document processing failed: {str(e)}")
         raise
     except Exception as e:
@@ -278,14 +289,18 @@ def analyze_query_intent(query: str) -> Dict[str, float]:
     
     keyword_map = {
         "casual_chat": ["hi", "hello", "hey", "what's up", "how are you"],
-        "summary_request": ["summarize", "overview", "main points", "tl;dr"],
-        "technical_detail": ["method", "result", "data", "analysis", "how does"],
-        "comparison": ["vs", "versus", "compare", "difference", "similarity"],
-        "metadata_query": ["author", "title", "date", "pages", "figure", "table"]
+        "summary_request": ["summarize", "summarized", "overview", "main points", "tl;dr"],
+        "technical_detail": ["method", "methods", "result", "results", "data", "analysis", "analyses", "how does"],
+        "comparison": ["vs", "versus", "compare", "compared", "comparison", "difference", "differences",
+                       "similarity", "similarities"],
+        "metadata_query": ["author", "authors", "title", "date", "pages", "figure", "figures", "table", "tables"]
     }
     
     for intent, keywords in keyword_map.items():
-        intent_scores[intent] += sum(keyword in query_lower for keyword in keywords) * 0.3
+        # Whole-word matches only, so "hi" no longer fires inside "this"; other forms are listed above
+        intent_scores[intent] += sum(
+            bool(re.search(rf"(?<!\w){re.escape(keyword)}(?!\w)", query_lower)) for keyword in keywords
+        ) * 0.3
     
     if re.search(r"explain (like|to) (a|me|i'm)", query_lower):
         intent_scores["casual_chat"] += 0.5
@@ -316,7 +331,58 @@ def handle_metadata_query(query: str, metadata: Dict) -> Optional[str]:
         return f"The file is an image of type {metadata.get('file_type', 'unknown')}."
     return None
 
-def prepare_context(query: str, documents: List, metadata: Dict, intent_scores: Dict, chat_history: List = None, vector_store=None, image_context: str = None) -> str:
+def retrieve_relevant_chunks(query: str, documents: List, metadata: Dict, intent_scores: Dict, vector_store=None, query_vector=None) -> List:
+    """Pick the chunks to put in the prompt: section-filtered or plain FAISS search, or section matching without an index"""
+    relevant_docs = []
+
+    if vector_store:
+        # Layout-derived sections are reliable enough to search only the relevant part
+        target_sections = None
+        if metadata.get("section_spans") and query_vector is not None:
+            if intent_scores["technical_detail"] > 0.5:
+                target_sections = ["methods", "results"]
+            elif intent_scores["summary_request"] > 0.5:
+                target_sections = ["abstract", "introduction", "discussion"]
+        if target_sections:
+            section_index = section_index_for(vector_store)
+            if section_index.size(target_sections) >= 5:
+                relevant_docs = section_index.search(query_vector, target_sections, k=5)
+                logger.info(f"Section-filtered search over {section_index.size(target_sections)} of {vector_store.index.ntotal} vectors ({target_sections})")
+        if not relevant_docs:
+            if query_vector is not None:
+                relevant_docs = vector_store.similarity_search_by_vector(query_vector, k=5)
+            else:
+                relevant_docs = vector_store.similarity_search(query, k=5)
+        retrieved_sections = [doc.metadata.get('section', 'other') for doc in relevant_docs]
+        logger.info(f"FAISS retrieved {len(relevant_docs)} documents for query '{query}': Sections {retrieved_sections}")
+    else:
+        logger.warning(f"No FAISS vector store available, using section-based filtering for query: {query}")
+        if intent_scores["technical_detail"] > 0.5:
+            sections = ["methods", "results"]
+        elif intent_scores["comparison"] > 0.4:
+            sections = ["results", "discussion"]
+        else:
+            sections = ["abstract", "introduction", "discussion"]
+            
+        relevant_docs = [d for d in documents if d.metadata.get("section") in sections]
+        if not relevant_docs and documents:
+            relevant_docs = documents[:3]
+        retrieved_sections = [doc.metadata.get('section', 'other') for doc in relevant_docs]
+        logger.info(f"Fallback retrieved {len(relevant_docs)} documents for query '{query}': Sections {retrieved_sections}")
+    return relevant_docs
+
+def format_chunks(chunks: List, max_chars: int) -> str:
+    """Join up to five chunks with section labels, cut at a paragraph boundary to fit max_chars"""
+    content = "\n\n".join(
+        f"[Section: {doc.metadata.get('section', 'other')}]\n{doc.page_content}"
+        for doc in chunks[:5]
+    )
+    if len(content) > max_chars:
+        last_paragraph_end = content[:max_chars].rfind("\n\n")
+        content = content[:last_paragraph_end] if last_paragraph_end > 0 else content[:max_chars]
+    return content
+
+def prepare_context(query: str, documents: List, metadata: Dict, intent_scores: Dict, chat_history: List = None, vector_store=None, image_context: str = None, query_vector=None, memory: Optional[Dict] = None) -> str:
     """Prepare context for LLM using FAISS similarity search and section filtering"""
     context_parts = []
     
@@ -326,48 +392,16 @@ def prepare_context(query: str, documents: List, metadata: Dict, intent_scores:
     if intent_scores["metadata_query"] > 0.3:
         context_parts.append(format_metadata(metadata))
 
-    if chat_history:
-        history_str = "\n".join(
-            f"{entry['type'].upper()}: {entry['content']}" for entry in chat_history[-5:]
-        )
-        context_parts.append(f"PREVIOUS CONVERSATION:\n{history_str}")
-        query_lower = query.lower()
-        for entry in chat_history[-5:]:
-            if entry["type"] == "user" and any(word in query_lower for word in entry["content"].lower().split()):
-                context_parts.append(f"NOTE: You previously asked about '{entry['content']}', which may be related.")
+    if memory:
+        memory_context = conversation_memory.context(memory, query, query_vector)
+        if memory_context:
+            context_parts.append(memory_context)
+    elif chat_history:
+        context_parts.append(f"PREVIOUS CONVERSATION:\n{format_recent_history(chat_history)}")
 
     if documents:
-        relevant_docs = []
-        
-        if vector_store:
-            relevant_docs = vector_store.similarity_search(query, k=5)
-            retrieved_sections = [doc.metadata.get('section', 'other') for doc in relevant_docs]
-            logger.info(f"FAISS retrieved {len(relevant_docs)} documents for query '{query}': Sections {retrieved_sections}")
-        else:
-            logger.warning(f"No FAISS vector store available, using section-based filtering for query: {query}")
-            if intent_scores["technical_detail"] > 0.5:
-                sections = ["methods", "results"]
-            elif intent_scores["comparison"] > 0.4:
-                sections = ["results", "discussion"]
-            else:
-                sections = ["abstract", "introduction", "conclusion"]
-                
-            relevant_docs = [d for d in documents if d.metadata.get("section") in sections]
-            if not relevant_docs and documents:
-                relevant_docs = documents[:3]
-            retrieved_sections = [doc.metadata.get('section', 'other') for doc in relevant_docs]
-            logger.info(f"Fallback retrieved {len(relevant_docs)} documents for query '{query}': Sections {retrieved_sections}")
-        
-        context_content = "\n\n".join(
-            f"[Section: {doc.metadata.get('section', 'other')}]\n{doc.page_content}"
-            for doc in relevant_docs[:5]
-        )
-        
-        if len(context_content) > MAX_CONTEXT_LENGTH:
-            last_paragraph_end = context_content[:MAX_CONTEXT_LENGTH].rfind("\n\n")
-            context_content = context_content[:last_paragraph_end] if last_paragraph_end > 0 else context_content[:MAX_CONTEXT_LENGTH]
-        
-        context_parts.append("DOCUMENT CONTENT:\n" + context_content)
+        relevant_docs = retrieve_relevant_chunks(query, documents, metadata, intent_scores, vector_store, query_vector)
+        context_parts.append("DOCUMENT CONTENT:\n" + format_chunks(relevant_docs, MAX_CONTEXT_LENGTH))
 
     return "\n\n".join(context_parts)
 
@@ -417,23 +451,60 @@ def generate_llm_prompt(query: str, context: str, response_style: Dict) -> str:
     
     return "\n\n".join(prompt_parts)
 
-def call_llm_api(prompt: str) -> str:
-    """Call the LLM API with the prepared prompt"""
+def generate_comparison_prompt(query: str, document_contexts: List[Tuple[str, str]], response_style: Dict) -> str:
+    """Prompt for comparing several documents; document_contexts holds (label, context) pairs"""
+    labels = ", ".join(f"[{label}]" for label, _ in document_contexts)
+    instruction = f"""You are an AI assistant with {response_style['tone']} tone comparing {len(document_contexts)} documents ({labels}). Respond with:
+    - Depth: {response_style['depth']}
+    - Structure: a markdown table with one column per document for the aspects the user asks about, then a short summary of the key similarities and differences
+    - Instruction: Attribute every point to its document label; say so when a document does not cover an aspect instead of guessing."""
+
+    prompt_parts = [instruction]
+    for label, context in document_contexts:
+        prompt_parts.append(f"DOCUMENT [{label}]:\n{context}")
+    prompt_parts.append(f"USER QUERY:\n{query}")
+    return "\n\n".join(prompt_parts)
+
+def generate_casual_prompt(query: str, chat_history: List = None) -> str:
+    """Minimal prompt for greetings and small talk; no document context"""
+    prompt_parts = ["You are a friendly AI assistant for research papers. Reply briefly and casually."]
+    if chat_history:
+        recent = "\n".join(f"{entry['type'].upper()}: {entry['content'][:300]}" for entry in chat_history[-2:])
+        prompt_parts.append(f"RECENT CONVERSATION:\n{recent}")
+    prompt_parts.append(f"USER QUERY:\n{query}")
+    return "\n\n".join(prompt_parts)
+
+@profiled()
+def call_llm_api(prompt: str, decision: Optional[Dict[str, Any]] = None) -> str:
+    """Call the LLM API with the prepared prompt, using the model and limits chosen by model_router"""
+    decision = decision or model_router.decision("general")
+    start = time.time()
+    ok = False
     try:
         headers = {
             "Authorization": f"Bearer {TOGETHER_API_KEY}",
             "Content-Type": "application/json"
         }
         data = {
-            "model": LLAMA_MODEL,
+            "model": decision["model"],
             "messages": [{"role": "system", "content": prompt}],
-            "temperature": 0.7 if "casual" in prompt.lower() else 0.3,
-            "max_tokens": 1500
+            "temperature": decision["temperature"],
+            "max_tokens": decision["max_tokens"]
         }
-        
-        response = requests.post(TOGETHER_API_URL, json=data, headers=headers, timeout=30)
-        response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
+
+        def post() -> str:
+            with llm_queue.slot():
+                response = requests.post(TOGETHER_API_URL, json=data, headers=headers, timeout=30)
+            response.raise_for_status()
+            return response.json()["choices"][0]["message"]["content"]
+
+        # Identical requests already in flight share that call instead of making their own
+        if LLM_SINGLEFLIGHT:
+            response = llm_flight.do(fingerprint(data), post)
+        else:
+            response = post()
+        ok = True
+        return response
     
     except requests.Timeout:
         logger.error("LLM API request timed out")
@@ -444,49 +515,211 @@ def call_llm_api(prompt: str) -> str:
     except KeyError as e:
         logger.error(f"Invalid LLM API response format: {str(e)}")
         return "Received an invalid response from the AI service."
+    finally:
+        model_router.record(decision["route"], time.time() - start, ok)
 
-def process_document_query(file_path: str, query: str, chat_history: List = None, image_context: str = None, user_id: Optional[str] = None) -> str:
-    """Main function to process a document query"""
+def build_document_prompt(query: str, documents: List, metadata: Dict, vector_store, query_vector=None, chat_history: List = None, image_context: str = None, memory: Optional[Dict] = None, timing: Optional[Dict] = None, intent_scores: Optional[Dict] = None) -> Tuple[Optional[str], Optional[str], Optional[Dict]]:
+    """Build the LLM prompt for a retrieval query.
+
+    Returns (prompt, direct_answer, decision); direct_answer is set for metadata questions,
+    decision is the model_router choice to pass to call_llm_api.
+    """
+    timing = timing if timing is not None else {}
+    if intent_scores is None:
+        timing["intent_start"] = time.time()
+        intent_scores = analyze_query_intent(query)
+        timing["intent"] = time.time() - timing["intent_start"]
+    
+    if intent_scores["metadata_query"] > 0.7:
+        metadata_response = handle_metadata_query(query, metadata)
+        if metadata_response:
+            return None, metadata_response, None
+    
+    timing["context_start"] = time.time()
+    context = prepare_context(query, documents, metadata, intent_scores, chat_history, vector_store, image_context, query_vector, memory)
+    timing["context"] = time.time() - timing["context_start"]
+    
+    timing["style_start"] = time.time()
+    response_style = determine_response_style(intent_scores, metadata)
+    timing["style"] = time.time() - timing["style_start"]
+    
+    timing["prompt_start"] = time.time()
+    prompt = generate_llm_prompt(query, context, response_style)
+    timing["prompt"] = time.time() - timing["prompt_start"]
+    decision = model_router.choose(query, intent_scores, response_style, follow_up=bool(chat_history or memory))
+    timing["llm_route"] = decision["route"]
+    return prompt, None, decision
+
+@profiled()
+def process_document_query(file_path: str, query: str, chat_history: List = None, image_context: str = None, user_id: Optional[str] = None, file_hash: Optional[str] = None, metadata: Optional[Dict] = None, memory: Optional[Dict] = None, guest_token: Optional[str] = None) -> str:
+    """Main function to process a document query.
+
+    Pass the stored metadata when available so metadata questions skip loading the document,
+    and the chat's conversation memory to use it instead of raw history.
+    """
     timing = {"start": time.time()}
+    stages = StageGraph()
+
+    try:
+        with stages:
+            # Keyword intent is cheap and decides whether the document is worth loading
+            # before the router has answered; greetings and metadata questions usually
+            # short-circuit, everything else loads alongside query embedding and routing.
+            # A load that turns out to be unneeded polls stages.stopped and ends early.
+            intent_scores = analyze_query_intent(query)
+            likely_short_circuit = intent_scores["casual_chat"] > 0.5 or intent_scores["metadata_query"] > 0.7
+            stages.add("route", lambda: query_router.route(query, metadata, handle_metadata_query))
+            stages.add(
+                "load",
+                lambda route=None: load_document(file_path, user_id, query, file_hash, guest_token, stages.stopped.is_set)
+                if route is None or route["route"] == "retrieval" else None,
+                after=("route",) if likely_short_circuit else ()
+            )
+
+            route = stages.result("route")
+            timing["route_decision"] = route["route"]
+
+            if route["route"] in ("metadata", "casual"):
+                stages.stop()
+                if route["route"] == "metadata":
+                    return route["answer"]
+                return call_llm_api(generate_casual_prompt(query, chat_history), model_router.decision("casual"))
+
+            def answer(route, loaded):
+                prompt, metadata_response, decision = build_document_prompt(
+                    query, *loaded, route["query_vector"], chat_history, image_context, memory, timing, intent_scores
+                )
+                return metadata_response or call_llm_api(prompt, decision)
+
+            stages.add("prompt", answer, after=("route", "load"))
+            return stages.result("prompt")
     
+    except AdmissionError:
+        raise
+    except FileProcessingError as e:
+        logger.error(f"Document processing error: {str(e)}")
+        return f"Error processing document: {str(e)}"
+    except Exception as e:
+        logger.error(f"Unexpected error processing query: {str(e)}", exc_info=True)
+        return f"An unexpected error occurred: {str(e)}"
+    finally:
+        # The graph is closed by now: every stage has finished or was cancelled
+        stages.report(timing)
+        timing["total"] = time.time() - timing["start"]
+        logger.info(f"Document query processing timing: {timing}")
+
+
+def process_document_queries(file_path: str, queries: List[str], user_id: Optional[str] = None, file_hash: Optional[str] = None, metadata: Optional[Dict] = None) -> Iterator[Dict[str, Any]]:
+    """Answer several questions about one document; returns an iterator of results in completion order.
+
+    The document and its index are loaded once up front (so load errors raise
+    here), all questions are embedded in one batch, and LLM calls run concurrently,
+    BATCH_LLM_CONCURRENCY at a time. Each result carries the question's index.
+    """
+    start = time.time()
+    query_vectors = embeddings.embed_documents(queries)
+    routes = [
+        query_router.route(query, metadata, handle_metadata_query, vector)
+        for query, vector in zip(queries, query_vectors)
+    ]
+
+    documents, vector_store = [], None
+    if any(route["route"] == "retrieval" for route in routes):
+        documents, metadata, vector_store = load_document(file_path, user_id, None, file_hash)
+    image_context = metadata.get("summary") if metadata and metadata.get("is_image") else None
+    logger.info(f"Batch of {len(queries)} questions prepared in {time.time() - start:.2f} seconds")
+
+    # Worker threads run as the requesting user for admission control
+    request_context = contextvars.copy_context()
+
+    def answer(index: int, query: str, route: Dict[str, Any]) -> Dict[str, Any]:
+        query_start = time.time()
+        result = {"index": index, "query": query, "route": route["route"]}
+        try:
+            if route["route"] == "metadata":
+                response = route["answer"]
+            elif route["route"] == "casual":
+                response = call_llm_api(generate_casual_prompt(query), model_router.decision("casual"))
+            else:
+                prompt, response, decision = build_document_prompt(
+                    query, documents, metadata, vector_store, route["query_vector"], image_context=image_context
+                )
+                if prompt:
+                    response = call_llm_api(prompt, decision)
+            result["response"] = response
+        except AdmissionError as e:
+            result["error"] = str(e)
+            result["retry_after"] = e.retry_after
+        except Exception as e:
+            logger.error(f"Batch question {index} failed: {str(e)}", exc_info=True)
+            result["error"] = f"An unexpected error occurred: {str(e)}"
+        result["elapsed_ms"] = round((time.time() - query_start) * 1000, 1)
+        return result
+
+    def results() -> Iterator[Dict[str, Any]]:
+        with ThreadPoolExecutor(max_workers=max(1, min(BATCH_LLM_CONCURRENCY, len(queries)))) as executor:
+            futures = [
+                executor.submit(request_context.copy().run, attach_thread(answer), index, query, route)
+                for index, (query, route) in enumerate(zip(queries, routes))
+            ]
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                # Client went away: do not start calls that have not begun yet
+                for future in futures:
+                    future.cancel()
+        logger.info(f"Batch of {len(queries)} questions answered in {time.time() - start:.2f} seconds")
+
+    return results()
+
+
+@profiled()
+def compare_documents(query: str, sources: List[Dict[str, Any]], user_id: Optional[str] = None) -> str:
+    """Answer a comparison question over several documents with one LLM call.
+
+    sources are dicts with name, file_path, file_hash and metadata. Each document is
+    loaded and searched in parallel, and gets an equal share of MAX_CONTEXT_LENGTH
+    so the prompt stays the same size however many documents are compared.
+    """
+    timing = {"start": time.time()}
     try:
-        timing["load_start"] = time.time()
-        documents, metadata, vector_store = load_document(file_path, user_id, query)
-        timing["load"] = time.time() - timing["load_start"]
-        
-        timing["intent_start"] = time.time()
+        query_vector = embeddings.embed_query(query)
         intent_scores = analyze_query_intent(query)
-        timing["intent"] = time.time() - timing["intent_start"]
-        
-        if intent_scores["metadata_query"] > 0.7:
-            metadata_response = handle_metadata_query(query, metadata)
-            if metadata_response:
-                return metadata_response
-        
-        timing["context_start"] = time.time()
-        context = prepare_context(query, documents, metadata, intent_scores, chat_history, vector_store, image_context)
-        timing["context"] = time.time() - timing["context_start"]
-        
-        timing["style_start"] = time.time()
-        response_style = determine_response_style(intent_scores, metadata)
-        timing["style"] = time.time() - timing["style_start"]
-        
-        timing["prompt_start"] = time.time()
-        prompt = generate_llm_prompt(query, context, response_style)
-        timing["prompt"] = time.time() - timing["prompt_start"]
-        
+        budget = MAX_CONTEXT_LENGTH // max(1, len(sources))
+
+        def gather(source: Dict[str, Any]) -> str:
+            documents, metadata, vector_store = load_document(source["file_path"], user_id, None, source.get("file_hash"))
+            metadata = metadata or source.get("metadata") or {}
+            if metadata.get("is_image"):
+                content = (source.get("metadata") or {}).get("summary", "No summary available")[:budget]
+            else:
+                chunks = retrieve_relevant_chunks(query, documents, metadata, intent_scores, vector_store, query_vector)
+                content = format_chunks(chunks, budget)
+            return f"Name: {source['name']}\n{format_metadata(metadata)}\nCONTENT:\n{content}"
+
+        timing["retrieval_start"] = time.time()
+        with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, attach_thread(gather), source) for source in sources]
+            contexts = [future.result() for future in futures]
+        timing["retrieval"] = time.time() - timing["retrieval_start"]
+
+        response_style = determine_response_style(intent_scores, {})
+        response_style["structure"] = "table"
+        prompt = generate_comparison_prompt(query, list(zip(DOCUMENT_LABELS, contexts)), response_style)
+
         timing["llm_start"] = time.time()
-        response = call_llm_api(prompt)
+        response = call_llm_api(prompt, model_router.choose(query, intent_scores, response_style))
         timing["llm"] = time.time() - timing["llm_start"]
-        
         timing["total"] = time.time() - timing["start"]
-        logger.info(f"Document query processing timing: {timing}")
-        
+        logger.info(f"Comparison over {len(sources)} documents timing: {timing}")
         return response
-    
+
+    except AdmissionError:
+        raise
     except FileProcessingError as e:
         logger.error(f"Document processing error: {str(e)}")
         return f"Error processing document: {str(e)}"
     except Exception as e:
-        logger.error(f"Unexpected error processing query: {str(e)}", exc_info=True)
-        return f"An unexpected error occurred: {str(e)}"
\ No newline at end of file
+        logger.error(f"Unexpected error comparing documents: {str(e)}", exc_info=True)
+        return f"An unexpected error occurred: {str(e)}"
@@ -0,0 +1,435 @@
+import os
+import re
+import logging
+import threading
+import multiprocessing
+from io import BytesIO
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Iterator, Union
+from utils.scheduler import PriorityScheduler, work_priority
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+PDF_BACKEND = os.getenv('PDF_BACKEND', 'auto')  # auto, pypdfium2, pymupdf or pdfplumber
+PDF_EXTRACT_WORKERS = int(os.getenv('PDF_EXTRACT_WORKERS', os.cpu_count() or 1))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', 16))
+PDF_STREAM_RANGE_PAGES = int(os.getenv('PDF_STREAM_RANGE_PAGES', 16))  # Max pages per pool task
+# Never fork: the server is multithreaded with torch and FAISS loaded, and a forked child can inherit held locks
+PDF_POOL_START_METHOD = os.getenv(
+    'PDF_POOL_START_METHOD',
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+
+HEADING_SIZE_RATIO = float(os.getenv('HEADING_SIZE_RATIO', 1.15))  # Font size relative to body text
+HEADING_MAX_CHARS = 80
+HEADING_MAX_WORDS = 8
+BOLD_FONT_MARKERS = ('bold', 'black', 'heavy', 'semibold', 'medi')
+HEADING_NUMBER = re.compile(r'^\s*(?:\d+(?:\.\d+)*|[IVX]+|[A-Z])\.?\s+\S')
+
+FIGURE_PATTERN = re.compile(r'(?:Figure|Fig\.?)\s*\d+', re.IGNORECASE)
+TABLE_PATTERN = re.compile(r'(?:Table|Tab\.?)\s*\d+', re.IGNORECASE)
+
+# Optional faster backends, used when installed: pip install pypdfium2 / pip install PyMuPDF.
+# pdfplumber is a hard dependency (file_utils) and the fallback for both.
+BACKEND_PREFERENCE = ['pypdfium2', 'pymupdf', 'pdfplumber']
+
+PdfSource = Union[str, bytes]
+
+# PDFium (and MuPDF) are not thread-safe, even across documents: every in-process call into them,
+# including opening and closing documents and pages, runs under this lock. Pool workers run one task
+# at a time, so there it is never contended.
+pdf_library_lock = threading.RLock()
+
+class PdfExtractionError(Exception):
+    """Raised when no backend can read the PDF"""
+    pass
+
+def _backend_available(name: str) -> bool:
+    try:
+        if name == 'pypdfium2':
+            import pypdfium2  # noqa: F401
+        elif name == 'pymupdf':
+            _import_pymupdf()
+        elif name == 'pdfplumber':
+            import pdfplumber  # noqa: F401
+        else:
+            return False
+        return True
+    except ImportError:
+        return False
+
+def resolve_backend(name: str = None) -> str:
+    """Pick the configured backend, falling back to the first installed one"""
+    name = name or PDF_BACKEND
+    if name != 'auto':
+        if _backend_available(name):
+            return name
+        logger.warning(f"PDF backend '{name}' is not installed, falling back")
+    for candidate in BACKEND_PREFERENCE:
+        if _backend_available(candidate):
+            return candidate
+    raise PdfExtractionError("No PDF extraction backend is installed")
+
+def _open_pypdfium2(source: PdfSource):
+    import pypdfium2 as pdfium
+    return pdfium.PdfDocument(source)
+
+def _import_pymupdf():
+    try:
+        import pymupdf
+    except ImportError:
+        import fitz as pymupdf  # PyMuPDF < 1.24
+    return pymupdf
+
+def _open_pymupdf(source: PdfSource):
+    pymupdf = _import_pymupdf()
+    if isinstance(source, bytes):
+        return pymupdf.open(stream=source, filetype='pdf')
+    return pymupdf.open(source)
+
+def _open_pdfplumber(source: PdfSource):
+    import pdfplumber
+    return pdfplumber.open(BytesIO(source) if isinstance(source, bytes) else source)
+
+def _page_record(text: str, image_count: int, lines: List[tuple] = None, sizes: Dict[float, int] = None) -> Dict[str, Any]:
+    """Per-page result. lines holds (offset, font_size, bold, text) for short lines that may be headings."""
+    return {
+        "text": text,
+        "image_count": image_count,
+        "figure_count": len(FIGURE_PATTERN.findall(text)),
+        "table_count": len(TABLE_PATTERN.findall(text)),
+        "lines": lines or [],
+        "sizes": sizes or {}
+    }
+
+def _is_bold_font(font_name: str) -> bool:
+    name = font_name.lower().split('+')[-1]
+    return any(marker in name for marker in BOLD_FONT_MARKERS)
+
+def _add_line(lines: list, sizes: dict, offset: int, text: str, size: float, bold: bool):
+    size = round(size, 1)
+    sizes[size] = sizes.get(size, 0) + len(text)
+    stripped = text.strip()
+    if stripped and len(stripped) <= HEADING_MAX_CHARS:
+        lines.append((offset, size, bold, stripped))
+
+def _pypdfium2_page(page, pdfium_c) -> Dict[str, Any]:
+    textpage = page.get_textpage()
+    try:
+        raw = textpage.get_text_range()
+        lines, sizes = [], {}
+        raw_pos = norm_pos = 0
+        for line in raw.split('\r\n'):
+            first = raw_pos + len(line) - len(line.lstrip())
+            if line.strip():
+                size = pdfium_c.FPDFText_GetFontSize(textpage.raw, first)
+                bold = pdfium_c.FPDFText_GetFontWeight(textpage.raw, first) >= 600
+                _add_line(lines, sizes, norm_pos, line, size, bold)
+            raw_pos += len(line) + 2
+            norm_pos += len(line) + 1
+        image_count = sum(1 for _ in page.get_objects(filter=(pdfium_c.FPDF_PAGEOBJ_IMAGE,)))
+        return _page_record(raw.replace('\r\n', '\n'), image_count, lines, sizes)
+    finally:
+        textpage.close()
+
+def _pymupdf_page(page) -> Dict[str, Any]:
+    parts, lines, sizes = [], [], {}
+    offset = 0
+    for block in page.get_text("dict")["blocks"]:
+        if block.get("type") != 0:
+            continue
+        for line in block["lines"]:
+            spans = [span for span in line["spans"] if span["text"]]
+            text = "".join(span["text"] for span in spans)
+            if not text.strip():
+                continue
+            size = max(span["size"] for span in spans)
+            bold = all(span["flags"] & 16 or _is_bold_font(span["font"]) for span in spans if span["text"].strip())
+            _add_line(lines, sizes, offset, text, size, bold)
+            parts.append(text)
+            offset += len(text) + 1
+    return _page_record("\n".join(parts), len(page.get_images()), lines, sizes)
+
+def _pdfplumber_page(page) -> Dict[str, Any]:
+    words = page.extract_words(extra_attrs=["size", "fontname"], use_text_flow=True)
+    rows = []
+    for word in words:
+        if rows and abs(rows[-1][0]["top"] - word["top"]) <= 3:
+            rows[-1].append(word)
+        else:
+            rows.append([word])
+    parts, lines, sizes = [], [], {}
+    offset = 0
+    for row in rows:
+        text = " ".join(word["text"] for word in row)
+        size = max(word["size"] for word in row)
+        bold = all(_is_bold_font(word["fontname"]) for word in row)
+        _add_line(lines, sizes, offset, text, size, bold)
+        parts.append(text)
+        offset += len(text) + 1
+    return _page_record("\n".join(parts), len(page.images), lines, sizes)
+
+def _iter_range(backend: str, source: PdfSource, start: int, end: int) -> Iterator[Dict[str, Any]]:
+    """Yield page records for pages [start, end) with one backend"""
+    if backend == 'pypdfium2':
+        import pypdfium2.raw as pdfium_c
+        with pdf_library_lock:
+            pdf = _open_pypdfium2(source)
+        try:
+            for index in range(start, end):
+                # Held per page, not across the yield, so other documents interleave
+                with pdf_library_lock:
+                    page = pdf[index]
+                    try:
+                        record = _pypdfium2_page(page, pdfium_c)
+                    finally:
+                        page.close()
+                yield record
+        finally:
+            with pdf_library_lock:
+                pdf.close()
+    elif backend == 'pymupdf':
+        with pdf_library_lock:
+            doc = _open_pymupdf(source)
+        try:
+            for index in range(start, end):
+                with pdf_library_lock:
+                    record = _pymupdf_page(doc[index])
+                yield record
+        finally:
+            with pdf_library_lock:
+                doc.close()
+    else:
+        with _open_pdfplumber(source) as pdf:
+            for page in pdf.pages[start:end]:
+                yield _pdfplumber_page(page)
+
+def _extract_range(backend: str, source: PdfSource, start: int, end: int) -> List[Dict[str, Any]]:
+    """Extract pages [start, end) with one backend. Runs inside pool workers."""
+    return list(_iter_range(backend, source, start, end))
+
+def detect_headings(pages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Pick heading lines by layout: noticeably larger than body text, or bold and short"""
+    sizes = {}
+    for page in pages:
+        for size, count in page["sizes"].items():
+            sizes[size] = sizes.get(size, 0) + count
+    if not sizes:
+        return []
+    body_size = max(sizes.items(), key=lambda item: item[1])[0]
+
+    headings = []
+    for page_number, page in enumerate(pages):
+        for offset, size, bold, text in page["lines"]:
+            if sum(c.isalpha() for c in text) < 3 or text.endswith(('.', ',', ';', ':')) and not HEADING_NUMBER.match(text):
+                continue
+            larger = size >= body_size * HEADING_SIZE_RATIO
+            emphasized = bold and size >= body_size * 0.95 and len(text.split()) <= HEADING_MAX_WORDS
+            if larger or emphasized:
+                headings.append({"page": page_number, "offset": offset, "title": text, "size": size})
+    return headings
+
+def _read_info(backend: str, source: PdfSource) -> Dict[str, Any]:
+    """Return page count and document info dictionary"""
+    if backend == 'pypdfium2':
+        with pdf_library_lock:
+            pdf = _open_pypdfium2(source)
+            try:
+                return {"total_pages": len(pdf), "info": pdf.get_metadata_dict(skip_empty=True)}
+            finally:
+                pdf.close()
+    if backend == 'pymupdf':
+        with pdf_library_lock:
+            doc = _open_pymupdf(source)
+            try:
+                info = {key.capitalize(): value for key, value in (doc.metadata or {}).items() if value}
+                return {"total_pages": doc.page_count, "info": info}
+            finally:
+                doc.close()
+    with _open_pdfplumber(source) as pdf:
+        return {"total_pages": len(pdf.pages), "info": pdf.metadata or {}}
+
+_pool = None
+_pool_lock = threading.Lock()
+extraction_scheduler = PriorityScheduler("extraction", PDF_EXTRACT_WORKERS)
+
+def _pool_context():
+    context = multiprocessing.get_context(PDF_POOL_START_METHOD)
+    if PDF_POOL_START_METHOD == 'forkserver':
+        # Workers fork from a server that imports only this module, not the app and its models
+        context.set_forkserver_preload([__name__])
+    return context
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=PDF_EXTRACT_WORKERS, mp_context=_pool_context())
+        return _pool
+
+def page_ranges(total_pages: int, workers: int, max_pages: int = None) -> List[tuple]:
+    """Split pages into contiguous ranges, about two per worker for load balance.
+
+    max_pages caps the range size so the first pages come back early when streaming.
+    """
+    if total_pages <= 0:
+        return []
+    parts = max(1, min(total_pages, workers * 2))
+    size = -(-total_pages // parts)
+    if max_pages:
+        size = min(size, max_pages)
+    return [(start, min(start + size, total_pages)) for start in range(0, total_pages, size)]
+
+class PdfPageStream:
+    """Extract PDF pages in document order, yielding each page as soon as it is ready.
+
+    Large documents are extracted in page ranges across the process pool with a
+    bounded number of ranges in flight, so consumers can chunk and embed early
+    pages while later ones are still being parsed. If the backend fails, the
+    remaining pages are extracted with pdfplumber.
+    """
+
+    def __init__(self, source: PdfSource, backend: str = None):
+        self.source = source
+        self.backend = resolve_backend(backend)
+        self.pages = []
+        self.ranges = 0
+        try:
+            header = _read_info(self.backend, source)
+        except Exception as e:
+            if not self._fall_back(e):
+                raise PdfExtractionError(f"Failed to open PDF with {self.backend}: {str(e)}")
+            header = _read_info(self.backend, source)
+        self.total_pages = header["total_pages"]
+        self.info = header["info"]
+
+    def _fall_back(self, error: Exception) -> bool:
+        if self.backend == 'pdfplumber' or not _backend_available('pdfplumber'):
+            return False
+        logger.warning(f"PDF backend {self.backend} failed ({str(error)}), retrying with pdfplumber")
+        self.backend = 'pdfplumber'
+        return True
+
+    def _iter_pages(self, start: int) -> Iterator[Dict[str, Any]]:
+        remaining = self.total_pages - start
+        if PDF_EXTRACT_WORKERS <= 1 or remaining < PDF_PARALLEL_MIN_PAGES:
+            self.ranges += 1
+            yield from _iter_range(self.backend, self.source, start, self.total_pages)
+            return
+
+        ranges = [
+            (start + range_start, start + range_end)
+            for range_start, range_end in page_ranges(remaining, PDF_EXTRACT_WORKERS, PDF_STREAM_RANGE_PAGES)
+        ]
+        self.ranges += len(ranges)
+        pool = _get_pool()
+        pending = deque()
+        # Each pool task holds a scheduler slot, so interactive documents overtake bulk ones
+        priority = work_priority.get()
+        release = lambda _future: extraction_scheduler.release(priority)
+        try:
+            for range_start, range_end in ranges:
+                extraction_scheduler.acquire(priority)
+                try:
+                    future = pool.submit(_extract_range, self.backend, self.source, range_start, range_end)
+                except Exception:
+                    extraction_scheduler.release(priority)
+                    raise
+                future.add_done_callback(release)
+                pending.append(future)
+                if len(pending) >= PDF_EXTRACT_WORKERS * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        while len(self.pages) < self.total_pages:
+            start = len(self.pages)
+            try:
+                for page in self._iter_pages(start):
+                    self.pages.append(page)
+                    yield page
+                break
+            except PdfExtractionError:
+                raise
+            except Exception as e:
+                if not self._fall_back(e):
+                    raise PdfExtractionError(f"Failed to extract PDF with {self.backend}: {str(e)}")
+        logger.info(f"Extracted {self.total_pages} PDF pages with {self.backend} across {self.ranges} range(s)")
+
+    def result(self) -> Dict[str, Any]:
+        """Summary of the pages extracted so far, in the extract_pdf format"""
+        pages = self.pages
+        return {
+            "backend": self.backend,
+            "total_pages": self.total_pages,
+            "info": self.info,
+            "pages": [page["text"] for page in pages],
+            "headings": detect_headings(pages),
+            "text": "\n".join(page["text"] for page in pages),
+            "image_count": sum(page["image_count"] for page in pages),
+            "figure_count": sum(page["figure_count"] for page in pages),
+            "table_count": sum(page["table_count"] for page in pages)
+        }
+
+def extract_pdf(source: PdfSource, backend: str = None) -> Dict[str, Any]:
+    """Extract per-page text and figure/image/table counts in a single pass.
+
+    Large documents are split into page ranges and extracted in a process pool.
+    """
+    stream = PdfPageStream(source, backend)
+    for _ in stream:
+        pass
+    return stream.result()
+
+def pdf_page_count(source: PdfSource, backend: str = None) -> int:
+    return _read_info(resolve_backend(backend), source)["total_pages"]
+
+def render_pages(source: PdfSource, indices: List[int], width: int, backend: str = None) -> Iterator[tuple]:
+    """Render pages to RGB PIL images `width` pixels wide, yielding (index, image); the document is opened once"""
+    from PIL import Image
+    backend = resolve_backend(backend)
+    if backend == 'pypdfium2':
+        with pdf_library_lock:
+            pdf = _open_pypdfium2(source)
+        try:
+            for index in indices:
+                # Preview renders run on request and build threads; same lock as extraction
+                with pdf_library_lock:
+                    page = pdf[index]
+                    try:
+                        bitmap = page.render(scale=width / page.get_width())
+                        try:
+                            image = bitmap.to_pil().convert("RGB")
+                        finally:
+                            bitmap.close()
+                    finally:
+                        page.close()
+                yield index, image
+        finally:
+            with pdf_library_lock:
+                pdf.close()
+    elif backend == 'pymupdf':
+        pymupdf = _import_pymupdf()
+        with pdf_library_lock:
+            doc = _open_pymupdf(source)
+        try:
+            for index in indices:
+                with pdf_library_lock:
+                    page = doc[index]
+                    zoom = width / page.rect.width
+                    pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+                    image = Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+                yield index, image
+        finally:
+            with pdf_library_lock:
+                doc.close()
+    else:
+        with _open_pdfplumber(source) as pdf:
+            for index in indices:
+                yield index, pdf.pages[index].to_image(width=width).original.convert("RGB")
@@ -0,0 +1,216 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict, Counter
+from typing import Dict, Any, List, Optional, Tuple
+from pymongo import WriteConcern
+from pymongo.errors import BulkWriteError, PyMongoError
+from utils.db import chat_sessions_collection, queries_collection
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", 100))  # Max operations per bulk_write
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", 0.05))  # Seconds between background flushes
+PERSIST_MAX_PENDING = int(os.getenv("PERSIST_MAX_PENDING", 5000))  # Above this, submitters flush inline
+PERSIST_RETRIES = int(os.getenv("PERSIST_RETRIES", 3))  # Attempts for a batch that fails with a transient error
+PERSIST_RETRY_DELAY = float(os.getenv("PERSIST_RETRY_DELAY", 0.1))  # Seconds before the first retry, doubled after each
+PERSIST_MAX_FAILED_KEYS = 1000  # Failures kept for keys that have not flushed since
+
+def write_concern_for(name: str):
+    """Write concern from MONGO_WRITE_CONCERN_<NAME>, e.g. "majority", "1" or "1:j" (journaled); None keeps the default"""
+    value = os.getenv(f"MONGO_WRITE_CONCERN_{name.upper()}", "").strip()
+    if not value:
+        return None
+    w, _, journal = value.partition(":")
+    return WriteConcern(w=int(w) if w.isdigit() else w, j=True if journal == "j" else None)
+
+def with_write_concern(collection, name: str):
+    concern = write_concern_for(name)
+    return collection.with_options(write_concern=concern) if concern else collection
+
+class PersistenceError(Exception):
+    """Raised when writes a request depends on could not be applied"""
+    pass
+
+class TurnWriter:
+    """Write-behind buffer for chat turn writes.
+
+    Routes submit pymongo operations (UpdateOne, InsertOne) instead of writing
+    inline, or a callable returning one (or None to skip it) for work that can wait
+    until the write, such as an embedding; a background thread groups them per collection and applies each group
+    with ordered bulk_writes, so a turn costs no database round trip on the
+    response path. Operations are submitted under a key (the user), and
+    flush(key) writes only that key's pending operations, so a request reading
+    its own chats waits for its own writes rather than everyone's. Operations of
+    one key are never written by two flushes at once, which keeps them in
+    submission order. Transient errors are retried; an operation that still fails
+    is reported by the next flush of its key (PersistenceError).
+
+    The buffer is per process: a write another worker still holds is invisible
+    here, so anything a client will immediately read elsewhere (a new chat) must
+    be flushed before responding.
+    """
+
+    def __init__(self, collections: Dict[str, Any]):
+        self.collections = {name: with_write_concern(collection, name) for name, collection in collections.items()}
+        self._pending = OrderedDict((name, []) for name in collections)  # name -> [(key, operation)]
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._writing = Counter()  # key -> flushes currently writing its operations
+        self._failures = OrderedDict()  # key -> last error not yet reported
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.counters = {"submitted": 0, "written": 0, "batches": 0, "failed": 0, "retries": 0, "inline_flushes": 0}
+
+    def _ensure_thread(self):
+        # Started lazily, and again in a forked worker process
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="turn-writer", daemon=True)
+            self._thread.start()
+
+    def _count(self, **deltas):
+        with self._lock:
+            for name, value in deltas.items():
+                self.counters[name] += value
+
+    def submit(self, name: str, operation, key: Optional[str] = None):
+        with self._lock:
+            self._ensure_thread()
+            self._pending[name].append((key, operation))
+            self.counters["submitted"] += 1
+            pending = sum(len(entries) for entries in self._pending.values())
+            if pending >= PERSIST_MAX_PENDING:
+                self.counters["inline_flushes"] += 1
+        if pending >= PERSIST_MAX_PENDING:
+            # Database is falling behind; apply backpressure on the submitter
+            self.flush()
+        elif pending >= PERSIST_BATCH_SIZE:
+            self._wakeup.set()
+
+    def has_pending(self, key: Optional[str] = None) -> bool:
+        with self._lock:
+            return any(key is None or entry_key == key for entries in self._pending.values() for entry_key, _ in entries)
+
+    def _take(self, key: Optional[str]) -> Tuple[List[Tuple[str, list]], List[str]]:
+        """Remove pending operations (all, or one key's) and mark their keys as being written; lock held"""
+        batches, keys = [], set()
+        for name, entries in self._pending.items():
+            taken = [entry for entry in entries if key is None or entry[0] == key]
+            if not taken:
+                continue
+            self._pending[name] = [entry for entry in entries if key is not None and entry[0] != key]
+            batches.append((name, taken))
+            keys.update(entry_key for entry_key, _ in taken)
+        for entry_key in keys:
+            self._writing[entry_key] += 1
+        return batches, list(keys)
+
+    def flush(self, key: Optional[str] = None):
+        """Write pending operations now: everything, or only those submitted under key.
+
+        With a key, raises PersistenceError if one of its operations failed, in this
+        flush or in an earlier background one.
+        """
+        with self._idle:
+            # Earlier operations of the same key are written first
+            while (self._writing[key] if key is not None else any(self._writing.values())):
+                self._idle.wait()
+            batches, keys = self._take(key)
+        try:
+            for name, entries in batches:
+                self._write(name, entries)
+        finally:
+            with self._idle:
+                for entry_key in keys:
+                    self._writing[entry_key] -= 1
+                    if self._writing[entry_key] <= 0:
+                        del self._writing[entry_key]
+                self._idle.notify_all()
+        if key is not None:
+            with self._lock:
+                error = self._failures.pop(key, None)
+            if error:
+                raise PersistenceError(error)
+
+    def _fail(self, entries: list, message: str):
+        logger.error(message)
+        with self._lock:
+            self.counters["failed"] += len(entries)
+            for key, _ in entries:
+                if key is not None:
+                    self._failures[key] = message
+                    self._failures.move_to_end(key)
+            while len(self._failures) > PERSIST_MAX_FAILED_KEYS:
+                self._failures.popitem(last=False)
+
+    def _resolve(self, name: str, entries: list) -> list:
+        """Build deferred operations; one that fails is reported like a rejected write"""
+        resolved = []
+        for key, operation in entries:
+            if callable(operation):
+                try:
+                    operation = operation()
+                except Exception as e:
+                    self._fail([(key, operation)], f"Deferred write to {name} failed: {str(e)}")
+                    continue
+                if operation is None:
+                    continue
+            resolved.append((key, operation))
+        return resolved
+
+    def _write(self, name: str, entries: list):
+        collection = self.collections[name]
+        entries = self._resolve(name, entries)
+        for start in range(0, len(entries), PERSIST_BATCH_SIZE):
+            remaining = entries[start:start + PERSIST_BATCH_SIZE]
+            attempt = 0
+            while remaining:
+                write_start = time.time()
+                try:
+                    collection.bulk_write([operation for _, operation in remaining], ordered=True)
+                    self._count(written=len(remaining), batches=1)
+                    logger.debug(f"Wrote {len(remaining)} operations to {name} in {(time.time() - write_start) * 1000:.1f}ms")
+                    remaining = []
+                except BulkWriteError as e:
+                    # Ordered: operations before the first error were applied, that one was rejected
+                    # (a retry would fail the same way) and the rest were not attempted
+                    errors = e.details.get("writeErrors") or [{"index": 0}]
+                    index = errors[0]["index"]
+                    self._count(written=index, batches=1)
+                    self._fail(remaining[index:index + 1], f"Write to {name} rejected: {errors[0].get('errmsg', str(e))}")
+                    remaining = remaining[index + 1:]
+                except PyMongoError as e:
+                    attempt += 1
+                    if attempt >= PERSIST_RETRIES:
+                        self._fail(remaining, f"Bulk write of {len(remaining)} operations to {name} failed after {attempt} attempts: {str(e)}")
+                        remaining = []
+                    else:
+                        self._count(retries=1)
+                        logger.warning(f"Bulk write to {name} failed ({str(e)}), retrying")
+                        time.sleep(PERSIST_RETRY_DELAY * 2 ** (attempt - 1))
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(PERSIST_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                if self.has_pending():
+                    self.flush()
+            except Exception as e:
+                logger.error(f"Turn writer flush failed: {str(e)}", exc_info=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pending = {name: len(entries) for name, entries in self._pending.items()}
+            return {"pending": pending, "unreported_failures": len(self._failures), **self.counters}
+
+turn_writer = TurnWriter({
+    "chat_sessions": chat_sessions_collection,
+    "queries": queries_collection
+})
+atexit.register(turn_writer.flush)
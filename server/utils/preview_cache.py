@@ -0,0 +1,257 @@
+import os
+import json
+import shutil
+import logging
+import tempfile
+import itertools
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Iterable, Iterator
+from utils.pdf_extraction import pdf_page_count, render_pages, extraction_scheduler
+from utils.scheduler import BULK, INTERACTIVE
+from utils.blob_store import BlobStore
+from utils.text_store import text_store
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+PREVIEW_DIR = os.getenv("PREVIEW_DIR", os.path.join(os.getenv("UPLOAD_FOLDER", os.path.join(os.getcwd(), "uploads")), "previews"))
+PREVIEW_PAGE_WIDTH = int(os.getenv("PREVIEW_PAGE_WIDTH", 800))  # Pixels; PDF page images
+PREVIEW_JPEG_QUALITY = int(os.getenv("PREVIEW_JPEG_QUALITY", 75))
+PREVIEW_DOCX_PAGE_CHARS = int(os.getenv("PREVIEW_DOCX_PAGE_CHARS", 4000))
+PREVIEW_BUILD_WORKERS = int(os.getenv("PREVIEW_BUILD_WORKERS", 1))
+
+MANIFEST_VERSION = 1
+
+class PreviewError(Exception):
+    """Raised when a preview cannot be built or a page does not exist"""
+    pass
+
+def _iter_lines(pieces: Iterable[str]) -> Iterator[str]:
+    """Lines of text arriving in arbitrary pieces"""
+    carry = ""
+    for piece in pieces:
+        lines = (carry + piece).split("\n")
+        carry = lines.pop()
+        yield from lines
+    yield carry
+
+def iter_pages(pieces: Iterable[str], page_chars: int = PREVIEW_DOCX_PAGE_CHARS) -> Iterator[str]:
+    """Pages of about page_chars from text arriving in pieces, breaking between paragraphs where possible"""
+    current, size, emitted = [], 0, False
+    for paragraph in _iter_lines(pieces):
+        while len(paragraph) > page_chars:
+            # A single paragraph longer than a page is cut at a word boundary
+            cut = paragraph.rfind(" ", 0, page_chars)
+            cut = cut if cut > 0 else page_chars
+            if current:
+                yield "\n".join(current)
+                current, size = [], 0
+            yield paragraph[:cut]
+            emitted = True
+            paragraph = paragraph[cut:].lstrip()
+        if current and size + len(paragraph) + 1 > page_chars:
+            yield "\n".join(current)
+            emitted = True
+            current, size = [], 0
+        current.append(paragraph)
+        size += len(paragraph) + 1
+    if current and any(line.strip() for line in current):
+        yield "\n".join(current)
+    elif not emitted:
+        yield ""
+
+def paginate_text(text: str, page_chars: int = PREVIEW_DOCX_PAGE_CHARS) -> List[str]:
+    """Split text into pages of about page_chars, breaking between paragraphs where possible"""
+    return list(iter_pages([text or ""], page_chars))
+
+def _write_atomic(path: str, data: bytes):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as handle:
+            handle.write(data)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+class PreviewCache:
+    """On-disk preview artifacts per stored file.
+
+    Stored names are content-addressed, so artifacts never go stale and are keyed
+    by name: a manifest plus paginated text (DOCX) or one JPEG per page (PDF).
+    Ingest schedules a build in the background; PDF pages are rendered in order at
+    bulk priority, and a page requested before the build reaches it is rendered on
+    demand, so the first page is available long before a large document is done.
+    """
+
+    def __init__(self, root: str = PREVIEW_DIR, workers: int = PREVIEW_BUILD_WORKERS):
+        self.root = root
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="preview")
+        self._lock = threading.Lock()
+        self._building = set()
+        self.counters = {"built": 0, "pages_rendered": 0, "on_demand": 0, "hits": 0, "failed": 0}
+
+    def _dir(self, name: str) -> str:
+        return os.path.join(self.root, name[:2], name)
+
+    def _manifest_path(self, name: str) -> str:
+        return os.path.join(self._dir(name), "manifest.json")
+
+    def page_path(self, name: str, page: int) -> str:
+        kind = "jpg" if name.lower().endswith(".pdf") else "txt"
+        return os.path.join(self._dir(name), f"page-{page:05d}.{kind}")
+
+    def _load_manifest(self, name: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._manifest_path(name), "r", encoding="utf-8") as handle:
+                manifest = json.load(handle)
+            return manifest if manifest.get("version") == MANIFEST_VERSION else None
+        except (OSError, ValueError):
+            return None
+
+    def _save_manifest(self, name: str, manifest: Dict[str, Any]):
+        _write_atomic(self._manifest_path(name), json.dumps(manifest).encode("utf-8"))
+
+    def _build_docx(self, name: str, file_path: str, text: Optional[str]) -> Dict[str, Any]:
+        if text is not None:
+            pieces = [text]
+        else:
+            # Text stored at ingestion saves parsing the DOCX again; it is paginated as it decompresses
+            file_hash = BlobStore.hash_of(name)
+            stored = text_store.iter_text(file_hash)
+            first = next(stored, None)
+            if first is not None or text_store.exists(file_hash):
+                pieces = itertools.chain([first or ""], stored)
+            else:
+                from utils.file_utils import extract_text_from_docx
+                with open(file_path, "rb") as file_stream:
+                    pieces = [extract_text_from_docx(file_stream)]
+        chars = [0]
+
+        def counted(pieces):
+            for piece in pieces:
+                chars[0] += len(piece)
+                yield piece
+
+        pages = 0
+        for content in iter_pages(counted(pieces)):
+            pages += 1
+            _write_atomic(self.page_path(name, pages), content.encode("utf-8"))
+        manifest = {"version": MANIFEST_VERSION, "type": "docx", "pages": pages, "chars": chars[0]}
+        self._save_manifest(name, manifest)
+        return manifest
+
+    def _build_pdf_manifest(self, name: str, file_path: str) -> Dict[str, Any]:
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "type": "pdf",
+            "pages": pdf_page_count(file_path),
+            "width": PREVIEW_PAGE_WIDTH
+        }
+        self._save_manifest(name, manifest)
+        return manifest
+
+    def _save_page_image(self, name: str, index: int, image):
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=PREVIEW_JPEG_QUALITY, optimize=True)
+        _write_atomic(self.page_path(name, index + 1), buffer.getvalue())
+        self.counters["pages_rendered"] += 1
+
+    def _render_pdf_pages(self, name: str, file_path: str, total_pages: int):
+        missing = [index for index in range(total_pages) if not os.path.exists(self.page_path(name, index + 1))]
+        pages = render_pages(file_path, missing, PREVIEW_PAGE_WIDTH)
+        while True:
+            # One slot per page so interactive extraction can overtake the build
+            with extraction_scheduler.slot(BULK):
+                rendered = next(pages, None)
+                if rendered is None:
+                    break
+                if not os.path.exists(self.page_path(name, rendered[0] + 1)):
+                    self._save_page_image(name, *rendered)
+
+    def _build(self, name: str, file_path: str, text: Optional[str] = None):
+        try:
+            os.makedirs(self._dir(name), exist_ok=True)
+            if name.lower().endswith(".docx"):
+                self._build_docx(name, file_path, text)
+            elif name.lower().endswith(".pdf"):
+                manifest = self._load_manifest(name) or self._build_pdf_manifest(name, file_path)
+                self._render_pdf_pages(name, file_path, manifest["pages"])
+            self.counters["built"] += 1
+            logger.info(f"Built preview for {name}")
+        except Exception as e:
+            self.counters["failed"] += 1
+            logger.error(f"Failed to build preview for {name}: {str(e)}", exc_info=True)
+        finally:
+            with self._lock:
+                self._building.discard(name)
+
+    def schedule(self, name: str, file_path: str, text: Optional[str] = None):
+        """Build preview artifacts in the background unless they exist or are being built"""
+        if not name.lower().endswith((".pdf", ".docx")):
+            return
+        with self._lock:
+            if name in self._building or self._is_complete(name):
+                return
+            self._building.add(name)
+        self._executor.submit(self._build, name, file_path, text)
+
+    def _is_complete(self, name: str) -> bool:
+        manifest = self._load_manifest(name)
+        return bool(manifest) and all(
+            os.path.exists(self.page_path(name, number)) for number in range(1, manifest["pages"] + 1)
+        )
+
+    def manifest(self, name: str, file_path: str) -> Dict[str, Any]:
+        """Manifest for a stored file, built now if missing (documents ingested before previews existed)"""
+        manifest = self._load_manifest(name)
+        if manifest:
+            return manifest
+        os.makedirs(self._dir(name), exist_ok=True)
+        if name.lower().endswith(".docx"):
+            manifest = self._build_docx(name, file_path, None)
+        elif name.lower().endswith(".pdf"):
+            manifest = self._build_pdf_manifest(name, file_path)
+            self.schedule(name, file_path)
+        else:
+            raise PreviewError(f"No preview available for {name}")
+        return manifest
+
+    def page(self, name: str, file_path: str, page: int) -> str:
+        """Path of a preview page (1-based), rendering a PDF page on demand if the build has not reached it"""
+        manifest = self.manifest(name, file_path)
+        if page < 1 or page > manifest["pages"]:
+            raise PreviewError(f"Page {page} out of range (1-{manifest['pages']})")
+        path = self.page_path(name, page)
+        if os.path.exists(path):
+            self.counters["hits"] += 1
+            return path
+        if manifest["type"] != "pdf":
+            raise PreviewError(f"Preview page {page} of {name} is missing")
+        with extraction_scheduler.slot(INTERACTIVE):
+            for index, image in render_pages(file_path, [page - 1], PREVIEW_PAGE_WIDTH):
+                self._save_page_image(name, index, image)
+        self.counters["on_demand"] += 1
+        return path
+
+    def read_text(self, name: str, file_path: str) -> str:
+        """Full DOCX preview text, assembled from cached pages"""
+        manifest = self.manifest(name, file_path)
+        parts = []
+        for number in range(1, manifest["pages"] + 1):
+            with open(self.page(name, file_path, number), "r", encoding="utf-8") as handle:
+                parts.append(handle.read())
+        return "\n".join(parts)
+
+    def remove(self, name: str):
+        shutil.rmtree(self._dir(name), ignore_errors=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            building = len(self._building)
+        return {"building": building, **self.counters}
+
+preview_cache = PreviewCache()
@@ -0,0 +1,256 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import cProfile
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN")  # Callers sending it in X-Profile-Token get profiled; unset disables the header
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", 0))  # Fraction of requests profiled automatically
+PROFILING_MODE = os.getenv("PROFILING_MODE", "sampling")  # sampling (folded stacks) or cprofile (.prof)
+PROFILING_INTERVAL_MS = float(os.getenv("PROFILING_INTERVAL_MS", 5))
+PROFILING_MAX_CONCURRENT = int(os.getenv("PROFILING_MAX_CONCURRENT", 2))
+PROFILING_DIR = os.getenv("PROFILING_DIR", os.path.join(os.getcwd(), "logs", "profiles"))
+
+PROFILE_MODES = ("sampling", "cprofile")
+SAFE_TAG = re.compile(r"[^A-Za-z0-9_.-]+")
+
+# Profile of the request running in this context; copy the context into worker threads
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _is_idle(frame) -> bool:
+    """Leaf frames of threads parked on a lock, queue or event"""
+    code = frame.f_code
+    return code.co_name in ("wait", "get", "_wait_for_tstate_lock", "select") and \
+        os.path.basename(code.co_filename) in ("threading.py", "queue.py", "selectors.py")
+
+class RequestProfile:
+    """Profile of one request.
+
+    In sampling mode a background thread records, every PROFILING_INTERVAL_MS, the
+    stacks of the request thread and of the worker threads currently running on its
+    behalf (stages, ingestion producers, batch workers, which join through
+    attach_thread), so concurrent requests never show up in each other's profiles.
+    Threads shared between requests, such as the embedding service dispatcher, are
+    left out. Stacks are prefixed with the thread name and written in folded format
+    for flamegraph.pl or speedscope. cprofile mode traces
+    the request thread only and writes a .prof file. Named spans (load_document,
+    LLM calls) are recorded with wall times in a JSON file next to the profile.
+    """
+
+    def __init__(self, mode: str, reason: str):
+        self.mode = mode if mode in PROFILE_MODES else "sampling"
+        self.reason = reason
+        self.started = time.time()
+        self.thread_id = threading.get_ident()
+        self.samples = Counter()
+        self.spans = []
+        self._threads = Counter({self.thread_id: 1})  # Thread ident -> nesting depth of attach()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._profiler = None
+
+    def start(self):
+        if self.mode == "cprofile":
+            try:
+                self._profiler = cProfile.Profile()
+                self._profiler.enable()
+                return
+            except ValueError as e:
+                # Python 3.12+ allows one deterministic profiler per process at a time
+                logger.warning(f"cProfile unavailable ({str(e)}), sampling instead")
+                self._profiler = None
+                self.mode = "sampling"
+        if self.mode == "sampling":
+            self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+            self._sampler.start()
+
+    def attach(self, thread_id: int):
+        with self._lock:
+            self._threads[thread_id] += 1
+
+    def detach(self, thread_id: int):
+        with self._lock:
+            self._threads[thread_id] -= 1
+            if self._threads[thread_id] <= 0:
+                del self._threads[thread_id]
+
+    def _sample(self):
+        interval = PROFILING_INTERVAL_MS / 1000
+        names = {}
+        while not self._stop.wait(interval):
+            with self._lock:
+                threads = set(self._threads)
+            if not threads.issubset(names):
+                for thread in threading.enumerate():
+                    names.setdefault(thread.ident, thread.name)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id not in threads or (thread_id != self.thread_id and _is_idle(frame)):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                thread_name = "request" if thread_id == self.thread_id else names.get(thread_id, str(thread_id))
+                self.samples[";".join([thread_name] + stack[::-1])] += 1
+
+    def stop(self):
+        if self._profiler is not None:
+            self._profiler.disable()
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+
+    def add_span(self, name: str, start: float, duration: float, error: Optional[str] = None):
+        with self._lock:
+            span = {"name": name, "offset_ms": round((start - self.started) * 1000, 2), "ms": round(duration * 1000, 2)}
+            if error:
+                span["error"] = error
+            self.spans.append(span)
+
+    def write(self, request_id: str, info: Dict[str, Any]) -> str:
+        """Write the profile and its metadata to PROFILING_DIR; returns the profile path"""
+        os.makedirs(PROFILING_DIR, exist_ok=True)
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        base = os.path.join(PROFILING_DIR, f"{stamp}-{SAFE_TAG.sub('_', request_id)[:64]}")
+        if self.mode == "cprofile":
+            path = f"{base}.prof"
+            self._profiler.dump_stats(path)
+        else:
+            path = f"{base}.folded"
+            with open(path, "w", encoding="utf-8") as handle:
+                for stack, count in self.samples.most_common():
+                    handle.write(f"{stack} {count}\n")
+        with open(f"{base}.json", "w", encoding="utf-8") as handle:
+            json.dump({
+                "request_id": request_id,
+                "mode": self.mode,
+                "reason": self.reason,
+                "duration_ms": round((time.time() - self.started) * 1000, 2),
+                "samples": sum(self.samples.values()),
+                "interval_ms": PROFILING_INTERVAL_MS,
+                "spans": sorted(self.spans, key=lambda span: span["offset_ms"]),
+                **info
+            }, handle, indent=2, default=str)
+        return path
+
+class Profiler:
+    """Decides which requests are profiled and keeps the runtime toggle"""
+
+    def __init__(self):
+        self.sample_rate = PROFILING_SAMPLE_RATE
+        self.mode = PROFILING_MODE
+        self._active = 0
+        self._lock = threading.Lock()
+        self.counters = Counter()
+
+    def configure(self, sample_rate: Optional[float] = None, mode: Optional[str] = None):
+        if sample_rate is not None:
+            self.sample_rate = min(1.0, max(0.0, float(sample_rate)))
+        if mode is not None:
+            if mode not in PROFILE_MODES:
+                raise ValueError(f"Unknown profiling mode: {mode}")
+            self.mode = mode
+        logger.info(f"Profiling configured: sample_rate={self.sample_rate}, mode={self.mode}")
+
+    def begin(self, headers) -> Optional[RequestProfile]:
+        """Start profiling the current request when asked for by header or picked by sampling"""
+        current_profile.set(None)
+        requested = PROFILING_TOKEN and headers.get("X-Profile-Token") == PROFILING_TOKEN
+        if not requested and not (self.sample_rate and random.random() < self.sample_rate):
+            return None
+        with self._lock:
+            if self._active >= PROFILING_MAX_CONCURRENT:
+                self.counters["skipped"] += 1
+                return None
+            self._active += 1
+        mode = headers.get("X-Profile-Mode", self.mode) if requested else self.mode
+        profile = RequestProfile(mode, "header" if requested else "sampled")
+        profile.start()
+        current_profile.set(profile)
+        return profile
+
+    def end(self, profile: RequestProfile, request_id: Optional[str], info: Dict[str, Any]) -> Optional[str]:
+        try:
+            profile.stop()
+            path = profile.write(request_id or uuid.uuid4().hex, info)
+            self.counters["written"] += 1
+            logger.info(f"Wrote {profile.mode} profile for request {request_id} to {path}")
+            return path
+        except Exception as e:
+            self.counters["failed"] += 1
+            logger.error(f"Failed to write profile: {str(e)}", exc_info=True)
+            return None
+        finally:
+            current_profile.set(None)
+            with self._lock:
+                self._active -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"sample_rate": self.sample_rate, "mode": self.mode, "active": self._active, **self.counters}
+
+@contextmanager
+def span(name: str):
+    """Record the wall time of a block in the current request's profile, if any"""
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.time()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        profile.add_span(name, start, time.time() - start, error)
+
+def attach_thread(func):
+    """Wrap work handed to another thread so it is sampled with the current request's profile.
+
+    Call the wrapper inside a copy of the request's context; the thread counts as
+    the request's only while func runs.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = current_profile.get()
+        if profile is None:
+            return func(*args, **kwargs)
+        thread_id = threading.get_ident()
+        profile.attach(thread_id)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.detach(thread_id)
+    return wrapper
+
+def profiled(name: str = None):
+    """Decorator form of span"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+profiler = Profiler()
@@ -0,0 +1,139 @@
+import os
+import time
+import logging
+import threading
+import numpy as np
+from collections import Counter
+from typing import Dict, List, Optional, Any
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+ROUTER_CASUAL_THRESHOLD = float(os.getenv("ROUTER_CASUAL_THRESHOLD", 0.6))
+ROUTER_METADATA_THRESHOLD = float(os.getenv("ROUTER_METADATA_THRESHOLD", 0.55))
+ROUTER_MARGIN = float(os.getenv("ROUTER_MARGIN", 0.05))  # Required lead over the next best intent
+ROUTER_CASUAL_MAX_WORDS = int(os.getenv("ROUTER_CASUAL_MAX_WORDS", 12))
+
+INTENT_PROTOTYPES = {
+    "casual_chat": [
+        "hi", "hello", "hey there", "good morning", "how are you?", "what's up",
+        "thanks!", "thank you, that was helpful", "ok cool", "bye"
+    ],
+    "metadata_query": [
+        "how many pages does the document have", "how long is this paper",
+        "how many figures are there", "how many images are in the document",
+        "how many tables does the paper contain", "what are the sections of this document",
+        "show the table of contents", "what type of file is this", "what format is this image"
+    ],
+    "summary_request": [
+        "summarize the document", "give me an overview of the paper", "what are the main points",
+        "tl;dr", "what is this paper about"
+    ],
+    "technical_detail": [
+        "what method does the paper use", "explain the experimental setup", "what dataset was used",
+        "how does the proposed model work", "what are the evaluation results"
+    ],
+    "comparison": [
+        "compare the two approaches", "what is the difference between these methods",
+        "advantages and disadvantages", "how does it compare to the baseline"
+    ]
+}
+
+class QueryRouter:
+    """Classify queries against precomputed intent prototype vectors.
+
+    Reuses the already loaded sentence embedding model. Greetings and answerable
+    metadata questions are routed away from retrieval; every decision is counted
+    so the short-circuit rate can be measured.
+    """
+
+    def __init__(self, embedding_model, prototypes: Dict[str, List[str]] = None):
+        self.embedding_model = embedding_model
+        self.prototypes = prototypes or INTENT_PROTOTYPES
+        self._matrices = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.route_counts = Counter()
+        self.route_time = Counter()
+
+    @staticmethod
+    def _normalize(vectors) -> np.ndarray:
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+
+    def _prototype_matrices(self) -> Dict[str, np.ndarray]:
+        if self._matrices is None:
+            with self._lock:
+                if self._matrices is None:
+                    start = time.time()
+                    self._matrices = {
+                        intent: self._normalize(self.embedding_model.embed_documents(phrases))
+                        for intent, phrases in self.prototypes.items()
+                    }
+                    logger.info(f"Query router prototypes embedded in {time.time() - start:.2f} seconds")
+        return self._matrices
+
+    def classify(self, query: str, query_vector=None) -> Dict[str, Any]:
+        """Return per-intent similarity (best prototype match) and the normalized query vector"""
+        if query_vector is None:
+            query_vector = self.embedding_model.embed_query(query)
+        vector = self._normalize(query_vector)
+        scores = {
+            intent: float(np.max(matrix @ vector))
+            for intent, matrix in self._prototype_matrices().items()
+        }
+        return {"scores": scores, "query_vector": query_vector}
+
+    def route(self, query: str, metadata: Optional[Dict] = None, metadata_answer=None, query_vector=None) -> Dict[str, Any]:
+        """Decide between 'casual', 'metadata' and 'retrieval'.
+
+        metadata_answer(query, metadata) must return a string for the metadata route
+        to be taken, so only questions the stored metadata can answer short-circuit.
+        Pass query_vector when the query has already been embedded (e.g. in a batch).
+        """
+        start = time.time()
+        classified = self.classify(query, query_vector)
+        scores = classified["scores"]
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        best_intent, best_score = ranked[0]
+        margin = best_score - ranked[1][1] if len(ranked) > 1 else best_score
+
+        decision = {
+            "route": "retrieval",
+            "intent": best_intent,
+            "score": round(best_score, 3),
+            "margin": round(margin, 3),
+            "answer": None,
+            "query_vector": classified["query_vector"]
+        }
+        if (best_intent == "casual_chat" and best_score >= ROUTER_CASUAL_THRESHOLD and margin >= ROUTER_MARGIN
+                and len(query.split()) <= ROUTER_CASUAL_MAX_WORDS):
+            decision["route"] = "casual"
+        elif (best_intent == "metadata_query" and best_score >= ROUTER_METADATA_THRESHOLD and margin >= ROUTER_MARGIN
+                and metadata and metadata_answer):
+            answer = metadata_answer(query, metadata)
+            if answer:
+                decision["route"] = "metadata"
+                decision["answer"] = answer
+
+        elapsed = time.time() - start
+        decision["elapsed_ms"] = round(elapsed * 1000, 2)
+        with self._stats_lock:
+            self.route_counts[decision["route"]] += 1
+            self.route_time[decision["route"]] += elapsed
+        logger.info(
+            f"Query routed to {decision['route']} (intent={best_intent}, score={decision['score']}, "
+            f"margin={decision['margin']}, {decision['elapsed_ms']}ms)"
+        )
+        return decision
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                route: {
+                    "count": count,
+                    "avg_ms": round(self.route_time[route] / count * 1000, 2) if count else 0.0
+                }
+                for route, count in self.route_counts.items()
+            }
@@ -0,0 +1,139 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any, List
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+SCHEDULER_EMBED_SLOTS = int(os.getenv("SCHEDULER_EMBED_SLOTS", 1))  # Concurrent calls into the embedding model
+SCHEDULER_BULK_SLICE = int(os.getenv("SCHEDULER_BULK_SLICE", 16))  # Texts per bulk embedding call; bounds how long a query waits
+SCHEDULER_BULK_AGING = float(os.getenv("SCHEDULER_BULK_AGING", 10))  # Seconds after which waiting bulk work competes equally
+SCHEDULER_SMALL_DOC_PAGES = int(os.getenv("SCHEDULER_SMALL_DOC_PAGES", 20))
+SCHEDULER_SMALL_DOC_BYTES = int(os.getenv("SCHEDULER_SMALL_DOC_BYTES", 1024 * 1024))
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITIES = (INTERACTIVE, BULK)
+
+# Priority class of the work running in this context; copy the context into worker threads
+work_priority = contextvars.ContextVar("work_priority", default=INTERACTIVE)
+
+def ingest_priority(total_pages: int = None, size: int = None) -> str:
+    """Small documents are ingested at interactive priority, large ones as bulk work"""
+    if total_pages is not None:
+        return INTERACTIVE if total_pages <= SCHEDULER_SMALL_DOC_PAGES else BULK
+    return INTERACTIVE if (size or 0) <= SCHEDULER_SMALL_DOC_BYTES else BULK
+
+class PriorityScheduler:
+    """Slot scheduler with an interactive and a bulk class.
+
+    Free slots always go to waiting interactive work first; bulk work only runs
+    when no interactive work is waiting (or after waiting SCHEDULER_BULK_AGING
+    seconds, so it cannot starve). Bulk callers take a slot per slice of work, which
+    makes them preemptible between slices. Queue depth and wait times are kept per class.
+    """
+
+    def __init__(self, name: str, slots: int):
+        self.name = name
+        self.slots = max(1, slots)
+        self._free = self.slots
+        self._cond = threading.Condition()
+        self._waiting = {priority: deque() for priority in PRIORITIES}
+        self._stats = {
+            priority: {"running": 0, "completed": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for priority in PRIORITIES
+        }
+
+    def _eligible(self, ticket, priority: str) -> bool:
+        if self._free <= 0 or self._waiting[priority][0] is not ticket:
+            return False
+        if priority == INTERACTIVE or not self._waiting[INTERACTIVE]:
+            return True
+        return time.time() - ticket[0] >= SCHEDULER_BULK_AGING
+
+    def acquire(self, priority: str = None) -> float:
+        """Block until a slot is free for this class; returns seconds waited"""
+        priority = priority or work_priority.get()
+        ticket = (time.time(),)
+        with self._cond:
+            self._waiting[priority].append(ticket)
+            while not self._eligible(ticket, priority):
+                self._cond.wait()
+            self._waiting[priority].popleft()
+            self._free -= 1
+            waited = time.time() - ticket[0]
+            stats = self._stats[priority]
+            stats["running"] += 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+            # The next waiter in line may be eligible now too
+            self._cond.notify_all()
+        return waited
+
+    def release(self, priority: str = None):
+        priority = priority or work_priority.get()
+        with self._cond:
+            self._free += 1
+            self._stats[priority]["running"] -= 1
+            self._stats[priority]["completed"] += 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority: str = None):
+        priority = priority or work_priority.get()
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            result = {"slots": self.slots, "free": self._free}
+            for priority in PRIORITIES:
+                stats = self._stats[priority]
+                admitted = stats["completed"] + stats["running"]
+                result[priority] = {
+                    "queued": len(self._waiting[priority]),
+                    "running": stats["running"],
+                    "completed": stats["completed"],
+                    "avg_wait_ms": round(stats["wait_total"] / admitted * 1000, 2) if admitted else 0.0,
+                    "max_wait_ms": round(stats["wait_max"] * 1000, 2)
+                }
+            return result
+
+class ScheduledEmbeddings(Embeddings):
+    """Embedding model behind a PriorityScheduler.
+
+    Query embeddings are always interactive. Document batches use the priority of
+    the current context; bulk batches are cut into SCHEDULER_BULK_SLICE texts and
+    re-queue between slices, so a waiting query gets the model within one slice.
+    """
+
+    def __init__(self, model: Embeddings, scheduler: PriorityScheduler, bulk_slice: int = SCHEDULER_BULK_SLICE):
+        self.model = model
+        self.scheduler = scheduler
+        self.bulk_slice = max(1, bulk_slice)
+
+    def embed_query(self, text: str) -> List[float]:
+        with self.scheduler.slot(INTERACTIVE):
+            return self.model.embed_query(text)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        priority = work_priority.get()
+        if priority == INTERACTIVE:
+            with self.scheduler.slot(INTERACTIVE):
+                return self.model.embed_documents(texts)
+        vectors = []
+        for start in range(0, len(texts), self.bulk_slice):
+            with self.scheduler.slot(BULK):
+                vectors.extend(self.model.embed_documents(texts[start:start + self.bulk_slice]))
+        return vectors
+
+embedding_scheduler = PriorityScheduler("embedding", SCHEDULER_EMBED_SLOTS)
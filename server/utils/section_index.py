@@ -0,0 +1,154 @@
+import re
+import logging
+import threading
+import weakref
+import numpy as np
+from typing import List, Dict, Any, Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Canonical sections, matched against heading titles only (not body text)
+HEADING_SECTION_PATTERNS = {
+    "abstract": r"abstract|summary",
+    "introduction": r"introduction|background|motivation|related work|preliminaries",
+    "methods": r"methods?|methodology|approach|proposed|model|experimental setup|experiments?|implementation|materials",
+    "results": r"results?|findings|evaluation|analysis|outcomes?",
+    "discussion": r"discussion|conclusions?|concluding remarks|limitations|future work|implications",
+    "references": r"references|bibliography",
+    "appendix": r"appendix|appendices|supplementary"
+}
+
+# Legacy body-text patterns, used only when no heading structure is available
+SECTION_PATTERNS = {
+    "abstract": r"abstract|summary",
+    "introduction": r"introduction|background",
+    "methods": r"method|methodology|approach|experiment",
+    "results": r"result|finding|outcome|data",
+    "discussion": r"discussion|conclusion|implication",
+    "references": r"reference|bibliography",
+    "appendix": r"appendix|supplement"
+}
+
+HEADING_NUMBERING = re.compile(r'^\s*(?:(?:\d+|[IVX]+)(?:\.\d+)*\.?|[A-Z]\.)\s*')
+_HEADING_REGEXES = {
+    section: re.compile(rf"^(?:{pattern})\b", re.IGNORECASE)
+    for section, pattern in HEADING_SECTION_PATTERNS.items()
+}
+
+def canonical_section(title: str) -> Optional[str]:
+    """Map a heading title such as '3.1 Experimental Setup' to a canonical section"""
+    stripped = HEADING_NUMBERING.sub("", title).strip()
+    for section, regex in _HEADING_REGEXES.items():
+        if regex.match(stripped):
+            return section
+    return None
+
+def build_section_spans(headings: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Turn layout headings into ordered section start positions.
+
+    Headings that do not name a canonical section (subsections, titles) keep the
+    enclosing section, so only section changes are recorded.
+    """
+    spans = []
+    for heading in headings:
+        section = canonical_section(heading["title"])
+        if section and (not spans or spans[-1]["section"] != section):
+            spans.append({
+                "section": section,
+                "title": heading["title"],
+                "page": heading["page"],
+                "offset": heading["offset"]
+            })
+    return spans
+
+def assign_sections_from_spans(chunks: List[Any], spans: List[Dict[str, Any]]):
+    """Tag chunks (with page and start_index metadata) with the span they start in"""
+    starts = [(span["page"], span["offset"]) for span in spans]
+    for chunk in chunks:
+        position = (chunk.metadata.get("page", 0), chunk.metadata.get("start_index", 0))
+        section = "other"
+        for start, span in zip(starts, spans):
+            if start > position:
+                break
+            section = span["section"]
+        chunk.metadata["section"] = section
+
+def tag_element_sections(elements: Iterable[Any], spans: List[Dict[str, Any]]) -> Iterator[Any]:
+    """Tag DOCX elements with the section of the latest Title element while streaming.
+
+    Spans are appended as they are found; elements before the first section
+    heading are left untagged.
+    """
+    current = None
+    for index, element in enumerate(elements):
+        if element.metadata.get("category") == "Title":
+            section = canonical_section(element.page_content)
+            if section and section != current:
+                spans.append({"section": section, "title": element.page_content.strip(), "element": index})
+                current = section
+        if current:
+            element.metadata["section"] = current
+        yield element
+
+def assign_sections_by_keywords(chunks: List[Any]):
+    """Fallback: regex over the first 200 characters of chunks that have no section yet"""
+    for chunk in chunks:
+        if chunk.metadata.get("section"):
+            continue
+        first_200 = chunk.page_content[:200].lower()
+        for section, pattern in SECTION_PATTERNS.items():
+            if re.search(pattern, first_200):
+                chunk.metadata["section"] = section
+                break
+        else:
+            chunk.metadata["section"] = "other"
+
+class SectionIndex:
+    """Per-section vector matrices over a FAISS store, for pre-filtered search.
+
+    Searching a section only scores that section's vectors instead of retrieving
+    from the whole document and filtering afterwards.
+    """
+
+    def __init__(self, docs: List[Any], vectors: np.ndarray):
+        self.sections = {}
+        by_section = {}
+        for row, doc in enumerate(docs):
+            by_section.setdefault(doc.metadata.get("section", "other"), []).append(row)
+        for section, rows in by_section.items():
+            self.sections[section] = ([docs[row] for row in rows], vectors[rows])
+
+    @classmethod
+    def from_vector_store(cls, vector_store) -> "SectionIndex":
+        count = vector_store.index.ntotal
+        vectors = vector_store.index.reconstruct_n(0, count) if count else np.zeros((0, 0), dtype=np.float32)
+        docs = [vector_store.docstore.search(vector_store.index_to_docstore_id[i]) for i in range(count)]
+        return cls(docs, vectors)
+
+    def size(self, sections: List[str]) -> int:
+        return sum(len(self.sections[s][0]) for s in sections if s in self.sections)
+
+    def search(self, query_vector, sections: List[str], k: int = 5) -> List[Any]:
+        """L2 nearest neighbours (same metric as the FAISS flat index) within the given sections"""
+        query = np.asarray(query_vector, dtype=np.float32)
+        candidates = []
+        for section in sections:
+            if section not in self.sections:
+                continue
+            docs, matrix = self.sections[section]
+            distances = np.sum((matrix - query) ** 2, axis=1)
+            candidates.extend(zip(distances.tolist(), range(len(docs)), [section] * len(docs)))
+        candidates.sort(key=lambda item: item[0])
+        return [self.sections[section][0][row] for _, row, section in candidates[:k]]
+
+_section_indexes = weakref.WeakKeyDictionary()
+_section_lock = threading.Lock()
+
+def section_index_for(vector_store) -> SectionIndex:
+    """SectionIndex for a vector store, built once and dropped with the store"""
+    with _section_lock:
+        index = _section_indexes.get(vector_store)
+        if index is None:
+            index = SectionIndex.from_vector_store(vector_store)
+            _section_indexes[vector_store] = index
+        return index
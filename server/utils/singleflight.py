@@ -0,0 +1,68 @@
+import json
+import hashlib
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Dict, Any, Callable
+
+logger = logging.getLogger(__name__)
+
+def fingerprint(payload: Dict[str, Any]) -> str:
+    """Stable key for a request payload: same model, messages and parameters give the same key"""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+class SingleFlight:
+    """Coalesces identical calls that overlap in time.
+
+    The first caller for a key (the leader) runs the call; callers arriving with
+    the same key while it is running wait for it and get the same result, or the
+    same exception. Nothing is kept once the call returns, so this never serves a
+    stale answer; it only removes duplicate work during bursts (double submits, a
+    class asking the same question about the same paper).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}  # key -> Future
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "leaders": 0, "shared": 0, "failed": 0}
+        self._max_waiters = 0
+        self._waiters = {}
+
+    def do(self, key: str, func: Callable[[], Any]) -> Any:
+        with self._lock:
+            self.counters["calls"] += 1
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self._waiters[key] = 1
+                self.counters["leaders"] += 1
+            else:
+                self.counters["shared"] += 1
+                self._waiters[key] += 1
+                self._max_waiters = max(self._max_waiters, self._waiters[key])
+        if not leader:
+            return future.result()
+        try:
+            result = func()
+        except BaseException as e:
+            with self._lock:
+                self.counters["failed"] += 1
+                self._release(key)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._release(key)
+        future.set_result(result)
+        return result
+
+    def _release(self, key: str):
+        self._calls.pop(key, None)
+        waiters = self._waiters.pop(key, 1)
+        if waiters > 1:
+            logger.info(f"{self.name}: one call served {waiters} identical requests")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.counters, "in_flight": len(self._calls), "max_waiters": self._max_waiters}
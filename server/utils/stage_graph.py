@@ -0,0 +1,173 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from typing import Dict, Any, Callable, List, Optional, Sequence
+from utils.profiling import attach_thread
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+STAGE_GRAPH_WORKERS = int(os.getenv("STAGE_GRAPH_WORKERS", 8))  # Threads shared by all request stage graphs
+
+stage_pool = ThreadPoolExecutor(max_workers=max(1, STAGE_GRAPH_WORKERS), thread_name_prefix="stage")
+
+PENDING, CLAIMED, CANCELLED = "pending", "claimed", "cancelled"
+
+class _Stage:
+    def __init__(self, name: str, func: Callable, after: Sequence[str]):
+        self.name = name
+        self.func = func
+        self.after = tuple(after)
+        self.future = Future()
+        self.state = PENDING
+        self.started = None
+        self.finished = None
+
+class StageGraph:
+    """Runs the stages of one request as a small dependency graph.
+
+    add() registers a stage with the stages it runs after; it is handed to the
+    shared stage pool as soon as those have finished, and called with their results
+    in order. result() waits for a stage, but a caller never waits on work nobody
+    has started: stages still queued (or whose inputs are not ready yet) are run in
+    the calling thread instead, so nested graphs cannot starve the pool. Stages run
+    in a copy of the creating thread's context (admission user, profile). report()
+    adds per-stage timings and the critical path to a timing dict.
+
+    Use the graph as a context manager so no stage outlives the request: on exit,
+    whatever the exit path, stages not started yet are cancelled, stopped is set
+    for long-running stages to poll, and running stages are waited for.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.stopped = threading.Event()  # Set by stop(); long-running stages poll it to end early
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._context = contextvars.copy_context()
+
+    def add(self, name: str, func: Callable, after: Sequence[str] = ()) -> "StageGraph":
+        missing = [dep for dep in after if dep not in self._stages]
+        if missing:
+            raise ValueError(f"Stage {name} depends on unknown stage(s): {', '.join(missing)}")
+        stage = _Stage(name, func, after)
+        with self._lock:
+            self._stages[name] = stage
+        remaining = [self._stages[dep].future for dep in after]
+        if not remaining:
+            self._submit(stage)
+            return self
+        counter = {"left": len(remaining)}
+        counter_lock = threading.Lock()
+
+        def dependency_done(_):
+            with counter_lock:
+                counter["left"] -= 1
+                ready = counter["left"] == 0
+            if ready:
+                self._submit(stage)
+
+        for future in remaining:
+            future.add_done_callback(dependency_done)
+        return self
+
+    def _submit(self, stage: _Stage):
+        if stage.state == PENDING:
+            try:
+                stage_pool.submit(self._run, stage)
+            except RuntimeError:
+                # Pool shut down (interpreter exit); the waiter runs the stage itself
+                pass
+
+    def _claim(self, stage: _Stage) -> bool:
+        with self._lock:
+            if stage.state != PENDING:
+                return False
+            stage.state = CLAIMED
+            return True
+
+    def _run(self, stage: _Stage):
+        if not self._claim(stage):
+            return
+        stage.started = time.time()
+        try:
+            inputs = [self._stages[dep].future.result() for dep in stage.after]
+            result = self._context.copy().run(attach_thread(stage.func), *inputs)
+        except BaseException as e:
+            stage.finished = time.time()
+            stage.future.set_exception(e)
+            return
+        stage.finished = time.time()
+        stage.future.set_result(result)
+
+    def result(self, name: str, timeout: Optional[float] = None) -> Any:
+        """Result of a stage, running it (and its unfinished inputs) here if no worker has picked it up"""
+        stage = self._stages[name]
+        if not stage.future.done():
+            for dep in stage.after:
+                self.result(dep, timeout)
+            self._run(stage)
+        return stage.future.result(timeout)
+
+    def cancel(self):
+        """Drop stages that have not started, e.g. speculative work after an early answer"""
+        with self._lock:
+            for stage in self._stages.values():
+                if stage.state == PENDING:
+                    stage.state = CANCELLED
+                    stage.future.cancel()
+
+    def stop(self):
+        """Cancel pending stages and ask running ones to stop, without waiting for them"""
+        self.stopped.set()
+        self.cancel()
+
+    def close(self):
+        """stop(), then wait for stages already running"""
+        self.stop()
+        with self._lock:
+            running = [stage.future for stage in self._stages.values() if stage.state == CLAIMED]
+        wait(running)
+
+    def __enter__(self) -> "StageGraph":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def critical_path(self) -> List[str]:
+        """Chain of finished stages, each the latest-finishing input of the next, ending at the last to finish"""
+        finished = [stage for stage in self._stages.values() if stage.finished is not None]
+        if not finished:
+            return []
+        stage = max(finished, key=lambda s: s.finished)
+        path = [stage.name]
+        while True:
+            inputs = [self._stages[dep] for dep in stage.after if self._stages[dep].finished is not None]
+            if not inputs:
+                break
+            stage = max(inputs, key=lambda s: s.finished)
+            path.append(stage.name)
+        return path[::-1]
+
+    def report(self, timing: Dict[str, Any]) -> Dict[str, Any]:
+        stages = {}
+        for stage in self._stages.values():
+            if stage.finished is not None:
+                stages[stage.name] = {
+                    "offset_ms": round((stage.started - self.started) * 1000, 1),
+                    "ms": round((stage.finished - stage.started) * 1000, 1)
+                }
+            elif stage.state == CANCELLED:
+                stages[stage.name] = "cancelled"
+        path = self.critical_path()
+        timing["stages"] = stages
+        timing["critical_path"] = " > ".join(path)
+        if path:
+            first, last = self._stages[path[0]], self._stages[path[-1]]
+            timing["critical_path_ms"] = round((last.finished - first.started) * 1000, 1)
+        return timing
@@ -0,0 +1,173 @@
+import os
+import zlib
+import codecs
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Any, Iterator, Optional
+from utils.db import documents_collection, document_texts_collection
+
+try:
+    import zstandard
+except ImportError:  # Optional (pip install zstandard); zlib is always available, zstd is smaller and faster
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+TEXT_STORE_CODEC = os.getenv("TEXT_STORE_CODEC", "zstd" if zstandard else "zlib")  # zstd or zlib
+TEXT_STORE_LEVEL = int(os.getenv("TEXT_STORE_LEVEL", 6))  # Compression level for either codec
+TEXT_STORE_PART_BYTES = int(os.getenv("TEXT_STORE_PART_BYTES", 4 * 1024 * 1024))  # Compressed bytes per record, under the 16MB BSON limit
+TEXT_STORE_READ_CHARS = 64 * 1024  # Input fed to the compressor at a time
+
+CODECS = ("zstd", "zlib")
+
+# Projection for document reads that do not need the text; also hides copies in records written before the store
+WITHOUT_TEXT = {"extracted_text": 0, "metadata.extracted_text": 0}
+
+def _compressor(codec: str):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=TEXT_STORE_LEVEL).compressobj()
+    return zlib.compressobj(TEXT_STORE_LEVEL)
+
+def _decompressor(codec: str):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd-compressed text")
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj()
+
+class TextStore:
+    """Compressed extracted text, stored out of line from the documents collection.
+
+    Text is keyed by file hash, so identical uploads share one copy. The compressed
+    stream is cut into records of at most TEXT_STORE_PART_BYTES: the head record
+    (_id = file hash) holds the codec, sizes and the first part, and further parts
+    are "<hash>:<n>". The head is written last, so a text is visible only once it is
+    complete. iter_text decompresses one part at a time instead of materialising the
+    compressed blob. Records written before the store kept the text inline; those
+    are moved here the first time they are read.
+    """
+
+    def __init__(self, collection=document_texts_collection, codec: str = TEXT_STORE_CODEC):
+        self.collection = collection
+        if codec not in CODECS or (codec == "zstd" and zstandard is None):
+            logger.warning(f"Text store codec {codec} unavailable, using zlib")
+            codec = "zlib"
+        self.codec = codec
+        self._lock = threading.Lock()
+        self.counters = {"stored": 0, "reads": 0, "misses": 0, "migrated": 0, "removed": 0,
+                         "raw_bytes": 0, "compressed_bytes": 0}
+
+    def _count(self, **deltas):
+        with self._lock:
+            for key, value in deltas.items():
+                self.counters[key] += value
+
+    def exists(self, file_hash: str) -> bool:
+        return bool(file_hash) and self.collection.find_one({"_id": file_hash}, {"_id": 1}) is not None
+
+    def put(self, file_hash: str, text: str) -> bool:
+        """Store text for a file hash; a no-op when it is already stored"""
+        if not file_hash or text is None or self.exists(file_hash):
+            return False
+        compressor = _compressor(self.codec)
+        parts = []
+        pending = b""
+        raw = 0
+        for offset in range(0, len(text), TEXT_STORE_READ_CHARS):
+            data = text[offset:offset + TEXT_STORE_READ_CHARS].encode("utf-8")
+            raw += len(data)
+            pending += compressor.compress(data)
+            while len(pending) >= TEXT_STORE_PART_BYTES:
+                parts.append(pending[:TEXT_STORE_PART_BYTES])
+                pending = pending[TEXT_STORE_PART_BYTES:]
+        pending += compressor.flush()
+        while pending or not parts:
+            parts.append(pending[:TEXT_STORE_PART_BYTES])
+            pending = pending[TEXT_STORE_PART_BYTES:]
+        for number, data in enumerate(parts[1:], start=1):
+            self.collection.replace_one({"_id": f"{file_hash}:{number}"}, {"data": data}, upsert=True)
+        compressed = sum(len(data) for data in parts)
+        self.collection.replace_one({"_id": file_hash}, {
+            "codec": self.codec,
+            "chars": len(text),
+            "raw_bytes": raw,
+            "compressed_bytes": compressed,
+            "parts": len(parts),
+            "data": parts[0],
+            "created_at": datetime.utcnow()
+        }, upsert=True)
+        self._count(stored=1, raw_bytes=raw, compressed_bytes=compressed)
+        logger.info(f"Stored text for {file_hash}: {raw} bytes as {compressed} ({self.codec}, {len(parts)} part(s))")
+        return True
+
+    def _migrate(self, file_hash: str) -> bool:
+        """Move text kept inline by older document records into the store"""
+        legacy = documents_collection.find_one(
+            {"file_hash": file_hash, "extracted_text": {"$exists": True}},
+            {"extracted_text": 1}
+        )
+        if legacy is None:
+            return False
+        self.put(file_hash, legacy.get("extracted_text") or "")
+        documents_collection.update_many(
+            {"file_hash": file_hash},
+            {"$unset": {"extracted_text": "", "metadata.extracted_text": ""}}
+        )
+        self._count(migrated=1)
+        logger.info(f"Migrated inline text of {file_hash} to the text store")
+        return True
+
+    def iter_text(self, file_hash: str) -> Iterator[str]:
+        """Decompressed text in pieces, fetching one stored part at a time"""
+        if not file_hash:
+            return
+        head = self.collection.find_one({"_id": file_hash})
+        if head is None and self._migrate(file_hash):
+            head = self.collection.find_one({"_id": file_hash})
+        if head is None:
+            self._count(misses=1)
+            return
+        self._count(reads=1)
+        decompressor = _decompressor(head["codec"])
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for number in range(head["parts"]):
+            if number == 0:
+                data = head["data"]
+            else:
+                record = self.collection.find_one({"_id": f"{file_hash}:{number}"})
+                if record is None:
+                    raise RuntimeError(f"Stored text for {file_hash} is missing part {number}")
+                data = record["data"]
+            piece = decoder.decode(decompressor.decompress(bytes(data)))
+            if piece:
+                yield piece
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+
+    def read(self, file_hash: str) -> Optional[str]:
+        """Full text for a file hash, or None when nothing is stored"""
+        pieces = list(self.iter_text(file_hash))
+        if not pieces and not self.exists(file_hash):
+            return None
+        return "".join(pieces)
+
+    def remove(self, file_hash: Optional[str]):
+        if not file_hash:
+            return
+        head = self.collection.find_one_and_delete({"_id": file_hash})
+        if head is None:
+            return
+        for number in range(1, head.get("parts", 1)):
+            self.collection.delete_one({"_id": f"{file_hash}:{number}"})
+        self._count(removed=1)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self.counters)
+        ratio = counters["raw_bytes"] / counters["compressed_bytes"] if counters["compressed_bytes"] else 0.0
+        return {"codec": self.codec, "compression_ratio": round(ratio, 2), **counters}
+
+text_store = TextStore()
@@ -0,0 +1,118 @@
+import os
+import hashlib
+import logging
+import tempfile
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge
+from utils.file_utils import MAX_FILE_SIZE, FileProcessingError
+from utils.image_utils import allowed_image, MAX_IMAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_TEMP_PREFIX = ".upload_"
+
+class HashingUploadFile:
+    """Temporary upload file that hashes and size-checks data as the multipart parser writes it.
+
+    The file lives in the upload folder, so keeping it is a rename rather than a copy.
+    Anything not committed is deleted when the request closes its files.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.committed = False
+        self._hasher = hashlib.sha256()
+        self._file = tempfile.NamedTemporaryFile(dir=directory, prefix=UPLOAD_TEMP_PREFIX, delete=False)
+        self.temp_path = self._file.name
+
+    @property
+    def sha256(self) -> str:
+        return self._hasher.hexdigest()
+
+    def write(self, data) -> int:
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.discard()
+            raise RequestEntityTooLarge(f"File size exceeds {self.max_size/1024/1024}MB limit")
+        self._hasher.update(data)
+        return self._file.write(data)
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def flush(self):
+        return self._file.flush()
+
+    def commit(self, dest_path: str):
+        """Move the fully received upload to its final path"""
+        self._file.flush()
+        self._file.close()
+        os.replace(self.temp_path, dest_path)
+        self.committed = True
+
+    def discard(self):
+        if not self._file.closed:
+            self._file.close()
+        if not self.committed and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def close(self):
+        self.discard()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+class UploadRequest(Request):
+    """Request class whose file parts stream straight into HashingUploadFile"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        limit = MAX_IMAGE_SIZE if filename and allowed_image(filename) else MAX_FILE_SIZE
+        return HashingUploadFile(current_app.config['UPLOAD_FOLDER'], limit)
+
+def save_upload(file_storage, dest_path: str, max_size: int = MAX_FILE_SIZE):
+    """Persist an uploaded file and return (size, sha256) without re-reading it.
+
+    Falls back to a single hashing copy when the upload was not parsed by UploadRequest.
+    """
+    stream = file_storage.stream
+    if isinstance(stream, HashingUploadFile):
+        stream.commit(dest_path)
+        return stream.size, stream.sha256
+
+    sha256_hash = hashlib.sha256()
+    size = 0
+    stream.seek(0)
+    try:
+        with open(dest_path, "wb") as out:
+            for block in iter(lambda: stream.read(131072), b""):
+                size += len(block)
+                if size > max_size:
+                    raise FileProcessingError(f"File size exceeds {max_size/1024/1024}MB limit")
+                sha256_hash.update(block)
+                out.write(block)
+    except Exception:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+    return size, sha256_hash.hexdigest()
+
+def upload_hash(file_storage) -> str:
+    """Hash of an upload already computed during parsing, if available"""
+    stream = file_storage.stream
+    if isinstance(stream, HashingUploadFile):
+        return stream.sha256
+    return None
+
+def discard_upload(file_storage):
+    """Drop a received upload without ever moving it into the upload folder"""
+    stream = file_storage.stream
+    if isinstance(stream, HashingUploadFile):
+        stream.discard()